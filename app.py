@@ -2,13 +2,116 @@ import streamlit as st
 import os
 import time
 import uuid
-
-
-randomID = uuid.uuid4()
-folderName = f"./docs/{randomID}"
+from dotenv import load_dotenv
+# before the modules below read their settings (JOB_WORKERS, RESULTS_DB, METRICS_PORT)
+load_dotenv()
+from worker import JobQueue
+from uploads import UploadPersister
+from results_store import ResultsStore, RESULTS_PAGE_SIZE
+
+# Warm pipeline processes shared by every session of this server
+@st.cache_resource
+def get_job_queue():
+    return JobQueue()
+
+@st.cache_resource
+def get_results_store():
+    return ResultsStore()
+
+STAGE_LABELS = {
+    "parse": "Parsing documents",
+    "chunk": "Chunking",
+    "summarize": "Summarizing",
+    "compare": "Comparing with the RFQ",
+    "rank": "Ranking providers",
+}
+
+MAX_PROVIDERS = 20
+OUTPUT_CACHE_ENTRIES = 512  # finished markdown outputs kept in memory across sessions
+
+# Workspace of this browser session: ./docs/{id} for the uploads and ./markdown/{id} for the outputs
+def session_workspace():
+    if 'workspace_id' not in st.session_state:
+        st.session_state.workspace_id = uuid.uuid4().hex
+        st.session_state.uploads = UploadPersister(f"./docs/{st.session_state.workspace_id}")
+    return st.session_state.workspace_id
+
+# Provider sub folders of the workspace, as discovered by comparison.py
+def workspace_providers(folderName):
+    if not os.path.isdir(folderName):
+        return []
+    return sorted(name for name in os.listdir(folderName)
+                  if os.path.isdir(os.path.join(folderName, name)) and not name.startswith("."))
+
+# Markdown output keyed by path and mtime: reruns and other sessions reuse it until the file changes
+@st.cache_data(max_entries=OUTPUT_CACHE_ENTRIES, show_spinner=False)
+def read_output(path, mtime):
+    with open(path, "r") as file:
+        return file.read()
+
+def cached_output(path):
+    try:
+        return read_output(path, os.path.getmtime(path))
+    except FileNotFoundError:
+        return None
+
+# Summaries and final recommendation of a finished analysis in `outputDir`
+def render_outputs(outputDir, providers):
+    outputs = [("Customer RFQ Summary", "RFQ_customerSummary.md")]
+    outputs += [(f"{provider.capitalize()} RFQ Summary", f"{provider}_summary.md") for provider in providers]
+    outputs.append(("Final RFQ Comparison and Recommendation", "finalResponse.md"))
+    for title, name in outputs:
+        content = cached_output(os.path.join(outputDir, name))
+        if content:
+            st.markdown(f"## {title}")
+            st.markdown(content)
+
+# Sidebar search over the results store; returns the past evaluation picked, if any
+def select_past_evaluation():
+    store = get_results_store()
+    st.sidebar.header("Past evaluations")
+    search = st.sidebar.text_input("Workspace or provider", placeholder="Start of the workspace id or a provider name")
+    order = st.sidebar.radio("Sort by", ["recent", "score"], horizontal=True,
+                             format_func=lambda order: "Most recent" if order == "recent" else "Top score")
+    page = st.sidebar.number_input("Page", min_value=1, value=1, step=1)
+    runs = store.list_runs(search.strip() or None, order, offset=(int(page) - 1) * RESULTS_PAGE_SIZE)
+    if not runs:
+        st.sidebar.caption("No evaluations found")
+        return None
+    labels = {run["id"]: f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(run['finished_at']))} · {run['file_id'][:8]} · "
+                         f"{run['top_provider'] or 'no providers'} {run['top_score'] or ''}".strip() for run in runs}
+    selected = st.sidebar.selectbox("Evaluation", list(labels), index=None, format_func=labels.get, placeholder="Open a past evaluation")
+    return store.get_run(selected) if selected else None
+
+def render_past_evaluation(run):
+    st.markdown(f"# Evaluation {run['file_id']}")
+    st.caption(f"Finished {time.strftime('%Y-%m-%d %H:%M', time.localtime(run['finished_at']))}; ranking: "
+               + ", ".join(f"{position}. {provider} ({score})" for provider, score, position in run["scores"]))
+    finalPath = os.path.join(run["output_dir"], "finalResponse.md")
+    # the outputs of a workspace are rewritten by every run, only the latest run's are on disk
+    if os.path.exists(finalPath) and os.path.getmtime(finalPath) > run["finished_at"] + 1:
+        st.warning("This workspace was analysed again later; the outputs shown are from the latest run.")
+    render_outputs(run["output_dir"], sorted(provider for provider, _, _ in run["scores"]))
+
+# Partial markdown written token by token by the running analysis
+def render_live_outputs(randomID, folderName):
+    outputs = [("Customer RFQ Summary", "RFQ_customerSummary.md")]
+    for provider in workspace_providers(folderName):
+        outputs.append((f"{provider.capitalize()} RFQ Summary", f"{provider}_summary.md"))
+        outputs.append((f"{provider.capitalize()} Comparison", f"{provider}_comparison.md"))
+    outputs.append(("Final RFQ Comparison and Recommendation", "finalResponse.md"))
+
+    # files that did not change since the last poll are served from the cache
+    for title, name in outputs:
+        content = cached_output(f"./markdown/{randomID}/{name}")
+        if content:
+            st.markdown(f"## {title}")
+            st.markdown(content)
 
 # Function to handle the app's main content
 def main():
+    randomID = session_workspace()
+    folderName = f"./docs/{randomID}"
     print("--debug triggering app.py with id:",randomID," and folder name:",folderName,"\n")
     # Initialize session state variables to track uploads and analysis completion
     if 'uploaded' not in st.session_state:
@@ -20,6 +123,11 @@ def main():
     # Title of the app
     st.title("RFQ Document Summarization and Response Comparison")
 
+    pastRun = select_past_evaluation()
+    if pastRun:
+        render_past_evaluation(pastRun)
+        return
+
     # Instructions
     st.markdown(
         """
@@ -33,45 +141,33 @@ def main():
     customer_file = st.file_uploader("Upload RFQ Customer File", type=["pdf", "docx", "txt", "xlsx"])
 
     # Upload provider docs
-    provider1_files = st.file_uploader("Upload Provider1 Files", type=["pdf", "docx", "txt", "xlsx"], accept_multiple_files=True)
-    provider2_files = st.file_uploader("Upload Provider2 Files", type=["pdf", "docx", "txt", "xlsx"], accept_multiple_files=True)
-    provider3_files = st.file_uploader("Upload Provider3 Files", type=["pdf", "docx", "txt", "xlsx"], accept_multiple_files=True)
+    provider_count = st.number_input("Number of providers", min_value=1, max_value=MAX_PROVIDERS, value=3, step=1)
+    provider_files = {}
+    for number in range(1, int(provider_count) + 1):
+        provider_files[f"provider{number}"] = st.file_uploader(
+            f"Upload Provider{number} Files", type=["pdf", "docx", "txt", "xlsx"], accept_multiple_files=True
+        )
 
     print("--debug customer and provider files", customer_file," ",
-            "\n--providerfiles",provider1_files,provider2_files,provider3_files)
+            "\n--providerfiles",provider_files)
     
     # Ensure the directory for docs exists
     os.makedirs(f"{folderName}", exist_ok=True)
     print("--debug creating directory in docs: ",st.session_state.uploaded)
 
 
-    # Upload files and save them to the ./docs folder
+    # Upload files and save them to the ./docs folder; every rerun of the script passes the same
+    # uploads again, only new or replaced ones are written (hard links into a shared blob store)
     if customer_file is not None:
-        with open(os.path.join(f"{folderName}", "rfq_customer.pdf"), "wb") as f:
-            f.write(customer_file.getbuffer())
-        
-        # Provider 1
-        if provider1_files:
-            os.makedirs(f"{folderName}/provider1", exist_ok=True)
-            for i, provider_file in enumerate(provider1_files):
-                with open(os.path.join(f"{folderName}/provider1", provider_file.name), "wb") as f:
-                    f.write(provider_file.getbuffer())
-            print("--debug created provider1_files size:",len(provider1_files))
-        # Provider 2
-        if provider2_files:
-            os.makedirs(f"{folderName}/provider2", exist_ok=True)
-            for i, provider_file in enumerate(provider2_files):
-                with open(os.path.join(f"{folderName}/provider2", provider_file.name), "wb") as f:
-                    f.write(provider_file.getbuffer())
-            print("--debug created provider2_files size:",len(provider2_files))
-
-        # Provider 3
-        if provider3_files:
-            os.makedirs(f"{folderName}/provider3", exist_ok=True)
-            for i, provider_file in enumerate(provider3_files):
-                with open(os.path.join(f"{folderName}/provider3", provider_file.name), "wb") as f:
-                    f.write(provider_file.getbuffer())
-            print("--debug created provider3_files size:",len(provider3_files))
+        # keep the uploaded extension so the parser picks the right reader
+        customer_extension = os.path.splitext(customer_file.name)[1].lower() or ".pdf"
+        uploads = {f"rfq_customer{customer_extension}": customer_file}
+        for provider, files in provider_files.items():
+            for provider_file in files or []:
+                uploads[os.path.join(provider, os.path.basename(provider_file.name))] = provider_file
+        written = st.session_state.uploads.persist(uploads)
+        if written:
+            print("--debug uploads written:",written)
 
         st.success("Files uploaded successfully!")
         st.session_state.uploaded = True  # Mark uploads as successful in session state
@@ -79,55 +175,47 @@ def main():
     # Backend processing trigger
     if st.button("Run Analysis"):
         if st.session_state.uploaded:
-            with st.spinner('Processing documents...'):
-                # Progress bar
-                progress_bar = st.progress(0)
-
-                try:
-                    # Run comparison.py (backend logic)
-                    os.system(f"python3 comparison.py --filename {randomID}")
-                    
-                    progress_bar.progress(50)
-                    time.sleep(2)  # Simulate time taken for the backend to complete
-                    progress_bar.progress(100)
-
-                    st.success("RFQ Summarization and Comparison completed successfully!")
-                    st.session_state.analysis_done = True  # Mark analysis as done in session state
-                    
-                except Exception as e:
-                    st.error(f"Error running the analysis: {e}")
-            progress_bar.empty()
+            # Run comparison.py (backend logic) in the background worker pool
+            st.session_state.job_id = get_job_queue().submit(str(randomID), stream=True)
+            st.session_state.analysis_done = False
         else:
             st.error("Please upload both the customer and provider files before running analysis.")
 
-    # Display customer RFQ summary only if analysis is done
-    if st.session_state.analysis_done and os.path.exists(f"./markdown/{randomID}/RFQ_customerSummary.md"):
-        with open(f"./markdown/{randomID}/RFQ_customerSummary.md", "r") as file:
-            customer_summary = file.read()
-
-        st.markdown("## Customer RFQ Summary")
-        st.markdown(customer_summary)
-    print("--debug markdown files")
-
-    # Display provider RFQ summaries only if analysis is done
+    # Poll the running job; the rerun keeps this session responsive and frees the server for others
+    if st.session_state.get('job_id') and not st.session_state.analysis_done:
+        jobs = get_job_queue()
+        try:
+            # fails the job if its worker process died under it
+            jobs.check_workers()
+        except RuntimeError as e:
+            st.error(f"Error running the analysis: {e}")
+            st.session_state.job_id = None
+            st.stop()
+        job = jobs.status(st.session_state.job_id)
+        if job["status"] == "done":
+            print("--debug time to first token", job["result"]["time_to_first_token"])
+            st.success("RFQ Summarization and Comparison completed successfully!")
+            totals = job["result"]["metrics"]["totals"]
+            st.caption(f"{job['result']['metrics']['wall_seconds']:.0f}s, {totals['llm_calls']} LLM calls "
+                       f"({totals['cache_hits']} cached), {totals['prompt_tokens'] + totals['completion_tokens']} tokens "
+                       f"({totals['cached_token_ratio']:.0%} of the prompt tokens from the prompt cache), "
+                       f"about ${totals['cost_usd']:.2f}")
+            st.session_state.analysis_done = True  # Mark analysis as done in session state
+            st.session_state.job_id = None
+        elif job["status"] == "error":
+            st.error(f"Error running the analysis: {job['error']}")
+            st.session_state.job_id = None
+        else:
+            label = "Waiting for a free worker..." if job["status"] == "queued" else \
+                f"{STAGE_LABELS.get(job['stage'], 'Processing documents')} {job['target'] or ''}".strip()
+            st.progress(job["progress"], text=label)
+            render_live_outputs(randomID, folderName)
+            time.sleep(0.5)
+            st.rerun()
+
+    # Display the customer and provider summaries and the final recommendation only if analysis is done;
+    # the files are read once per change, not on every rerun
     if st.session_state.analysis_done:
-        providers = ["provider1", "provider2", "provider3"]
-
-        for provider in providers:
-            summary_file = f"./markdown/{randomID}/{provider}_summary.md"
-            
-            if os.path.exists(summary_file):
-                with open(summary_file, "r") as file:
-                    provider_summary = file.read()
-                
-                st.markdown(f"## {provider.capitalize()} RFQ Summary")
-                st.markdown(provider_summary)
-
-    # Display the final recommendation only if analysis is done
-    if st.session_state.analysis_done and os.path.exists(f"./markdown/{randomID}/finalResponse.md"):
-        with open(f"./markdown/{randomID}/finalResponse.md", "r") as file:
-            final_analysis = file.read()
-
-        st.markdown("## Final RFQ Comparison and Recommendation")
-        st.markdown(final_analysis)
+        render_outputs(f"./markdown/{randomID}", workspace_providers(folderName))
+    print("--debug markdown files")
 
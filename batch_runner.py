@@ -0,0 +1,157 @@
+# Headless re-run of many RFQ workspaces, e.g. overnight over the historical folders in ./docs/
+#
+#   python batch_runner.py --workers 4 --llm-concurrency 32
+#   python batch_runner.py --include "2024-*" --compare-mode summary --report ./markdown/rescore.json
+#
+# Every workspace under ./docs/ with an rfq_customer file is analysed by a pool of warm
+# worker processes (worker.JobQueue). The LLM concurrency cap and the LLM_RPM / LLM_TPM
+# budgets are split between the processes, so together they never exceed them. Each
+# analysis checkpoints its finished tasks in ./markdown/{fileId}/stages.json, so after a
+# crash the same command resumes: completed stages are reused and only the rest runs.
+# The report (JSON and a markdown table next to it) is rewritten after every workspace.
+import os
+import sys
+import json
+import time
+import fnmatch
+import argparse
+from dotenv import load_dotenv
+
+BATCH_RUNNER_WORKERS = int(os.getenv("BATCH_RUNNER_WORKERS", 2))  # workspaces analysed at once
+BATCH_RUNNER_POLL_SECONDS = 1.0
+DOCS_DIR = "./docs"  # where run_analysis reads ./docs/{fileId}
+
+
+def discover_workspaces(docsDir=DOCS_DIR, include=("*",), exclude=()):
+    workspaces = []
+    for entry in sorted(os.scandir(docsDir), key=lambda entry: entry.name):
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+        if not any(fnmatch.fnmatch(entry.name, pattern) for pattern in include):
+            continue
+        if any(fnmatch.fnmatch(entry.name, pattern) for pattern in exclude):
+            continue
+        if any('rfq_customer' in name.lower() for name in os.listdir(entry.path)):
+            workspaces.append(entry.name)
+    return workspaces
+
+
+# Splits the process-wide LLM limits between `workers` processes; must run before they start
+def share_llm_limits(workers, llm_concurrency):
+    os.environ["LLM_MAX_CONCURRENCY"] = str(max(1, llm_concurrency // workers))
+    for name in ("LLM_RPM", "LLM_TPM"):
+        limit = int(os.getenv(name, 0))
+        if limit:
+            os.environ[name] = str(max(1, limit // workers))
+    # each analysis parses with its own process pool
+    os.environ.setdefault("PARSE_WORKERS", str(max(1, (os.cpu_count() or 1) // workers)))
+
+
+def workspace_entry(job):
+    entry = {
+        "fileId": job["fileId"], "status": job["status"],
+        "queued_seconds": round((job["started_at"] or job["finished_at"]) - job["submitted_at"], 3),
+        "job_seconds": round(job["finished_at"] - job["started_at"], 3) if job["started_at"] else None,
+    }
+    if job["status"] == "error":
+        entry["error"] = (job["error"] or "").strip().splitlines()[-1:]
+        return entry
+    metrics = job["result"]["metrics"]
+    entry.update({
+        "wall_seconds": metrics["wall_seconds"],
+        "stage_seconds": {stage: values["seconds"] for stage, values in metrics["stages"].items() if values["count"]},
+        "reused_stages": len(job["result"]["reused_stages"]),
+        **{field: metrics["totals"][field] for field in ("llm_calls", "cache_hits", "prompt_tokens", "completion_tokens", "cost_usd", "dedup_tokens_saved")},
+    })
+    return entry
+
+
+def write_report(path, report):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(report, file, indent=2)
+    os.replace(tmp_path, path)
+
+    rows = ["| Workspace | Status | Wall (s) | Reused tasks | LLM calls | Cache hits | Tokens | Cost (USD) |",
+            "|---|---|---|---|---|---|---|---|"]
+    for entry in report["workspaces"]:
+        if entry["status"] == "done":
+            rows.append(f"| {entry['fileId']} | done | {entry['wall_seconds']:.1f} | {entry['reused_stages']} | {entry['llm_calls']} | "
+                        f"{entry['cache_hits']} | {entry['prompt_tokens'] + entry['completion_tokens']} | {entry['cost_usd']:.2f} |")
+        else:
+            rows.append(f"| {entry['fileId']} | {entry['status']} | | | | | | |")
+    totals = report["totals"]
+    summary = (f"{totals['done']} of {totals['workspaces']} workspaces done, {totals['errors']} failed, "
+               f"{totals['wall_seconds']:.0f}s, {totals['llm_calls']} LLM calls, about ${totals['cost_usd']:.2f}")
+    with open(os.path.splitext(path)[0] + ".md", "w") as file:
+        file.write(f"# Batch run {report['started']}\n\n{summary}\n\n" + "\n".join(rows) + "\n")
+
+
+def run_batch(workspaces, workers=BATCH_RUNNER_WORKERS, report_path=None, **options):
+    """Analyses `workspaces` with `workers` warm processes and returns the report.
+
+    `options` are passed to comparison.run_analysis (mode, refresh, batch,
+    compare_mode). The report lists per workspace its status, queue and run time,
+    time per stage, reused tasks, LLM calls, tokens and cost, plus totals; with
+    `report_path` it is written there (and as markdown) after every workspace.
+    """
+    from worker import JobQueue
+
+    started = time.time()
+    report = {"started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started)), "options": options,
+              "workers": workers, "llm_concurrency": int(os.environ.get("LLM_MAX_CONCURRENCY", 8)) * workers,
+              "workspaces": [], "totals": {}}
+    jobs = JobQueue(workers=workers)
+    try:
+        pending = {jobs.submit(fileId, **options): fileId for fileId in workspaces}
+        while pending:
+            time.sleep(BATCH_RUNNER_POLL_SECONDS)
+            jobs.check_workers()
+            for jobId in list(pending):
+                job = jobs.status(jobId)
+                if job["status"] not in ("done", "error"):
+                    continue
+                del pending[jobId]
+                entry = workspace_entry(job)
+                report["workspaces"].append(entry)
+                print(f"--batch {entry['fileId']} {entry['status']} after {entry['job_seconds'] or 0:.1f}s, "
+                      f"{len(report['workspaces'])}/{len(workspaces)} finished", file=sys.stderr)
+                done = [entry for entry in report["workspaces"] if entry["status"] == "done"]
+                report["totals"] = {
+                    "workspaces": len(workspaces), "done": len(done), "errors": len(report["workspaces"]) - len(done),
+                    "wall_seconds": round(time.time() - started, 3),
+                    **{field: round(sum(entry[field] for entry in done), 6)
+                       for field in ("llm_calls", "cache_hits", "prompt_tokens", "completion_tokens", "cost_usd", "dedup_tokens_saved")},
+                }
+                if report_path:
+                    write_report(report_path, report)
+    finally:
+        jobs.stop()
+    return report
+
+
+if __name__ == "__main__":
+    # the limits in .env are split between the workers too
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Analyse every RFQ workspace under a docs folder")
+    parser.add_argument('--include', type=str, nargs='+', default=["*"], help='Workspace name patterns to analyse')
+    parser.add_argument('--exclude', type=str, nargs='+', default=[], help='Workspace name patterns to skip')
+    parser.add_argument('--workers', type=int, default=BATCH_RUNNER_WORKERS, help='Workspaces analysed at once, one process each')
+    parser.add_argument('--llm-concurrency', type=int, default=None,
+                        help='OpenAI requests in flight across all workers')
+    parser.add_argument('--mode', type=str, choices=["mapreduce", "refine"], default=None)
+    parser.add_argument('--compare-mode', type=str, choices=["retrieval", "summary"], default=None)
+    parser.add_argument('--refresh', action='store_true', help='Recompute every stage instead of resuming from the checkpoints')
+    parser.add_argument('--batch', action='store_true', help='Send the requests through the Batch API (slower, half the price)')
+    parser.add_argument('--report', type=str, default=f"./markdown/batch-report-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    args = parser.parse_args()
+
+    workspaces = discover_workspaces(DOCS_DIR, args.include, args.exclude)
+    print(f"--batch {len(workspaces)} workspaces: {', '.join(workspaces)}", file=sys.stderr)
+    options = {name: value for name, value in (("mode", args.mode), ("compare_mode", args.compare_mode)) if value}
+    options.update(refresh=args.refresh, batch=args.batch)
+    share_llm_limits(args.workers, args.llm_concurrency or int(os.getenv("LLM_MAX_CONCURRENCY", 8)))
+    report = run_batch(workspaces, workers=args.workers, report_path=args.report, **options)
+    print(f"--batch report written to {args.report}", file=sys.stderr)
+    sys.exit(1 if report["totals"].get("errors") else 0)
@@ -0,0 +1,410 @@
+# Local stand-in for the OpenAI chat completions endpoint, so the pipeline can be
+# measured without spending tokens.
+#
+#   python -m benchmarks.fake_openai --port 8099 --latency 0.5 --tokens-per-second 80
+#   OPENAI_BASE_URL=http://127.0.0.1:8099/v1 OPENAI_KEY=fake python3 comparison.py --filename <fileId>
+#
+# Every request waits `latency` seconds plus the prompt prefill time, then answers with
+# `completion_tokens` words generated at `tokens_per_second` (streamed as SSE when the
+# client asks for it). `model_speeds` makes a model that many times faster in all three,
+# and every model words its answers differently. Calls and tokens are tallied per model
+# in `stats()`. With `requests_per_minute` / `tokens_per_minute` it enforces per-minute
+# budgets like the real API: x-ratelimit-* headers on every answer and 429 with
+# retry-after-ms once a budget is spent; `error_rate` answers that share of requests
+# with a 500. With `prompt_cache` the longest prompt prefix the same model saw before
+# (from 1024 tokens, in steps of 128) is reported in
+# usage.prompt_tokens_details.cached_tokens and skips the prefill.
+# Requests with a json_schema response_format get a JSON instance of the schema.
+#
+# The Batch API is served too (/v1/files upload and content, /v1/batches create,
+# retrieve and cancel): a batch completes `batch_seconds` after it is created, with
+# one output line per request, and `error_rate` of them in the error file.
+import json
+import time
+import zlib
+import hashlib
+import uuid
+import random
+import argparse
+import threading
+from email.parser import BytesParser
+from email.policy import default
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from chunking import get_encoding
+
+WORDS = ("provider scope delivery requirement pricing milestone security compliance support "
+         "timeline team experience risk governance approach").split()
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_INCREMENT = 128
+MODEL_SPEEDS = {"gpt-4o-mini": 2.0, "gpt-4.1-mini": 2.0, "gpt-4.1-nano": 3.0}  # relative to gpt-4o
+
+
+class FakeOpenAIServer:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.2, tokens_per_second=200.0,
+                 prompt_tokens_per_second=20000.0, completion_tokens=300, requests_per_minute=0,
+                 tokens_per_minute=0, error_rate=0.0, batch_seconds=2.0, prompt_cache=True, model_speeds=None):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.error_rate = error_rate
+        self.batch_seconds = batch_seconds
+        self.prompt_cache = prompt_cache
+        self.model_speeds = MODEL_SPEEDS if model_speeds is None else model_speeds
+        self.files = {}
+        self.batches = {}
+        self._lock = threading.Lock()
+        self.reset()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {"calls": 0, "streamed_calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+                           "max_in_flight": 0, "rate_limited": 0, "errors": 0, "batches": 0, "batch_requests": 0,
+                           "models": {}}
+            self._in_flight = 0
+            self._remaining = {}  # budget left per kind (requests, tokens)
+            self._refilled = time.time()
+            self._prefixes = set()  # digests of the prompt prefixes in the prompt cache
+
+    def stats(self):
+        with self._lock:
+            return json.loads(json.dumps(self._stats))
+
+    # Admits a request against per-minute budgets refilled continuously, as the API does;
+    # returns the rate-limit headers and, when a budget is spent, the seconds until it fits
+    def admit(self, tokens):
+        now = time.time()
+        with self._lock:
+            elapsed, self._refilled = now - self._refilled, now
+            budgets = [(kind, limit) for kind, limit in (("requests", self.requests_per_minute), ("tokens", self.tokens_per_minute)) if limit]
+            needed = {"requests": 1, "tokens": tokens}
+            retryAfter = None
+            for kind, limit in budgets:
+                self._remaining[kind] = min(limit, self._remaining.get(kind, limit) + elapsed * limit / 60)
+                amount = min(needed[kind], limit)
+                if self._remaining[kind] < amount:
+                    retryAfter = max(retryAfter or 0, (amount - self._remaining[kind]) * 60 / limit)
+            if retryAfter is None:
+                for kind, limit in budgets:
+                    self._remaining[kind] -= min(needed[kind], limit)
+            else:
+                self._stats["rate_limited"] += 1
+            headers = {}
+            for kind, limit in budgets:
+                headers.update({f"x-ratelimit-limit-{kind}": limit,
+                                f"x-ratelimit-remaining-{kind}": int(self._remaining[kind]),
+                                f"x-ratelimit-reset-{kind}": f"{(limit - self._remaining[kind]) * 60 / limit:.3f}s"})
+            return headers, retryAfter
+
+    # Prompt tokens and how many of them are served from the prompt cache
+    def prompt_usage(self, body):
+        prompt = "\n".join(str(message.get("content") or "") for message in body.get("messages", []))
+        tokens = get_encoding().encode(prompt, disallowed_special=())
+        if not self.prompt_cache:
+            return len(tokens), 0
+        # the cache is per model, as the API's is
+        digest, prefixes = hashlib.sha256(body.get("model", "").encode("utf-8")), []
+        for end in range(PROMPT_CACHE_INCREMENT, len(tokens) + 1, PROMPT_CACHE_INCREMENT):
+            digest.update("\0".join(map(str, tokens[end - PROMPT_CACHE_INCREMENT:end])).encode("utf-8") + b"\1")
+            if end >= PROMPT_CACHE_MIN_TOKENS:
+                prefixes.append((end, digest.hexdigest()))
+        with self._lock:
+            cached = max((end for end, key in prefixes if key in self._prefixes), default=0)
+            self._prefixes.update(key for _, key in prefixes)
+        return len(tokens), cached
+
+    def completion(self, body, prompt_tokens, cached_tokens=0):
+        completion_tokens = int(body.get("max_tokens") or self.completion_tokens)
+        completion_tokens = min(completion_tokens, self.completion_tokens)
+        offset = zlib.crc32(body.get("model", "").encode("utf-8"))
+        words = [WORDS[(prompt_tokens + offset + i) % len(WORDS)] for i in range(completion_tokens)]
+        with self._lock:
+            stats = self._stats
+            stats["calls"] += 1
+            stats["streamed_calls"] += 1 if body.get("stream") else 0
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            stats["cached_tokens"] += cached_tokens
+            model = stats["models"].setdefault(body.get("model", ""), {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+            model["calls"] += 1
+            model["prompt_tokens"] += prompt_tokens
+            model["completion_tokens"] += completion_tokens
+        return prompt_tokens, words
+
+    def speed(self, body):
+        return self.model_speeds.get(body.get("model", ""), 1.0)
+
+    def store_file(self, filename, data, purpose):
+        fileId = f"file-{uuid.uuid4().hex}"
+        meta = {"id": fileId, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+        with self._lock:
+            self.files[fileId] = (meta, data)
+        return meta
+
+    def create_batch(self, request):
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}", "object": "batch", "endpoint": request.get("endpoint"),
+            "input_file_id": request.get("input_file_id"), "completion_window": request.get("completion_window"),
+            "status": "validating", "errors": None, "output_file_id": None, "error_file_id": None,
+            "created_at": int(time.time()), "in_progress_at": None, "finalizing_at": None, "completed_at": None,
+            "failed_at": None, "expired_at": None, "expires_at": int(time.time()) + 86400, "cancelling_at": None,
+            "cancelled_at": None, "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": request.get("metadata"),
+        }
+        with self._lock:
+            self.batches[batch["id"]] = batch
+            self._stats["batches"] += 1
+        threading.Thread(target=self._process_batch, args=(batch["id"],), daemon=True).start()
+        return dict(batch)
+
+    def _process_batch(self, batchId):
+        with self._lock:
+            batch = self.batches[batchId]
+            lines = self.files[batch["input_file_id"]][1].decode("utf-8").splitlines()
+            batch.update(status="in_progress", in_progress_at=int(time.time()))
+        time.sleep(self.batch_seconds)
+        outputs, errors = [], []
+        for line in filter(str.strip, lines):
+            request = json.loads(line)
+            body = request["body"]
+            if random.random() < self.error_rate:
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"],
+                               "response": {"status_code": 500, "body": {"error": {"message": "The server had an error"}}},
+                               "error": None})
+                continue
+            prompt_tokens, cached_tokens = self.prompt_usage(body)
+            prompt_tokens, words = self.completion(body, prompt_tokens, cached_tokens)
+            outputs.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "error": None,
+                            "response": {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                         "body": completion_body(body, prompt_tokens, words, cached_tokens)}})
+        with self._lock:
+            self._stats["batch_requests"] += len(outputs) + len(errors)
+            if batch["status"] in ("cancelling", "cancelled"):
+                batch.update(status="cancelled", cancelled_at=int(time.time()))
+                return
+        outputFile = self.store_file("output.jsonl", "\n".join(map(json.dumps, outputs)).encode("utf-8"), "batch_output")
+        errorFile = self.store_file("errors.jsonl", "\n".join(map(json.dumps, errors)).encode("utf-8"), "batch_output") if errors else None
+        with self._lock:
+            batch.update(status="completed", completed_at=int(time.time()), output_file_id=outputFile["id"],
+                         error_file_id=errorFile["id"] if errorFile else None,
+                         request_counts={"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)})
+
+    def _track(self, delta):
+        with self._lock:
+            self._in_flight += delta
+            self._stats["max_in_flight"] = max(self._stats["max_in_flight"], self._in_flight)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            limitHeaders = {}
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_limit_headers(self):
+                for name, value in self.limitHeaders.items():
+                    self.send_header(name, str(value))
+
+            def not_found(self):
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+            def do_GET(self):
+                parts = self.path.split("?")[0].strip("/").split("/")
+                if parts[1:2] == ["files"] and len(parts) >= 3 and parts[2] in server.files:
+                    meta, data = server.files[parts[2]]
+                    if parts[3:] == ["content"]:
+                        self.send_response(200)
+                        self.send_header("Content-Type", "application/octet-stream")
+                        self.send_header("Content-Length", str(len(data)))
+                        self.end_headers()
+                        self.wfile.write(data)
+                    else:
+                        self.send_json(200, meta)
+                elif parts[1:2] == ["batches"] and len(parts) == 3 and parts[2] in server.batches:
+                    with server._lock:
+                        batch = dict(server.batches[parts[2]])
+                    self.send_json(200, batch)
+                else:
+                    self.not_found()
+
+            def do_POST(self):
+                parts = self.path.split("?")[0].strip("/").split("/")
+                data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if parts[1:] == ["files"]:
+                    fields = multipart_fields(self.headers.get("Content-Type", ""), data)
+                    filename, content = fields["file"]
+                    self.send_json(200, server.store_file(filename, content, fields["purpose"][1].decode("utf-8")))
+                    return
+                if parts[1:] == ["batches"]:
+                    self.send_json(200, server.create_batch(json.loads(data)))
+                    return
+                if parts[1:2] == ["batches"] and parts[3:] == ["cancel"] and parts[2] in server.batches:
+                    with server._lock:
+                        server.batches[parts[2]].update(status="cancelling", cancelling_at=int(time.time()))
+                        batch = dict(server.batches[parts[2]])
+                    self.send_json(200, batch)
+                    return
+                if parts[1:] != ["chat", "completions"]:
+                    self.not_found()
+                    return
+                body = json.loads(data or b"{}")
+                prompt_tokens, cached_tokens = server.prompt_usage(body)
+                self.limitHeaders, retryAfter = server.admit(prompt_tokens + server.completion_tokens)
+                if retryAfter is not None:
+                    self.limitHeaders["retry-after-ms"] = int(retryAfter * 1000) + 1
+                    self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}})
+                    return
+                if random.random() < server.error_rate:
+                    with server._lock:
+                        server._stats["errors"] += 1
+                    self.send_json(500, {"error": {"message": "The server had an error", "type": "server_error"}})
+                    return
+                server._track(1)
+                try:
+                    prompt_tokens, words = server.completion(body, prompt_tokens, cached_tokens)
+                    speed = server.speed(body)
+                    time.sleep((server.latency + (prompt_tokens - cached_tokens) / server.prompt_tokens_per_second) / speed)
+                    if body.get("stream"):
+                        self.stream(body, prompt_tokens, words, cached_tokens)
+                    else:
+                        time.sleep(len(words) / server.tokens_per_second / speed)
+                        self.send_json(200, completion_body(body, prompt_tokens, words, cached_tokens))
+                finally:
+                    server._track(-1)
+
+            def send_json(self, status, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_limit_headers()
+                self.end_headers()
+                self.wfile.write(data)
+
+            def stream(self, body, prompt_tokens, words, cached_tokens=0):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.send_limit_headers()
+                self.end_headers()
+                chunkId, created = f"chatcmpl-{uuid.uuid4().hex}", int(time.time())
+
+                def event(choices, **extra):
+                    payload = {"id": chunkId, "object": "chat.completion.chunk", "created": created,
+                               "model": body.get("model"), "choices": choices, **extra}
+                    self.write_chunk(f"data: {json.dumps(payload)}\n\n")
+
+                event([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+                speed = server.speed(body)
+                for i, word in enumerate(answer(body, words).split(" ")):
+                    time.sleep(1 / server.tokens_per_second / speed)
+                    event([{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}])
+                event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    event([], usage=usage(prompt_tokens, len(words), cached_tokens))
+                self.write_chunk("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def write_chunk(self, text):
+                data = text.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def completion_body(body, prompt_tokens, words, cached_tokens=0):
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion",
+        "created": int(time.time()), "model": body.get("model"),
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": answer(body, words)}}],
+        "usage": usage(prompt_tokens, len(words), cached_tokens),
+    }
+
+
+def answer(body, words):
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return json.dumps(schema_instance(response_format["json_schema"]["schema"], iter(words * 2 or WORDS)))
+    return " ".join(words)
+
+
+# Value matching a JSON schema (objects, arrays, enums, strings, numbers), filled from `words`
+def schema_instance(schema, words):
+    if "enum" in schema:
+        return schema["enum"][len(next(words, "")) % len(schema["enum"])]
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: schema_instance(value, words) for name, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [schema_instance(schema.get("items", {}), words) for _ in range(2)]
+    if kind in ("integer", "number"):
+        return len(next(words, ""))
+    if kind == "boolean":
+        return True
+    return " ".join(next(words, "") for _ in range(8)).strip()
+
+
+# {field name: (filename, bytes)} of a multipart/form-data upload
+def multipart_fields(contentType, data):
+    message = BytesParser(policy=default).parsebytes(f"Content-Type: {contentType}\r\n\r\n".encode("utf-8") + data)
+    return {part.get_param("name", header="content-disposition"): (part.get_filename(), part.get_payload(decode=True))
+            for part in message.iter_parts()}
+
+
+def usage(prompt_tokens, completion_tokens, cached_tokens=0):
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI chat completions endpoint")
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=200.0, help='Completion tokens generated per second')
+    parser.add_argument('--prompt-tokens-per-second', type=float, default=20000.0, help='Prompt tokens processed per second before the first token')
+    parser.add_argument('--completion-tokens', type=int, default=300, help='Tokens in every answer')
+    parser.add_argument('--rpm', type=int, default=0, help='Requests per minute before answering 429 (0: unlimited)')
+    parser.add_argument('--tpm', type=int, default=0, help='Tokens per minute before answering 429 (0: unlimited)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with a 500')
+    parser.add_argument('--batch-seconds', type=float, default=2.0, help='Time for a batch to complete')
+    parser.add_argument('--no-prompt-cache', action='store_true', help='Never serve prompt prefixes from the prompt cache')
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(port=args.port, latency=args.latency, tokens_per_second=args.tokens_per_second,
+                              prompt_tokens_per_second=args.prompt_tokens_per_second,
+                              completion_tokens=args.completion_tokens, requests_per_minute=args.rpm,
+                              tokens_per_minute=args.tpm, error_rate=args.error_rate,
+                              batch_seconds=args.batch_seconds, prompt_cache=not args.no_prompt_cache).start()
+    print(f"fake OpenAI endpoint on {server.base_url}")
+    try:
+        while True:
+            time.sleep(60)
+            print(server.stats())
+    except KeyboardInterrupt:
+        server.stop()
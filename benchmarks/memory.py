@@ -0,0 +1,106 @@
+# Peak memory of the document stages of run_analysis, streamed against fully materialized.
+#
+#   python -m benchmarks.memory
+#   python -m benchmarks.memory --sizes 16 64 256 --file-mb 4 --compare-mode summary
+#
+# Writes synthetic TXT submissions of increasing total size (more files of the same
+# size, as a large vendor response comes in many attachments, with a `--boilerplate`
+# share of repeated company profile) and measures the tracemalloc peak of:
+#   analysis      the stages run_analysis runs on a provider before any LLM call:
+#                 comparison.streamDocuments (parsing, document cache and, in retrieval
+#                 mode, the passage index) -> iter_chunks with the near-duplicate filter,
+#                 as processingFiles drives them -> consumer
+#   materialized  the list pipeline, load_documents + chunk_documents
+# Parsing runs in-process and the caches start empty, so every Python allocation is
+# counted; SQLite's own page cache (the passage index) is bounded and not traced. The
+# analysis peak should stay flat as the submission grows, bounded by the few files
+# parsed ahead of the chunker and the dedup window, while the list pipeline grows with it.
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from benchmarks.pipeline import paragraph
+
+PROFILE_PARAGRAPHS = 6
+
+
+def generate_submission(directory, size_mb, file_mb, boilerplate=0.2):
+    per_file = file_mb * 1024 * 1024
+    profile = [paragraph(-1000 - i) for i in range(PROFILE_PARAGRAPHS)]
+    every = round(1 / boilerplate) if boilerplate else 0
+    seed = 0
+    for index in range(max(1, size_mb // file_mb)):
+        with open(os.path.join(directory, f"part{index:04d}.txt"), "w") as file:
+            written = 0
+            while written < per_file:
+                # every copy of a profile paragraph differs in its last words, like an updated date or name
+                if every and seed % every == 0:
+                    text = f"{profile[seed % PROFILE_PARAGRAPHS]} revision {seed}\n\n"
+                else:
+                    text = paragraph(seed) + "\n\n"
+                file.write(text)
+                written += len(text)
+                seed += 1
+
+
+def analysis(comparison, directory, compare_mode):
+    from loaders import list_files
+    from chunking import iter_chunks
+    from dedup import NearDuplicateFilter
+    run = comparison.AnalysisRun("memory-bench", refresh=True, compareMode=compare_mode)
+    report = {}
+    docs = comparison.streamDocuments(run, list_files(directory), "provider")
+    for chunk in iter_chunks(docs, comparison.MAX_TOKENS, model=comparison.LLM_MODEL, report=report, dedup=NearDuplicateFilter()):
+        pass
+    index = run.indexes.get("provider")
+    return f"{report['chunks']} chunks, {report['duplicates']} duplicates dropped, {len(index) if index else 0} passages indexed"
+
+
+def materialized(comparison, directory, compare_mode):
+    from loaders import load_documents
+    from chunking import chunk_documents
+    chunks, _ = chunk_documents(load_documents(directory, workers=1), comparison.MAX_TOKENS)
+    return f"{len(chunks)} chunks"
+
+
+def measure(pipeline, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    detail = pipeline(*args)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 / 1024, seconds, detail
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure peak memory of the streamed analysis stages and the list pipeline")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[8, 32, 128], help='Submission sizes in MB')
+    parser.add_argument('--file-mb', type=int, default=2, help='Size of each file in MB')
+    parser.add_argument('--boilerplate', type=float, default=0.2, help='Share of paragraphs repeating the company profile')
+    parser.add_argument('--compare-mode', type=str, choices=["retrieval", "summary"], default="retrieval")
+    args = parser.parse_args()
+
+    cacheDir = tempfile.mkdtemp(prefix="memory_bench_cache_")
+    # must be set before comparison creates its caches; parsing stays in this process to be traced
+    os.environ.update(OPENAI_KEY=os.getenv("OPENAI_KEY", "unused"), PARSE_WORKERS="1",
+                      DOC_CACHE_DIR=os.path.join(cacheDir, "docs"), RETRIEVAL_INDEX_DIR=os.path.join(cacheDir, "index"),
+                      LLM_CACHE_DIR=os.path.join(cacheDir, "llm"), RESULTS_DB=os.path.join(cacheDir, "results.sqlite3"))
+    import comparison
+    from chunking import get_encoding
+
+    get_encoding()  # keep the tokenizer load out of the first measurement
+    try:
+        for size_mb in args.sizes:
+            folder = tempfile.mkdtemp(prefix="memory_bench_")
+            try:
+                generate_submission(folder, size_mb, args.file_mb, args.boilerplate)
+                for name, pipeline in (("analysis", analysis), ("materialized", materialized)):
+                    peak, seconds, detail = measure(pipeline, comparison, folder, args.compare_mode)
+                    print(f"{size_mb:>5} MB  {name:<12} peak {peak:8.1f} MB  {seconds:7.2f}s  ({detail})")
+            finally:
+                shutil.rmtree(folder)
+    finally:
+        shutil.rmtree(cacheDir, ignore_errors=True)
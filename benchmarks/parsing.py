@@ -0,0 +1,86 @@
+# Document parsing throughput against the number of parse processes.
+#
+#   python -m benchmarks.parsing --folder ./docs/<fileId>
+#   python -m benchmarks.parsing --generate 24 --pdf sample1.pdf --pdf sample2.pdf
+#
+# --generate writes synthetic TXT, DOCX and XLSX files and copies the given PDFs
+# (scanned ones exercise OCR) into a temporary corpus. The parsed-document cache is
+# not used, so every run partitions the whole folder.
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from loaders import list_files, load_documents, pdf_page_ranges
+
+WORDS = ("migration report validation security controls architecture delivery pricing "
+         "milestone support maintenance training knowledge transfer governance risk").split()
+
+
+def paragraph(seed, words=120):
+    return " ".join(WORDS[(seed * 7 + i * 3) % len(WORDS)] for i in range(words))
+
+
+def generate_corpus(directory, count, pdfs):
+    from docx import Document as DocxDocument
+    from openpyxl import Workbook
+
+    for index in range(count):
+        kind = index % 4
+        if kind == 0:
+            with open(os.path.join(directory, f"doc{index}.txt"), "w") as file:
+                file.write("\n\n".join(paragraph(index + i) for i in range(40)))
+        elif kind == 1:
+            document = DocxDocument()
+            for i in range(40):
+                document.add_paragraph(paragraph(index + i))
+            document.save(os.path.join(directory, f"doc{index}.docx"))
+        elif kind == 2:
+            workbook = Workbook()
+            sheet = workbook.active
+            for row in range(200):
+                sheet.append([f"item {row}", WORDS[row % len(WORDS)], row * 10.5, paragraph(row, 12)])
+            workbook.save(os.path.join(directory, f"doc{index}.xlsx"))
+        elif pdfs:
+            shutil.copy(pdfs[index % len(pdfs)], os.path.join(directory, f"doc{index}.pdf"))
+
+
+def worker_counts(maximum):
+    counts = [1]
+    while counts[-1] * 2 <= maximum:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != maximum:
+        counts.append(maximum)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure parsing throughput per process count")
+    parser.add_argument('--folder', type=str, help='Folder of mixed PDF, DOCX, TXT and XLSX files')
+    parser.add_argument('--generate', type=int, default=0, help='Number of synthetic files to generate instead')
+    parser.add_argument('--pdf', action='append', default=[], help='PDF copied into the generated corpus (repeatable)')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    folder = args.folder
+    if folder is None:
+        folder = tempfile.mkdtemp(prefix="parse_bench_")
+        generate_corpus(folder, args.generate or 24, args.pdf)
+
+    paths = list_files(folder)
+    tasks = sum(len(pdf_page_ranges(path)) for path in paths)
+    size_mb = sum(os.path.getsize(path) for path in paths) / 1024 / 1024
+    print(f"corpus: {len(paths)} files, {tasks} parse tasks, {size_mb:.1f} MB")
+
+    baseline = None
+    for workers in worker_counts(args.max_workers):
+        load_documents(folder, workers=workers)  # warm up the pool
+        start = time.perf_counter()
+        docs = load_documents(folder, workers=workers)
+        seconds = time.perf_counter() - start
+        baseline = baseline or seconds
+        print(f"workers={workers:<3} {seconds:7.2f}s  {len(paths) / seconds:7.2f} files/s  "
+              f"{size_mb / seconds:6.2f} MB/s  speedup x{baseline / seconds:.2f}  ({len(docs)} documents)")
+
+    if args.folder is None:
+        shutil.rmtree(folder)
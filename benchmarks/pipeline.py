@@ -0,0 +1,164 @@
+# End-to-end run of comparison.run_analysis against the local fake OpenAI endpoint.
+#
+#   python -m benchmarks.pipeline
+#   python -m benchmarks.pipeline --pages 10 50 200 --providers 3 --latency 0.5 --json bench.json
+#
+# For every corpus size a workspace with a customer RFQ and `--providers` proposals of
+# `pages` pages each is generated under ./docs/, analysed with fresh caches, and
+# removed again. A `--boilerplate` share of every proposal repeats its company profile
+# with small edits, as real submissions do, which the near-duplicate filter drops.
+# Reports the wall time, the latency of every stage, the LLM calls and the tokens
+# sent and received, so regressions show up without spending real tokens.
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import random
+import tempfile
+from collections import defaultdict
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.parsing import WORDS
+
+PAGE_PARAGRAPHS = 4  # ~500 words per page
+PROFILE_PARAGRAPHS = 6  # company profile repeated in the boilerplate share of a proposal
+
+
+# A distinct paragraph per seed; benchmarks.parsing.paragraph repeats after 16 seeds
+def paragraph(seed, words=120):
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def generate_workspace(docsDir, pages, providers, boilerplate=0.0):
+    os.makedirs(docsDir)
+    count = pages * PAGE_PARAGRAPHS
+    with open(os.path.join(docsDir, "rfq_customer.txt"), "w") as file:
+        file.write("\n\n".join(paragraph(i) for i in range(count)))
+    for n in range(1, providers + 1):
+        providerDir = os.path.join(docsDir, f"provider{n}")
+        os.makedirs(providerDir)
+        profile = [paragraph(-n * 1000 - i) for i in range(PROFILE_PARAGRAPHS)]
+        repeated = int(count * boilerplate)
+        body = [paragraph(n * 1_000_000 + i) for i in range(count - repeated)]
+        # every copy of a profile paragraph differs in its last words, like an updated date or name
+        copies = [f"{profile[i % PROFILE_PARAGRAPHS]} revision {i}" for i in range(repeated)]
+        step = max(1, len(body) // max(1, repeated))
+        paragraphs = []
+        for i, text in enumerate(body):
+            paragraphs.append(text)
+            if i % step == 0 and copies:
+                paragraphs.append(copies.pop())
+        with open(os.path.join(providerDir, "proposal.txt"), "w") as file:
+            file.write("\n\n".join(paragraphs + copies))
+
+
+# Seconds between the started and done events of every (stage, target)
+def stage_latencies(events):
+    started, latencies = {}, defaultdict(list)
+    for event in events:
+        key = (event["stage"], event["target"])
+        if event["status"] == "started":
+            started[key] = event["time"]
+        elif event["status"] == "done" and key in started:
+            latencies[event["stage"]].append(event["time"] - started.pop(key))
+    return {stage: {"count": len(values), "total": round(sum(values), 3), "max": round(max(values), 3)}
+            for stage, values in latencies.items()}
+
+
+def run(comparison, server, pages, providers, mode, stream, batch=False, compare_mode="retrieval", boilerplate=0.0):
+    fileId = f"bench-{pages}p-{uuid.uuid4().hex[:8]}"
+    docsDir = f"./docs/{fileId}"
+    generate_workspace(docsDir, pages, providers, boilerplate)
+    events = []
+    server.reset()
+    try:
+        start = time.perf_counter()
+        analysis = comparison.run_analysis(fileId, mode=mode, refresh=True, onEvent=events.append, stream=stream, batch=batch,
+                                         compare_mode=compare_mode)
+        seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(docsDir, ignore_errors=True)
+        shutil.rmtree(f"./markdown/{fileId}", ignore_errors=True)
+    llm = server.stats()
+    stages = analysis["metrics"]["stages"]
+    return {
+        "pages": pages, "providers": providers, "boilerplate": boilerplate, "mode": mode, "stream": stream, "batch": batch, "compare_mode": compare_mode,
+        "wall_seconds": round(seconds, 3),
+        "stages": stage_latencies(events),
+        "llm_calls": llm["calls"],
+        "prompt_tokens": llm["prompt_tokens"],
+        "compare_prompt_tokens": sum(stages.get(stage, {}).get("prompt_tokens", 0) for stage in ("compare", "compare_criterion")),
+        "completion_tokens": llm["completion_tokens"],
+        "cached_tokens": llm["cached_tokens"],
+        "dedup_tokens_saved": analysis["metrics"]["totals"]["dedup_tokens_saved"],
+        "max_in_flight": llm["max_in_flight"],
+        "rate_limited": llm["rate_limited"],
+        "server_errors": llm["errors"],
+        "batches": llm["batches"],
+        "retries": analysis["metrics"]["totals"]["retries"],
+        "cost_usd": analysis["metrics"]["totals"]["cost_usd"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the full pipeline against a fake OpenAI endpoint")
+    parser.add_argument('--pages', type=int, nargs='+', default=[10, 50, 200], help='Pages per document, one run each')
+    parser.add_argument('--providers', type=int, default=3)
+    parser.add_argument('--boilerplate', type=float, default=0.2, help='Share of every proposal repeating its company profile')
+    parser.add_argument('--mode', type=str, choices=["mapreduce", "refine"], default="mapreduce")
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=200.0)
+    parser.add_argument('--prompt-tokens-per-second', type=float, default=20000.0)
+    parser.add_argument('--completion-tokens', type=int, default=300)
+    parser.add_argument('--rpm', type=int, default=0, help='Requests per minute enforced by the fake endpoint')
+    parser.add_argument('--tpm', type=int, default=0, help='Tokens per minute enforced by the fake endpoint')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with a 500')
+    parser.add_argument('--batch', action='store_true', help='Run the stages through the Batch API')
+    parser.add_argument('--batch-seconds', type=float, default=2.0, help='Time for a batch to complete')
+    parser.add_argument('--no-prompt-cache', action='store_true', help='Never serve prompt prefixes from the prompt cache')
+    parser.add_argument('--compare-mode', type=str, choices=["retrieval", "summary"], default="retrieval")
+    parser.add_argument('--json', type=str, help='Also write the results to this file')
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                              prompt_tokens_per_second=args.prompt_tokens_per_second,
+                              completion_tokens=args.completion_tokens, requests_per_minute=args.rpm,
+                              tokens_per_minute=args.tpm, error_rate=args.error_rate,
+                              batch_seconds=args.batch_seconds, prompt_cache=not args.no_prompt_cache).start()
+    cacheDir = tempfile.mkdtemp(prefix="pipeline_bench_")
+    # must be set before comparison creates its client and caches
+    os.environ.update(OPENAI_BASE_URL=server.base_url, OPENAI_KEY="fake",
+                      LLM_CACHE_DIR=os.path.join(cacheDir, "llm"), DOC_CACHE_DIR=os.path.join(cacheDir, "docs"),
+                      RETRIEVAL_INDEX_DIR=os.path.join(cacheDir, "index"), RESULTS_DB=os.path.join(cacheDir, "results.sqlite3"))
+    os.environ.setdefault("BATCH_COLLECT_SECONDS", "0.5")
+    os.environ.setdefault("BATCH_POLL_SECONDS", "0.5")
+    import comparison
+
+    results = []
+    try:
+        for pages in args.pages:
+            result = run(comparison, server, pages, args.providers, args.mode, args.stream, args.batch, args.compare_mode,
+                         args.boilerplate)
+            results.append(result)
+            print(f"\npages={pages} providers={args.providers} mode={args.mode} compare={args.compare_mode}: {result['wall_seconds']:.2f}s, "
+                  f"{result['llm_calls']} LLM calls, {result['prompt_tokens']} prompt tokens ({result['compare_prompt_tokens']} comparing, "
+                  f"{result['cached_tokens'] / max(result['prompt_tokens'], 1):.0%} from the prompt cache, "
+                  f"{result['dedup_tokens_saved']} saved by dropping duplicates), "
+                  f"{result['completion_tokens']} completion tokens, {result['max_in_flight']} max in flight, "
+                  f"{result['batches']} batches, {result['rate_limited']} x 429, {result['server_errors']} x 500, {result['retries']} retries, "
+                  f"${result['cost_usd']:.2f} at list prices",
+                  file=sys.stderr)
+            for stage, latency in result["stages"].items():
+                print(f"  {stage:<10} x{latency['count']:<3} total {latency['total']:8.2f}s  max {latency['max']:7.2f}s",
+                      file=sys.stderr)
+    finally:
+        server.stop()
+        shutil.rmtree(cacheDir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,183 @@
+# Latency and cost of model routings, against the local fake OpenAI endpoint.
+#
+#   python -m benchmarks.routing
+#   python -m benchmarks.routing --route summarize=gpt-4o-mini --route summarize=gpt-4o-mini,compare=gpt-4.1-mini
+#   python -m benchmarks.routing --workspace <fileId> --model-speed gpt-4o-mini=2.5 --json routing.json
+#
+# A fixed RFQ corpus (generated from fixed seeds, or a copy of ./docs/<fileId>) is
+# analysed once with every stage on LLM_MODEL, the baseline, and once per `--route`
+# with fresh caches. Each routing is reported with its wall time, stage latencies,
+# tokens per model and estimated cost; the smaller models answer faster (`--model-speed`).
+# Unified diffs against the baseline's markdown outputs are written to `--diff-dir` to
+# show which outputs a routing touches, their word-level similarity goes to `--json`.
+# The fake endpoint's answers and ratings say nothing about quality (they derive from
+# token counts and the model name), so no routing is recommended here: judge the
+# quality of the cheaper routes by rerunning them against the real API on real documents.
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import difflib
+import argparse
+import tempfile
+from collections import defaultdict
+from benchmarks.fake_openai import FakeOpenAIServer, MODEL_SPEEDS
+from benchmarks.pipeline import generate_workspace, stage_latencies
+
+# the stages of comparison.STAGE_MODELS, which is only imported once the environment is set
+STAGES = ("summarize", "compare", "rank")
+DEFAULT_ROUTES = [
+    "summarize=gpt-4o-mini",
+    "summarize=gpt-4o-mini,compare=gpt-4o-mini",
+    "summarize=gpt-4o-mini,compare=gpt-4o-mini,rank=gpt-4o-mini",
+]
+
+
+# "summarize=gpt-4o-mini,compare=gpt-4o" -> {"summarize": "gpt-4o-mini", "compare": "gpt-4o"}
+def parse_route(route):
+    models = {}
+    for part in filter(None, route.split(",")):
+        stage, _, model = part.partition("=")
+        if not model:
+            raise argparse.ArgumentTypeError(f"expected stage=model, got {part!r}")
+        if stage.strip() not in STAGES:
+            raise argparse.ArgumentTypeError(f"unknown stage {stage.strip()!r} in {route!r}, expected one of {', '.join(STAGES)}")
+        models[stage.strip()] = model.strip()
+    return models
+
+
+# --route value: the route as given and its {stage: model}
+def route_argument(route):
+    return route, parse_route(route)
+
+
+def read_outputs(outputDir):
+    outputs = {}
+    for name in sorted(os.listdir(outputDir)):
+        if name.endswith(".md"):
+            with open(os.path.join(outputDir, name)) as file:
+                outputs[name] = file.read()
+    return outputs
+
+
+def similarity(baseline, other):
+    return round(difflib.SequenceMatcher(None, baseline.split(), other.split(), autojunk=False).ratio(), 3)
+
+
+def run(comparison, server, corpus, label, models, mode, compare_mode):
+    fileId = f"routing-{uuid.uuid4().hex[:8]}"
+    shutil.copytree(corpus, f"./docs/{fileId}")
+    events = []
+    server.reset()
+    try:
+        start = time.perf_counter()
+        analysis = comparison.run_analysis(fileId, mode=mode, refresh=True, onEvent=events.append, compare_mode=compare_mode,
+                                         models=models)
+        seconds = time.perf_counter() - start
+        outputs = read_outputs(f"./markdown/{fileId}")
+    finally:
+        shutil.rmtree(f"./docs/{fileId}", ignore_errors=True)
+        shutil.rmtree(f"./markdown/{fileId}", ignore_errors=True)
+    metrics = analysis["metrics"]
+    tokens = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+    for call in metrics["calls"]:
+        entry = tokens[call["model"]]
+        entry["calls"] += 1
+        entry["prompt_tokens"] += call["prompt_tokens"]
+        entry["completion_tokens"] += call["completion_tokens"]
+        entry["cost_usd"] = round(entry["cost_usd"] + call["cost_usd"], 6)
+    return {
+        "route": label, "models": analysis["models"],
+        "wall_seconds": round(seconds, 3),
+        "stages": stage_latencies(events),
+        "llm_calls": metrics["totals"]["llm_calls"],
+        "prompt_tokens": metrics["totals"]["prompt_tokens"],
+        "completion_tokens": metrics["totals"]["completion_tokens"],
+        "cost_usd": metrics["totals"]["cost_usd"],
+        "per_model": dict(tokens),
+    }, outputs
+
+
+# Similarity of every output to the baseline's, with the unified diffs written to diffPath
+def compare_outputs(baseline, outputs, diffPath):
+    scores, diffs = {}, []
+    for name in sorted(set(baseline) | set(outputs)):
+        before, after = baseline.get(name, ""), outputs.get(name, "")
+        scores[name] = similarity(before, after)
+        diffs.extend(difflib.unified_diff(before.splitlines(), after.splitlines(), f"baseline/{name}", f"route/{name}", lineterm=""))
+    with open(diffPath, "w") as file:
+        file.write("\n".join(diffs) + "\n")
+    return scores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare model routings per stage against a fake OpenAI endpoint")
+    parser.add_argument('--route', type=route_argument, action='append', help='stage=model pairs separated by commas, stages: summarize, compare, rank; '
+                                                                     'repeat for several routings (default: moving each stage to gpt-4o-mini in turn)')
+    parser.add_argument('--workspace', type=str, help='Analyse a copy of ./docs/<fileId> instead of the generated corpus')
+    parser.add_argument('--pages', type=int, default=20, help='Pages per document of the generated corpus')
+    parser.add_argument('--providers', type=int, default=3)
+    parser.add_argument('--mode', type=str, choices=["mapreduce", "refine"], default="mapreduce")
+    parser.add_argument('--compare-mode', type=str, choices=["retrieval", "summary"], default="retrieval")
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=80.0, help='Completion tokens per second of the baseline model')
+    parser.add_argument('--prompt-tokens-per-second', type=float, default=20000.0)
+    parser.add_argument('--completion-tokens', type=int, default=300)
+    parser.add_argument('--model-speed', type=str, action='append', default=[],
+                        help='model=factor, how many times faster than the baseline model a model answers')
+    parser.add_argument('--diff-dir', type=str, default=f"./markdown/routing-{time.strftime('%Y%m%d-%H%M%S')}")
+    parser.add_argument('--json', type=str, help='Also write the results to this file')
+    args = parser.parse_args()
+
+    speeds = dict(MODEL_SPEEDS)
+    for value in args.model_speed:
+        model, _, factor = value.partition("=")
+        speeds[model] = float(factor)
+    routes = args.route or [route_argument(route) for route in DEFAULT_ROUTES]
+
+    server = FakeOpenAIServer(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                              prompt_tokens_per_second=args.prompt_tokens_per_second,
+                              completion_tokens=args.completion_tokens, model_speeds=speeds).start()
+    cacheDir = tempfile.mkdtemp(prefix="routing_bench_")
+    # must be set before comparison creates its client and caches
+    os.environ.update(OPENAI_BASE_URL=server.base_url, OPENAI_KEY="fake",
+                      LLM_CACHE_DIR=os.path.join(cacheDir, "llm"), DOC_CACHE_DIR=os.path.join(cacheDir, "docs"),
+                      RETRIEVAL_INDEX_DIR=os.path.join(cacheDir, "index"), RESULTS_DB=os.path.join(cacheDir, "results.sqlite3"))
+    import comparison
+
+    corpus = os.path.join(cacheDir, "corpus")
+    if args.workspace:
+        shutil.copytree(f"./docs/{args.workspace}", corpus)
+    else:
+        generate_workspace(corpus, args.pages, args.providers, boilerplate=0.2)
+    os.makedirs(args.diff_dir, exist_ok=True)
+
+    results = []
+    try:
+        baselineModels = {stage: comparison.LLM_MODEL for stage in comparison.STAGE_MODELS}
+        baseline, baselineOutputs = run(comparison, server, corpus, "baseline", baselineModels, args.mode, args.compare_mode)
+        baseline["similarity"] = {name: 1.0 for name in baselineOutputs}
+        results.append(baseline)
+        for label, models in routes:
+            result, outputs = run(comparison, server, corpus, label, {**baselineModels, **models}, args.mode, args.compare_mode)
+            diffPath = os.path.join(args.diff_dir, f"{label.replace('=', '-').replace(',', '_')}.diff")
+            result["similarity"] = compare_outputs(baselineOutputs, outputs, diffPath)
+            result["diff"] = diffPath
+            results.append(result)
+    finally:
+        server.stop()
+        shutil.rmtree(cacheDir, ignore_errors=True)
+
+    print(f"\n{'route':<62} {'wall s':>7} {'summarize s':>11} {'compare s':>9} {'rank s':>7} {'cost':>7}", file=sys.stderr)
+    for result in results:
+        stages = {stage: result["stages"].get(stage, {}).get("total", 0.0) for stage in STAGES}
+        print(f"{result['route']:<62} {result['wall_seconds']:7.2f} {stages['summarize']:11.2f} {stages['compare']:9.2f} "
+              f"{stages['rank']:7.2f} {result['cost_usd']:7.3f}", file=sys.stderr)
+    print(f"diffs of the outputs in {args.diff_dir}; the fake endpoint's answers say nothing about quality, "
+          f"compare the routes against the real API before switching", file=sys.stderr)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,38 @@
+# Per-job startup cost: a fresh `python3 comparison.py` process (previous app.py
+# behaviour) against dispatching a job to the warm worker.
+#
+#   python -m benchmarks.startup --runs 5
+import sys
+import time
+import argparse
+import subprocess
+from statistics import median
+from worker import JobQueue
+
+
+def cold_start_seconds():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import comparison"], check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def warm_start_seconds(jobs):
+    jobId = jobs.submit(None, kind="ping")
+    jobs.wait(jobId)
+    return jobs.status(jobId)["startup_seconds"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure per-job pipeline startup time")
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    cold = [cold_start_seconds() for _ in range(args.runs)]
+    jobs = JobQueue(workers=1)
+    warm_start_seconds(jobs)
+    warm = [warm_start_seconds(jobs) for _ in range(args.runs)]
+    jobs.stop()
+
+    print(f"cold start per job (new process + imports): median {median(cold):.3f}s, max {max(cold):.3f}s")
+    print(f"warm worker one-off import cost: {jobs.import_seconds[0]:.3f}s")
+    print(f"warm start per job (queue dispatch):        median {median(warm) * 1000:.1f}ms, max {max(warm) * 1000:.1f}ms")
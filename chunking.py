@@ -0,0 +1,116 @@
+import re
+import os
+from functools import lru_cache
+import tiktoken
+
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", 8000))
+PARAGRAPH_SEPARATOR = "\n\n"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model="gpt-4o"):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text, model="gpt-4o"):
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+
+
+# Yields paragraphs one at a time instead of building the split list
+def split_paragraphs(text):
+    start = 0
+    for match in PARAGRAPH_BREAK.finditer(text):
+        paragraph = text[start:match.start()].strip()
+        if paragraph:
+            yield paragraph
+        start = match.end()
+    paragraph = text[start:].strip()
+    if paragraph:
+        yield paragraph
+
+
+# Breaks a paragraph that is over budget on line boundaries, falling back to
+# fixed token windows for single lines that are still too long
+def split_oversized(text, max_tokens, encoding):
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return [(text, len(tokens))]
+    lines = [line for line in text.split("\n") if line.strip()]
+    if len(lines) > 1:
+        pieces = []
+        for line in lines:
+            pieces.extend(split_oversized(line, max_tokens, encoding))
+        return pieces
+    return [
+        (encoding.decode(tokens[start:start + max_tokens]), len(tokens[start:start + max_tokens]))
+        for start in range(0, len(tokens), max_tokens)
+    ]
+
+
+# Greedily packs (text, token_count) pieces into chunks of at most max_tokens,
+# only breaking between pieces; yields each chunk as soon as it is full
+def pack_pieces(pieces, max_tokens, encoding):
+    separator_tokens = len(encoding.encode(PARAGRAPH_SEPARATOR))
+    current, current_tokens = [], 0
+    for text, tokens in pieces:
+        cost = tokens + (separator_tokens if current else 0)
+        if current and current_tokens + cost > max_tokens:
+            yield PARAGRAPH_SEPARATOR.join(current), current_tokens
+            current, current_tokens = [], 0
+            cost = tokens
+        current.append(text)
+        current_tokens += cost
+    if current:
+        yield PARAGRAPH_SEPARATOR.join(current), current_tokens
+
+
+def iter_chunks(docs, max_tokens=CHUNK_MAX_TOKENS, model="gpt-4o", report=None, dedup=None):
+    """Streams the paragraphs of `docs` into chunks of at most `max_tokens` gpt-4o tokens.
+
+    `docs` may be any iterable, including a generator from the loader; only the
+    current document and the chunk being packed are held in memory. When `report`
+    is a dict it is updated as chunks are produced with the chunk count, the token
+    count, the largest chunk and the tokens per source file. With `dedup` (a
+    dedup.NearDuplicateFilter), paragraphs repeating an earlier one are dropped and
+    counted in `duplicates` and `duplicate_tokens`.
+    """
+    encoding = get_encoding(model)
+    report = {} if report is None else report
+    report.update(chunks=0, tokens=0, max_chunk_tokens=0, tokens_per_source={}, duplicates=0, duplicate_tokens=0)
+
+    def pieces():
+        for doc in docs:
+            source = doc.metadata.get('source', '')
+            for paragraph in split_paragraphs(doc.page_content):
+                paragraph_pieces = split_oversized(paragraph, max_tokens, encoding)
+                if dedup is not None:
+                    tokens = sum(piece[1] for piece in paragraph_pieces)
+                    if dedup.is_duplicate(paragraph, tokens):
+                        report["duplicates"] += 1
+                        report["duplicate_tokens"] += tokens
+                        continue
+                for piece in paragraph_pieces:
+                    report["tokens_per_source"][source] = report["tokens_per_source"].get(source, 0) + piece[1]
+                    yield piece
+
+    for text, tokens in pack_pieces(pieces(), max_tokens, encoding):
+        report["chunks"] += 1
+        report["tokens"] += tokens
+        report["max_chunk_tokens"] = max(report["max_chunk_tokens"], tokens)
+        yield text
+
+
+def chunk_documents(docs, max_tokens=CHUNK_MAX_TOKENS, model="gpt-4o"):
+    """Packs the paragraphs of `docs` into chunks of at most `max_tokens` gpt-4o tokens.
+
+    Returns the chunk texts and the report described in `iter_chunks`.
+    """
+    report = {}
+    chunks = list(iter_chunks(docs, max_tokens, model, report))
+    return chunks, report
@@ -1,100 +1,347 @@
 import os
+import re
+import json
 import logging
 import argparse
+import sqlite3
+import shutil
+import time
+import threading
+from functools import partial
+from itertools import chain
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from openai import OpenAI
 from dotenv import load_dotenv
-from langchain_community.document_loaders import DirectoryLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from unstructured.partition.utils.ocr_models import tesseract_ocr
-
-parser = argparse.ArgumentParser(description="Example script")
-parser.add_argument('--filename', type=str, help='Your file name')
-args = parser.parse_args()
-fileId = args.filename
+# Load environment variables; before the local modules and the constants below read their settings
+load_dotenv()
+from cache import DiskCache, hash_key
+from loaders import ParsedDocumentCache, iter_documents, list_files, file_sha256
+from chunking import CHUNK_MAX_TOKENS, iter_chunks
+from dedup import NearDuplicateFilter, DEDUP_THRESHOLD, DEDUP_MIN_TOKENS, DEDUP_WINDOW
+from metrics import RunMetrics, TimedIterator, registry
+from llm_client import RateLimitedClient, LLM_MAX_RETRIES
+from llm_batch import BatchCollector, BatchRequestFailed
+from results_store import ResultsStore, combined_score
+from retrieval import PassageIndex, RETRIEVAL_INDEX_DIR, RETRIEVAL_PASSAGE_CHARS, RETRIEVAL_TOP_K, INDEX_VERSION
 
 #constants
-TOKEN_ESTIMATE_PER_WORD = 0.8
-MAX_TOKENS = 8000
+MAX_TOKENS = CHUNK_MAX_TOKENS  # gpt-4o tokens per chunk
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "mapreduce")  # "mapreduce" or "refine"
+MAP_MAX_WORKERS = int(os.getenv("MAP_MAX_WORKERS", 8))  # concurrent chunk summaries
+REDUCE_FAN_IN = int(os.getenv("REDUCE_FAN_IN", 4))  # partial summaries merged per call
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))  # upper bound of in-flight OpenAI requests
+PIPELINE_MAX_WORKERS = int(os.getenv("PIPELINE_MAX_WORKERS", 8))  # pipeline stages running at once
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", 256))  # chunk summaries queued per target in batch mode
+COMPARE_MODE = os.getenv("COMPARE_MODE", "retrieval")  # "retrieval": per-criterion calls on indexed passages, "summary": one call on the summaries
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o")  # default model of every stage
+# Model routing per pipeline stage; SUMMARY_MODEL answers the chunk summaries and their merges,
+# COMPARE_MODEL the comparisons and ratings, RANK_MODEL the written recommendation
+STAGE_MODELS = {
+    "summarize": os.getenv("SUMMARY_MODEL") or LLM_MODEL,
+    "compare": os.getenv("COMPARE_MODEL") or LLM_MODEL,
+    "rank": os.getenv("RANK_MODEL") or LLM_MODEL,
+}
+# metrics stage of a completion -> routed stage
+STAGE_ROUTES = {"summarize_chunk": "summarize", "merge_summaries": "summarize",
+                "compare": "compare", "compare_criterion": "compare", "rate": "compare", "rank": "rank"}
+# bump the version of a stage when its prompts change, so that outputs stored by earlier runs are recomputed
+PROMPT_VERSIONS = {"summarize": 2, "compare": 3, "rank": 3}
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "./cache/llm")
+LLM_CACHE_MAX_MB = int(os.getenv("LLM_CACHE_MAX_MB", 512))
 
-# Load environment variables
-load_dotenv()
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_KEY")
-openai_client = OpenAI(api_key=os.getenv("OPENAI_KEY"))
+# OPENAI_BASE_URL points the client at another OpenAI-compatible endpoint, e.g. benchmarks/fake_openai.py
+openai_client = OpenAI(api_key=os.getenv("OPENAI_KEY"), base_url=os.getenv("OPENAI_BASE_URL") or None, max_retries=0)
 print("--env loaded in comparison.py")
 
-try:
-    # Loading files
-    loader = DirectoryLoader(f"./docs/{fileId}")
+# Shared by all pipelines and map-reduce workers: request/token budgets, adaptive concurrency
+# up to LLM_MAX_CONCURRENCY and retries with backoff
+llm = RateLimitedClient(openai_client, LLM_MAX_CONCURRENCY, model=LLM_MODEL)
+# Batch mode: requests queued by the waiting stages are submitted together to the Batch API
+llm_batch = BatchCollector(openai_client.with_options(max_retries=LLM_MAX_RETRIES))
+
+# Completions keyed by model, temperature and messages; run.refresh skips the lookup
+llm_cache = DiskCache(LLM_CACHE_DIR, LLM_CACHE_MAX_MB * 1024 * 1024, name="llm")
+doc_cache = ParsedDocumentCache()
+# Finished runs indexed by workspace, provider, time and score for the app's history; opened
+# by the first run that finishes, so importing this module creates no database
+results_store = None
+
+def resultsStore():
+    global results_store
+    if results_store is None:
+        results_store = ResultsStore()
+    return results_store
+
+# output: optional (stage, target, markdown path) the completion is written to; in
+# streaming runs the tokens are appended to that file as they arrive. A fourth element is
+# text the file keeps above the completion, e.g. the sections written before a conclusion
+# `stage` and `target` label the call in the run metrics; the target defaults to the output's target element
+# response_format: optional structured output format; `validate` raises ValueError on an
+# unusable answer, which is then not cached
+# The model is routed by `stage`, see stageModel
+def chatCompletion(messages, temperature=0, run=None, output=None, stage="llm", target=None, response_format=None, validate=None):
+    model = stageModel(run, stage)
+    key = hash_key(model, temperature, messages, *([response_format] if response_format else []))
+    target = target or (output[1] if output else None)
+    start = time.perf_counter()
+    if not (run and run.refresh):
+        cached = llm_cache.get(key)
+        if cached is not None:
+            entry = json.loads(cached)
+            content = entry["content"]
+            if output:
+                write_to_file(output[2], [outputText(output, content)])
+            if run:
+                run.metrics.record_llm(stage, target, model, time.perf_counter() - start, cached=True, **entry.get("usage", {}))
+            return content
+
+    batched = bool(run and run.batch)
+    if batched:
+        try:
+            content, usage, retries = batchCompletion(messages, temperature, output, response_format, model)
+        except BatchRequestFailed as e:
+            print("--debug batch request failed, sending it directly",e)
+            content, usage, retries = requestCompletion(messages, temperature, run, output, response_format, model)
+            batched = False
+    else:
+        content, usage, retries = requestCompletion(messages, temperature, run, output, response_format, model)
+    if run:
+        run.metrics.record_llm(stage, target, model, time.perf_counter() - start, retries=retries, batch=batched, **usage)
+    if validate:
+        validate(content)
+    llm_cache.set(key, json.dumps({"model": model, "temperature": temperature, "content": content, "usage": usage}).encode("utf-8"))
+    return content
+
+# Model for a completion of metrics stage `stage`: the run's routing (STAGE_MODELS unless
+# run_analysis got `models`), LLM_MODEL for stages without a route
+def stageModel(run, stage):
+    models = run.models if run else STAGE_MODELS
+    return models.get(STAGE_ROUTES.get(stage), LLM_MODEL)
+
+# Routing of a run: STAGE_MODELS with the stages in `models` replaced; unknown stages are rejected
+def stageRouting(models=None):
+    unknown = sorted(set(models or {}) - set(STAGE_MODELS))
+    if unknown:
+        raise ValueError(f"Unknown stage {', '.join(unknown)} in the model routing, expected {', '.join(STAGE_MODELS)}")
+    return {**STAGE_MODELS, **(models or {})}
+
+# Waits for the completion in the next Batch API job, see llm_batch.BatchCollector
+def batchCompletion(messages, temperature, output=None, response_format=None, model=LLM_MODEL):
+    body = {"model": model, "messages": messages, "temperature": temperature}
+    if response_format:
+        body["response_format"] = response_format
+    body = llm_batch.complete(body)
+    content = body["choices"][0]["message"]["content"]
+    usage = body.get("usage") or {}
+    if output:
+        write_to_file(output[2], [outputText(output, content)])
+    return content, {"prompt_tokens": usage.get("prompt_tokens", 0), "completion_tokens": usage.get("completion_tokens", 0),
+                     "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0}, 0
+
+# One completion through the shared rate-limited client, see llm_client.Completion
+def requestCompletion(messages, temperature, run=None, output=None, response_format=None, model=LLM_MODEL):
+    stream = bool(run and run.stream and output)
+    options = {"stream_options": {"include_usage": True}} if stream else {}
+    if response_format:
+        options["response_format"] = response_format
+    with llm.completion(model=model, messages=messages, temperature=temperature, stream=stream, **options) as call:
+        if stream:
+            content, call.usage = streamCompletion(call, run, output)
+        else:
+            content = call.response.choices[0].message.content
+            call.usage = usageTokens(call.response.usage)
+            if output:
+                write_to_file(output[2], [outputText(output, content)])
+    return content, call.usage, call.retries
+
+# cached_tokens: prompt tokens served from the API's prompt cache, billed at a discount
+def usageTokens(usage):
+    if usage is None:
+        return {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens,
+            "cached_tokens": getattr(details, "cached_tokens", None) or 0}
+
+# File content of a completion written to `output`, after the text the output keeps above it
+def outputText(output, content):
+    return output[3] + content if len(output) > 3 else content
+
+def streamCompletion(call, run, output):
+    stage, target, path = output[:3]
+    parts = []
+    usage = None
+    with open(path, 'w') as file:
+        file.write(outputText(output, ""))
+        for event in call.response:
+            # the last event carries the usage and no choices
+            if event.usage:
+                usage = event.usage
+            delta = event.choices[0].delta.content if event.choices else None
+            if not delta:
+                continue
+            if not parts:
+                run.firstToken(stage, target, time.perf_counter() - call.sentAt)
+            parts.append(delta)
+            file.write(delta)
+            file.flush()
+    return "".join(parts), usageTokens(usage)
+
+# Per-run settings shared by the pipeline stages
+class AnalysisRun:
+    def __init__(self, fileId, mode=SUMMARY_MODE, refresh=False, onEvent=None, stream=False, batch=False, compareMode=COMPARE_MODE,
+                 models=None):
+        self.fileId = fileId
+        self.mode = mode
+        self.compareMode = compareMode
+        self.models = stageRouting(models)
+        self.refresh = refresh
+        # batch answers arrive all at once, so there is nothing to stream
+        self.stream = stream and not batch
+        self.batch = batch
+        self.docsDir = f"./docs/{fileId}"
+        self.outputDir = f"./markdown/{fileId}"
+        self.onEvent = onEvent
+        # parse only until the workspace is loaded and the provider count is known
+        self.totalSteps = 1
+        self.doneSteps = 0
+        self.stageStarted = {}
+        self.timeToFirstToken = {}
+        self.parseReport = []
+        self.metrics = RunMetrics(fileId)
+        self.indexes = {}
+        self.targetPaths = {}
+        self.stageManifest = {}
+        self.reusedStages = []
+        self._lock = threading.Lock()
+        self._indexLock = threading.Lock()
+
+    # Progress event for a pipeline stage: parse, chunk, summarize, compare or rank
+    def report(self, stage, status, target=None, **detail):
+        with self._lock:
+            if status == "started":
+                self.stageStarted[(stage, target)] = time.perf_counter()
+            if status == "done":
+                self.doneSteps += 1
+                started = self.stageStarted.get((stage, target))
+                if started:
+                    self.metrics.record_stage(stage, target, time.perf_counter() - started)
+            progress = min(self.doneSteps / self.totalSteps, 1.0)
+        print("--debug stage",stage,target or "",status,f"{progress:.0%}")
+        if self.onEvent:
+            self.onEvent({"stage": stage, "status": status, "target": target,
+                          "progress": progress, "time": time.time(), **detail})
+
+    # Time to first streamed token, from the start of the stage and of the request
+    def firstToken(self, stage, target, requestSeconds):
+        label = f"{stage}:{target}" if target else stage
+        with self._lock:
+            if label in self.timeToFirstToken:
+                return
+            started = self.stageStarted.get((stage, target))
+            stageSeconds = time.perf_counter() - started if started else requestSeconds
+            self.timeToFirstToken[label] = {"stage_seconds": round(stageSeconds, 3), "request_seconds": round(requestSeconds, 3)}
+        self.report(stage, "first_token", target, **self.timeToFirstToken[label])
+
+    def outputPath(self, name):
+        return f"{self.outputDir}/{name}"
+
+    # Stores the result of a pipeline task with the fingerprint of its inputs in stages.json
+    def recordTask(self, name, fingerprint, result):
+        with self._lock:
+            self.stageManifest[name] = {"fingerprint": fingerprint, "result": result, "recorded_at": time.time()}
+            self.saveStageManifest()
+
+    def forgetTasks(self, names):
+        with self._lock:
+            for name in names:
+                self.stageManifest.pop(name, None)
+            self.saveStageManifest()
+
+    def saveStageManifest(self):
+        tmp_path = self.outputPath(f"stages.json.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(self.stageManifest, file)
+        os.replace(tmp_path, self.outputPath("stages.json"))
+
+    def loadStageManifest(self):
+        try:
+            with open(self.outputPath("stages.json")) as file:
+                self.stageManifest = json.load(file)
+        except (FileNotFoundError, ValueError):
+            self.stageManifest = {}
+
+def discoverProviders(docsDir):
+    return sorted(name for name in os.listdir(docsDir)
+                  if os.path.isdir(os.path.join(docsDir, name)) and not name.startswith("."))
+
+def loadWorkspace(run):
+    # Only the file lists are built here; each summary pulls its documents lazily from
+    # the loader, previously parsed uploads come from the document cache
+    run.report("parse", "started")
     print("--loader initialized ")
-    all_docs = loader.load()
-    print("---all docs loaded!")
-    for doc in all_docs:
-        print("---****---", doc.metadata.get('source', ''))
-    
+    run.parseReport = []
+    workspaceFiles = list_files(run.docsDir)
+    for path in workspaceFiles:
+        print("---****---", path)
+
     print("*****")
 
     #customer file
-    rfq_customer = [doc for doc in all_docs if 'rfq_customer' in doc.metadata.get('source', '').lower()]
+    customerPaths = [path for path in workspaceFiles if 'rfq_customer' in path.lower()]
 
-    #provider files
-    rfq_provider1 = [doc for doc in all_docs if 'provider1' in doc.metadata.get('source', '').lower()]
-    rfq_provider2 = [doc for doc in all_docs if 'provider2' in doc.metadata.get('source', '').lower()]
-    rfq_provider3 = [doc for doc in all_docs if 'provider3' in doc.metadata.get('source', '').lower()]
+    #provider files: one sub folder of the workspace per provider
+    providerPaths = {provider: list_files(os.path.join(run.docsDir, provider)) for provider in discoverProviders(run.docsDir)}
 
-    print("{} total files loaded \n".format(len(all_docs)))
-    print("{} customer, {} provider1, {}provider2, {}provider3 files".format(
-        len(rfq_customer),len(rfq_provider1),len(rfq_provider2),len(rfq_provider3)
+    print("{} total files found \n".format(len(workspaceFiles)))
+    print("{} customer files, provider files: {}".format(
+        len(customerPaths), {provider: len(paths) for provider, paths in providerPaths.items()}
     ))
-except Exception as e:
-    print("Error loading files: ", e)
-
-
-#dir for markdown files
-os.makedirs(f"./markdown/{fileId}", exist_ok=True)
-
-# Split to Chunks as per tokens
-def split_into_chunks(doc, max_tokens=MAX_TOKENS):
-    words = doc.split()
-    chunks = []
-    current_chunk = []
-    current_token_count = 0
-    
-    for word in words:
-        estimated_tokens = len(word) * TOKEN_ESTIMATE_PER_WORD
-        
-        if current_token_count + estimated_tokens > max_tokens:
-            chunks.append(' '.join(current_chunk))
-            current_chunk = [word]
-            current_token_count = estimated_tokens
-        else:
-            current_chunk.append(word)
-            current_token_count += estimated_tokens
-    
-    if current_chunk:
-        chunks.append(' '.join(current_chunk))
-    # print("--curr chunk: ",len(current_chunk))
-    return chunks
-
-def summarizeCustomerDoc(currSummarization, chunks):
-    prompt = f"""
-        Your job is to produce a final summary with generating a comprehensive and structured summary of an RFQ, RFI, or RFP document. 
-        The summary should address all critical elements for a holistic understanding of the request, requirements, and expectations.
-        
-        
-        You are provided the existing summary upto a certain point:
-        <existing_summary>
-        {currSummarization}
-        <existing_summary>
-        
-        Context from Document:
-        <chunk_from_document>
-        {chunks}
-        <chunk_from_document>
-        
-        
-        Your task is to update the <existing_summary> using the <chunk_from_document> 
-        
-        Please ensure the final summary includes the following sections:
+    # parse + chunk/summarize the customer + chunk/summarize/compare each provider + rank
+    run.totalSteps = 1 + 2 + 3 * len(providerPaths) + 1
+    run.targetPaths = {"customer": customerPaths, **providerPaths}
+    run.report("parse", "done", files=len(workspaceFiles))
+    return customerPaths, providerPaths
+
+# Saved passage index of `target` if it was built from the same files, with the fingerprint of the files
+def loadPassageIndex(run, paths, target):
+    directory = os.path.join(RETRIEVAL_INDEX_DIR, run.fileId, target)
+    fingerprint = hash_key(INDEX_VERSION, RETRIEVAL_PASSAGE_CHARS, [(path, os.path.getsize(path), os.path.getmtime(path)) for path in paths])
+    index = None if run.refresh else PassageIndex.load(directory, fingerprint)
+    if index is not None:
+        print("--debug passage index reused",target,len(index),"passages")
+    return index, fingerprint, directory
+
+# Generator over the documents of `paths`, parsed a few files ahead of the chunker. In
+# retrieval mode the passage index of `target` is built from the same stream, unless
+# the index saved for these exact files can be reused
+def streamDocuments(run, paths, target=None):
+    docs = iter_documents(paths, doc_cache, refresh=run.refresh, parse_report=run.parseReport)
+    if run.compareMode != "retrieval" or target is None:
+        return docs
+    index, fingerprint, directory = loadPassageIndex(run, paths, target)
+    if index is not None:
+        run.indexes[target] = index
+        return docs
+    run.indexes[target] = index = PassageIndex(directory)
+    return index.indexing(docs, fingerprint)
+
+# Passage index of `target` for the comparison; when its summary was reused from an earlier
+# run the documents were not streamed, so the saved index is loaded or rebuilt here
+def passageIndex(run, target):
+    with run._indexLock:
+        if target not in run.indexes:
+            paths = run.targetPaths.get(target, [])
+            index, fingerprint, directory = loadPassageIndex(run, paths, target)
+            if index is None:
+                index = PassageIndex(directory)
+                deque(index.indexing(iter_documents(paths, doc_cache, parse_report=run.parseReport), fingerprint), maxlen=0)
+            run.indexes[target] = index
+        return run.indexes[target]
+
+# Sections expected in the customer and provider summaries
+CUSTOMER_SUMMARY_SECTIONS = """\
             <sections_in_final_summary>
             1. Overview of the Request: Primary objectives/goals of the RFQ in detail
             2. Project/RFQ/RFP Scope: Detail out the Scope of services/products required
@@ -103,75 +350,109 @@ def summarizeCustomerDoc(currSummarization, chunks):
             4. Evaluation Criteria:Look at the document and call out the key evaluation criterias and expectation for eg. Cost, technical competence, experience, innovation, timelines, SLAs, regulatory compliance
             5. Expectations from the Provider: Expected response format, sections (executive summary, project approach, pricing, etc.), word/page limits, submission methods, Pricing Requirements:Describe how to present pricing (itemized, milestones, total cost) and preferred payment terms
             <sections_in_final_summary>
-            
+"""
+
+PROVIDER_SUMMARY_SECTIONS = """\
+            <sections_in_final_summary>
+                1. Overview: Brief overview of the vendor’s understanding of the scope and assess and provide insights on whether they have been able to fully understand the scope of work, summarize their proposed solution and approach, and its alignment with project goals and objectives.
+                2. Solution Approach and Methodology: Solution approach should be a very detailed section talking about the overall solution approach proposed by the vendor to address the scope of work, very detailed summarization of the technical solution proposed including architecture, technology stack, solution approach and steps, integrations, and innovative features). Also assess whether the solution approach is aligned with the latest technology trends, encapsulates the right approach to solve the problem or address the scope in the RFP/RFQ and also call out if there are any key elements of the solution that is missing or anything that is really well thought through and exceptional in the approach shared. Also provide in detail the vendors proposed Delivery methodology , implementation strategy, and key project milestones that they are committing to in the response and if its aligning with the RFQ timelines and asks. 
+                3. Pricing Structure and Cost Breakdown: Provide details on the proposed commercials, pricing and the Itemized breakdown of costs (e.g., hardware, software, services, licenses, labor, maintenance, support) provided by the vendor in their proposal and the Payment terms and alignment with budget constraints
+                4. Differentiators: Look at the response and summarize some of the valur added services or differentiators proposed by the vendor that could benefit the customer like Unique services or features, potential cost savings, scalability, or innovations that set the vendor apart
+                5. Risk Management and Contingency Plans:
+                    - Identified risks and mitigation strategies
+                    - SLAs or guarantees related to performance, uptime, or issue resolution
+                6. Vendor Capabilities and Experience: Summarize the details provided by the vendor that demonstrates their overall capabilities and experience executing similar projects or scope of work, Summary of case studies or testimonials demonstrating past success in similar projects, including outcomes achieved
+                7. Project Governance and Communication: Detail out the Governance structure, communication plans, reporting frequency, and risk management during the project that has been mentioned in the response document
+            <sections_in_final_summary>
+"""
+
+# The prompts put their static instructions first, in the system message, and the variable
+# content last, so consecutive calls share a prefix the API can serve from its prompt cache
+def summarizeCustomerDoc(currSummarization, chunks, run=None, output=None, target=None):
+    instructions = f"""
+        Your job is to produce a final summary with generating a comprehensive and structured summary of an RFQ, RFI, or RFP document. 
+        The summary should address all critical elements for a holistic understanding of the request, requirements, and expectations.
+        
+        You are provided the existing summary upto a certain point in <existing_summary> and context from the document in <chunk_from_document>.
+        Your task is to update the <existing_summary> using the <chunk_from_document> 
+        
+        Please ensure the final summary includes the following sections:
+{CUSTOMER_SUMMARY_SECTIONS}            
         If any section from <sections_in_final_summary> is missing in <chunk_from_document>. 
         Please inform that this section is not present
         Please ensure the summary is concise yet detailed, addressing each section clearly. 
     """
-
-    messages = [{"role": "user", "content": prompt}]
-    response = openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0,
-        stream=False,
-    )
-    
-    return response.choices[0].message.content
-
-def summarizeProviderDoc(currSummarization, chunks):
-    prompt=f"""
-        You are tasked with creating a comprehensive and structured summary of a response or proposal document received from a provider or vendor for an RFQ, RFI, or RFP. \
-        The summary should highlight critical elements to provide a complete understanding of the vendor's proposed solution, pricing, delivery approach, and overall capabilities.
-        
-        You are provided the existing summary upto a certain point:
+    prompt = f"""
         <existing_summary>
         {currSummarization}
         <existing_summary>
         
-        
         Context from Document:
         <chunk_from_document>
         {chunks}
         <chunk_from_document>
+    """
+
+    messages = [{"role": "system", "content": instructions}, {"role": "user", "content": prompt}]
+    return chatCompletion(messages, temperature=0, run=run, output=output, stage="summarize_chunk", target=target)
+
+def summarizeProviderDoc(currSummarization, chunks, run=None, output=None, target=None):
+    instructions = f"""
+        You are tasked with creating a comprehensive and structured summary of a response or proposal document received from a provider or vendor for an RFQ, RFI, or RFP. \
+        The summary should highlight critical elements to provide a complete understanding of the vendor's proposed solution, pricing, delivery approach, and overall capabilities.
         
+        You are provided the existing summary upto a certain point in <existing_summary> and context from the document in <chunk_from_document>.
         Your task is to update the <existing_summary> using the <chunk_from_document>.
         
         Please ensure the final summary clearly details out the key aspects that is available in the response and should includes the following sections:
-            <sections_in_final_summary>
-                1. Overview: Brief overview of the vendor’s understanding of the scope and assess and provide insights on whether they have been able to fully understand the scope of work, summarize their proposed solution and approach, and its alignment with project goals and objectives.
-                2. Solution Approach and Methodology: Solution approach should be a very detailed section talking about the overall solution approach proposed by the vendor to address the scope of work, very detailed summarization of the technical solution proposed including architecture, technology stack, solution approach and steps, integrations, and innovative features). Also assess whether the solution approach is aligned with the latest technology trends, encapsulates the right approach to solve the problem or address the scope in the RFP/RFQ and also call out if there are any key elements of the solution that is missing or anything that is really well thought through and exceptional in the approach shared. Also provide in detail the vendors proposed Delivery methodology , implementation strategy, and key project milestones that they are committing to in the response and if its aligning with the RFQ timelines and asks. 
-                3. Pricing Structure and Cost Breakdown: Provide details on the proposed commercials, pricing and the Itemized breakdown of costs (e.g., hardware, software, services, licenses, labor, maintenance, support) provided by the vendor in their proposal and the Payment terms and alignment with budget constraints
-                4. Differentiators: Look at the response and summarize some of the valur added services or differentiators proposed by the vendor that could benefit the customer like Unique services or features, potential cost savings, scalability, or innovations that set the vendor apart
-                5. Risk Management and Contingency Plans:
-                    - Identified risks and mitigation strategies
-                    - SLAs or guarantees related to performance, uptime, or issue resolution
-                6. Vendor Capabilities and Experience: Summarize the details provided by the vendor that demonstrates their overall capabilities and experience executing similar projects or scope of work, Summary of case studies or testimonials demonstrating past success in similar projects, including outcomes achieved
-                7. Project Governance and Communication: Detail out the Governance structure, communication plans, reporting frequency, and risk management during the project that has been mentioned in the response document
-            <sections_in_final_summary>
-            
+{PROVIDER_SUMMARY_SECTIONS}            
         If any section from <sections_in_final_summary> is missing in <chunk_from_document>. 
         Please inform that this section is not present
         Highlight critical factors like Solution approach, Differentiators, Pricing, risk management, and value additions.
     """
+    prompt = f"""
+        <existing_summary>
+        {currSummarization}
+        <existing_summary>
+        
+        Context from Document:
+        <chunk_from_document>
+        {chunks}
+        <chunk_from_document>
+    """
 
-    messages = [{"role": "user", "content": prompt}]
-    response = openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0,
-        stream=False,
+    messages = [{"role": "system", "content": instructions}, {"role": "user", "content": prompt}]
+    return chatCompletion(messages, temperature=0, run=run, output=output, stage="summarize_chunk", target=target)
+
+# Merging partial summaries (reduce step of map-reduce mode)
+def mergeSummaries(partialSummaries, isCustomer, run=None, output=None, target=None):
+    sections = CUSTOMER_SUMMARY_SECTIONS if isCustomer else PROVIDER_SUMMARY_SECTIONS
+    docType = "an RFQ, RFI, or RFP document" if isCustomer else "a provider's response to an RFQ, RFI, or RFP"
+    partials = "\n".join(
+        f"<partial_summary>\n{summary}\n<partial_summary>" for summary in partialSummaries
     )
-    
-    return response.choices[0].message.content
+    instructions = f"""
+        You are given partial summaries of consecutive parts of {docType}, in document order.
+        Your task is to merge them into one comprehensive and structured summary without losing any detail.
+
+        Please ensure the merged summary includes the following sections:
+{sections}
+        Combine information about the same section from all partial summaries and remove repetitions.
+        Only report a section as not present if it is missing from every partial summary.
+    """
+
+    messages = [{"role": "system", "content": instructions}, {"role": "user", "content": partials}]
+    return chatCompletion(messages, temperature=0, run=run, output=output, stage="merge_summaries", target=target)
 
 # Comparing RFQ_customer and Provider's response
-def summaryComparison(RFQ_providerSummary, RFQ_customerSummary):
-    prompt = f"""
+# The instructions and the customer summary come first and are identical for every provider,
+# so only the provider summary at the end is new to the API's prompt cache
+def summaryComparison(RFQ_providerSummary, RFQ_customerSummary, run=None, output=None):
+    instructions = """
         You are tasked with evaluating and comparing a provider's response to an RFQ (Request for Quotation) or RFP. 
-        Below are two documents for comparison:
-        Customer's RFQ: This document outlines the customer's specific requests and expectations: {RFQ_customerSummary}
-        Provider's Response: This document is the provider’s response to the RFQ, including their proposed services and deliverables: {RFQ_providerSummary}
+        You are given two documents for comparison:
+        Customer's RFQ: This document outlines the customer's specific requests and expectations, in <customer_rfq>
+        Provider's Response: This document is the provider’s response to the RFQ, including their proposed services and deliverables, in <provider_response>
 
         Your goal is to compare the two documents and evaluate the provider’s response across the following key areas:
             1. Services and Deliverables:
@@ -208,42 +489,209 @@ def summaryComparison(RFQ_providerSummary, RFQ_customerSummary):
             - Ensure the comparison is thorough, structured, and provides actionable insights to guide the customer’s decision-making process.
     """
 
-    messages = [{"role": "user", "content": prompt}]
-    response = openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0.3,
-        stream=False,
-    )
-    
-    return response.choices[0].message.content
-
-def processingFiles(files):
-    chunks = []
-    docs = splitter.split_documents(files)
-    print("--debug docs",len(docs))
-    
-    all_text=""
-    for doc in docs:
-        doc_text = doc.page_content
-        # print("--debug doc",doc.metadata) check if reading allProviderFiles
-        all_text += '\n\n' + doc_text
-    
-    chunks = split_into_chunks(all_text)
-    summarization = ""
-    print("--debug len chunks",len(chunks))
-    if(files == rfq_customer):
-        for chunk in chunks:
-            print("--debug chunk summarize customer",len(chunk))
-            summarization = summarizeCustomerDoc(summarization, chunk)
-            # print("--debug chunk summarize customer",summarization)
+    customer = f"""
+        <customer_rfq>
+        {RFQ_customerSummary}
+        </customer_rfq>
+    """
+    provider = f"""
+        <provider_response>
+        {RFQ_providerSummary}
+        </provider_response>
+    """
+
+    messages = [{"role": "system", "content": instructions}, {"role": "user", "content": customer}, {"role": "user", "content": provider}]
+    return chatCompletion(messages, temperature=0.3, run=run, output=output, stage="compare")
+
+# Criteria of the retrieval comparison: (section title, search query, what to assess)
+COMPARISON_CRITERIA = [
+    ("Services and Deliverables",
+     "services deliverables scope of work requirements tasks outputs solution implementation",
+     "Compare the services and deliverables offered with the requirements. Identify gaps, misalignments and additional services, and whether they add value."),
+    ("Fee Structure",
+     "fee fees price pricing cost costs budget rate rates payment terms invoice breakdown",
+     "Check whether the fees and pricing model align with the expected budget and pricing, how clear the cost breakdown is, and whether the payment terms are reasonable."),
+    ("Capabilities",
+     "experience expertise capabilities qualifications team staff similar projects track record",
+     "Assess the provider's expertise, experience and qualifications against the complexity and demands of the project; highlight strengths and weaknesses."),
+    ("Client Testimonials and References",
+     "client testimonials references case studies customers past performance",
+     "Review the testimonials or references and how relevant they are to the project goals, similar projects or industries."),
+    ("Evaluation Criteria",
+     "evaluation criteria scoring selection weighting award assessment proposal",
+     "Assess how well the response aligns with the evaluation criteria of the RFQ (cost, timelines, technical capabilities, scope compliance and others)."),
+    ("Risk Management",
+     "risk risks mitigation contingency issues assumptions dependencies",
+     "Compare how potential risks are addressed and the mitigation strategies proposed."),
+    ("Innovation and Value Additions",
+     "innovation innovative value added additional improvements optional enhancements",
+     "Highlight innovative solutions or value-added services that go beyond the core requirements."),
+    ("Support and Maintenance",
+     "support maintenance service level agreement sla helpdesk warranty ongoing",
+     "Evaluate post-implementation support, ongoing maintenance, customer service and SLAs."),
+    ("Timeline and Delivery Schedule",
+     "timeline schedule milestones deadlines delivery phases weeks months start completion",
+     "Compare timelines and delivery schedules for feasibility and alignment with the project deadlines."),
+    ("Compliance and Certifications",
+     "compliance certifications certified regulatory regulations standards iso insurance legal",
+     "Verify whether the necessary certifications and regulatory requirements are met and highlight compliance gaps."),
+]
+
+def formatPassages(passages, prefix):
+    if not passages:
+        return "(no relevant passage found)"
+    return "\n\n".join(f"[{prefix}{i}] ({passage['source']})\n{passage['text']}" for i, passage in enumerate(passages, 1))
+
+# One criterion of the retrieval comparison, assessed from the top passages of both sides only
+def criterionComparison(criterion, customerPassages, providerPassages, run=None, target=None):
+    title, _, assess = criterion
+    instructions = """
+        You are evaluating a provider's response to an RFQ (Request for Quotation) or RFP on one criterion at a time.
+        You are given the criterion, the passages of the customer's RFQ relevant to it in <rfq_passages> and the
+        passages of the provider's response relevant to it in <provider_passages>.
+
+        Base the assessment only on these passages and cite them by their ids, e.g. [R1] or [P2].
+        State what the RFQ requires, what the provider offers, the gaps or misalignments and anything offered beyond the requirements.
+        If the passages do not cover the criterion, say so instead of guessing. Do not repeat the criterion title.
+    """
+    # the criterion and the RFQ passages are the same for every provider and stay in the cached prefix
+    customer = f"""
+        Criterion: {title}. {assess}
+
+        <rfq_passages>
+        {formatPassages(customerPassages, "R")}
+        </rfq_passages>
+    """
+    provider = f"""
+        <provider_passages>
+        {formatPassages(providerPassages, "P")}
+        </provider_passages>
+    """
+    messages = [{"role": "system", "content": instructions}, {"role": "user", "content": customer}, {"role": "user", "content": provider}]
+    return chatCompletion(messages, temperature=0.3, run=run, stage="compare_criterion", target=target)
+
+# Overall comparison and conclusion over the per-criterion assessments
+def comparisonConclusion(assessments, run=None, target=None, output=None):
+    instructions = """
+        You are given the assessments of a provider's response to an RFQ (Request for Quotation) or RFP, one per evaluation criterion, in <assessments>.
+
+        Write the two final sections of the comparison:
+        ## Overall Comparison and Summary
+            Provide a detailed view of the provider's strengths and weaknesses, how well the requested aspects are addressed,
+            any critical gaps and the overall quality of the response.
+        ## Final Conclusion
+            - Determine if the provider's response sufficiently addresses the customer's RFQ.
+            - Justify your recommendation, clearly outlining areas where the provider met or fell short of the customer's requirements.
+            - Keep the citations of the assessments where they support a point.
+    """
+    prompt = f"""
+        <assessments>
+        {assessments}
+        </assessments>
+    """
+    messages = [{"role": "system", "content": instructions}, {"role": "user", "content": prompt}]
+    return chatCompletion(messages, temperature=0.3, run=run, output=output, stage="compare", target=target)
+
+# Retrieval comparison: every criterion pulls the top passages of the customer's and the
+# provider's index and is assessed by its own, much smaller, concurrent call. The output
+# file shows every section as soon as it is assessed, in criteria order, and the
+# conclusion streams in below them
+def retrievalComparison(run, provider, outputPath):
+    customerIndex, providerIndex = passageIndex(run, "customer"), passageIndex(run, provider)
+    assessments = {}
+    lock = threading.Lock()
+
+    def formatSections():
+        return "\n\n".join(f"## {criterion[0]}\n{assessments[criterion[0]]}" for criterion in COMPARISON_CRITERIA
+                           if criterion[0] in assessments)
+
+    def assess(criterion):
+        query = criterion[1]
+        customerPassages = customerIndex.search(query, RETRIEVAL_TOP_K)
+        providerPassages = providerIndex.search(query, RETRIEVAL_TOP_K)
+        start = time.perf_counter()
+        assessment = criterionComparison(criterion, customerPassages, providerPassages, run=run, target=provider)
+        with lock:
+            assessments[criterion[0]] = assessment
+            write_to_file(outputPath, [formatSections()])
+        # the first section is the first output of the stage
+        if run.stream:
+            run.firstToken("compare", provider, time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=len(COMPARISON_CRITERIA)) as executor:
+        list(executor.map(assess, COMPARISON_CRITERIA))
+    sections = formatSections()
+    conclusion = comparisonConclusion(sections, run=run, target=provider, output=("compare", provider, outputPath, f"{sections}\n\n"))
+    comparison = f"{sections}\n\n{conclusion}"
+    write_to_file(outputPath, [comparison])
+    return comparison
+
+# `files` may be a generator of documents: they are chunked as they arrive and each
+# chunk is handed to the summarizer, so the whole submission is never held in memory
+def processingFiles(files, isCustomer=False, run=None, target=None, output=None):
+    mode = run.mode if run else SUMMARY_MODE
+    # Single chunking pass: paragraphs packed up to MAX_TOKENS real gpt-4o tokens; paragraphs
+    # repeated across the target's files (company profile, legal terms, appendices) are sent once
+    # loader and splitter run lazily inside the summarizer, their time is measured on the iterators
+    report = {}
+    docs = TimedIterator(files)
+    chunks = TimedIterator(iter_chunks(docs, MAX_TOKENS, model=LLM_MODEL, report=report, dedup=NearDuplicateFilter()))
+    if mode == "refine":
+        summary = refineSummary(chunks, isCustomer, run, output, target)
     else:
-        for chunk in chunks:
-            print("--debug chunk summarize provider",len(chunk))
-            summarization = summarizeProviderDoc(summarization, chunk)
-            # print("--debug chunk summarize provider",summarization)
+        summary = mapReduceSummary(chunks, isCustomer, run, output, target)
+    print("--debug chunks",report["chunks"],"tokens",report["tokens"],"max chunk tokens",report["max_chunk_tokens"],"mode",mode)
+    print("--debug duplicates dropped",report["duplicates"],"tokens saved",report["duplicate_tokens"])
+    for source, tokens in report["tokens_per_source"].items():
+        print("--debug tokens",source,tokens)
+    if run:
+        run.metrics.record_stage("load", target, docs.seconds, documents=docs.items)
+        run.metrics.record_stage("split", target, chunks.seconds - docs.seconds, chunks=report["chunks"], tokens=report["tokens"],
+                                 duplicates=report["duplicates"], dedup_tokens_saved=report["duplicate_tokens"])
+        run.report("chunk", "done", target, chunks=report["chunks"], tokens=report["tokens"], dedup_tokens_saved=report["duplicate_tokens"])
+    return summary
+
+# Sequential refine: one summary updated chunk by chunk
+def refineSummary(chunks, isCustomer, run=None, output=None, target=None):
+    summarization = ""
+    summarize = summarizeCustomerDoc if isCustomer else summarizeProviderDoc
+    for chunk in chunks:
+        print("--debug chunk refine",len(chunk))
+        summarization = summarize(summarization, chunk, run=run, output=output, target=target)
     return summarization
 
+# Map-reduce: summarize chunks concurrently, then merge in a tree of REDUCE_FAN_IN;
+# only the call producing the final summary is written to output. Chunks are pulled
+# from the iterator as map slots free up, at most twice the workers are in flight; in
+# batch mode BATCH_MAX_WORKERS threads wait so that many chunks share one batch
+def mapReduceSummary(chunks, isCustomer, run=None, output=None, target=None):
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        return ""
+    second = next(chunks, None)
+    summarize = summarizeCustomerDoc if isCustomer else summarizeProviderDoc
+    if second is None:
+        return summarize("", first, run=run, output=output, target=target)
+    workers = BATCH_MAX_WORKERS if run and run.batch else MAP_MAX_WORKERS
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        inFlight, summaries = deque(), []
+        for chunk in chain([first, second], chunks):
+            inFlight.append(executor.submit(summarize, "", chunk, run=run, target=target))
+            if len(inFlight) >= workers * 2:
+                summaries.append(inFlight.popleft().result())
+        summaries.extend(future.result() for future in inFlight)
+        level = 0
+        while len(summaries) > 1:
+            groups = [summaries[i:i + REDUCE_FAN_IN] for i in range(0, len(summaries), REDUCE_FAN_IN)]
+            reduceOutput = output if len(groups) == 1 else None
+            print("--debug reduce level",level,"merging",len(summaries),"summaries in",len(groups),"groups")
+            summaries = list(executor.map(
+                lambda group: group[0] if len(group) == 1 else mergeSummaries(group, isCustomer, run, reduceOutput, target), groups
+            ))
+            level += 1
+    return summaries[0]
+
 # convert to markdownFile
 def write_to_file(filename, summary_list):
     with open(filename, 'w') as file:      
@@ -252,197 +700,419 @@ def write_to_file(filename, summary_list):
             file.write(summary_text + "\n\n")  
 
 
-# Chunk splitter
-splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
+# Runs {name: (fn, [dependency names])} on a thread pool, starting each task as soon as
+# its dependencies are done; fn is called with the dependency results in order
+def runTaskGraph(tasks, max_workers=PIPELINE_MAX_WORKERS):
+    results = {}
+    pending = dict(tasks)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name, (fn, deps) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    running[executor.submit(fn, *[results[dep] for dep in deps])] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(f"Unresolvable dependencies for tasks: {list(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
 
-#Processing RFQ_customer file
-RFQ_customerSummary = processingFiles(rfq_customer)
+# Fingerprint of the inputs of every pipeline task: the SHA-256 of its files, the prompt
+# version, model and settings of its stage, and the fingerprints of the tasks it depends on
+def taskFingerprints(run, customerPaths, providerPaths):
+    def files(paths):
+        return [(os.path.relpath(path, run.docsDir), file_sha256(path)) for path in paths]
 
-write_to_file(f'./markdown/{fileId}/RFQ_customerSummary.md', [RFQ_customerSummary])
-print("--debug rfq_customerSummary",RFQ_customerSummary,"\n",len(RFQ_customerSummary))
+    summarySettings = (PROMPT_VERSIONS["summarize"], run.models["summarize"], run.mode, MAX_TOKENS, REDUCE_FAN_IN, DEDUP_THRESHOLD, DEDUP_MIN_TOKENS, DEDUP_WINDOW)
+    fingerprints = {"customer": hash_key("customer", summarySettings, files(customerPaths))}
+    for provider, paths in providerPaths.items():
+        fingerprints[f"{provider}_summary"] = hash_key("summary", summarySettings, files(paths))
+        compareSettings = (PROMPT_VERSIONS["compare"], run.models["compare"], run.compareMode, RETRIEVAL_TOP_K, RETRIEVAL_PASSAGE_CHARS)
+        fingerprints[f"{provider}_comparison"] = hash_key("comparison", compareSettings,
+                                                          fingerprints["customer"], fingerprints[f"{provider}_summary"])
+    fingerprints["final"] = hash_key("final", PROMPT_VERSIONS["rank"], run.models["rank"], RANK_NARRATIVE,
+                                     [(provider, fingerprints[f"{provider}_comparison"]) for provider in providerPaths])
+    return fingerprints
 
+# Runs a pipeline task unless an earlier run recorded its result for the same input fingerprint
+# and its markdown output is still there; a reused task only reports its stages as done
+def memoizedTask(run, name, fingerprint, outputName, stages, target, fn, *deps):
+    entry = run.stageManifest.get(name)
+    if (not run.refresh and entry and entry["fingerprint"] == fingerprint
+            and os.path.exists(run.outputPath(outputName))):
+        print("--debug stage reused",name)
+        run.reusedStages.append(name)
+        for stage in stages:
+            run.report(stage, "done", target, reused=True)
+        return entry["result"]
+    result = fn(*deps)
+    run.recordTask(name, fingerprint, result)
+    return result
 
-#extract summary from allFilesCombinedText for each provider
-provider1_Summary = processingFiles(rfq_provider1)
-provider2_Summary = processingFiles(rfq_provider2)
-provider3_Summary = processingFiles(rfq_provider3)
+def summarizeCustomer(run, paths):
+    run.report("summarize", "started", "customer")
+    summaryPath = run.outputPath('RFQ_customerSummary.md')
+    summary = processingFiles(streamDocuments(run, paths, "customer"), isCustomer=True, run=run, target="customer",
+                              output=("summarize", "customer", summaryPath))
+    write_to_file(summaryPath, [summary])
+    print("--debug rfq_customerSummary",summary,"\n",len(summary))
+    run.report("summarize", "done", "customer")
+    return summary
 
-#convert providerSummaries to markdown debug RFP_summaries
-write_to_file(f'./markdown/{fileId}/provider1_summary.md', [provider1_Summary])
-write_to_file(f'./markdown/{fileId}/provider2_summary.md', [provider2_Summary])
-write_to_file(f'./markdown/{fileId}/provider3_summary.md', [provider3_Summary])
+def summarizeProvider(run, provider, paths):
+    run.report("summarize", "started", provider)
+    summaryPath = run.outputPath(f'{provider}_summary.md')
+    summary = processingFiles(streamDocuments(run, paths, provider), run=run, target=provider, output=("summarize", provider, summaryPath))
+    write_to_file(summaryPath, [summary])
+    print("--debug rfq_providerSummary",provider,"\n",summary,"\n",len(summary))
+    run.report("summarize", "done", provider)
+    return summary
 
-print("--debug rfq_providerSummaries\n",
-      "Provider1\n",provider1_Summary,"\n",len(provider1_Summary),'\n',
-      "Provider2\n",provider2_Summary,"\n",len(provider2_Summary),'\n',
-      "Provider3\n",provider3_Summary,"\n",len(provider3_Summary),'\n'
-)
+def compareProvider(run, provider, providerSummary, customerSummary):
+    run.report("compare", "started", provider)
+    comparisonPath = run.outputPath(f'{provider}_comparison.md')
+    if run.compareMode == "retrieval":
+        comparison = retrievalComparison(run, provider, comparisonPath)
+    else:
+        comparison = summaryComparison(providerSummary, customerSummary, run=run, output=("compare", provider, comparisonPath))
+    ratings = rateProvider(comparison, run=run, target=provider)
+    with open(run.outputPath(f'{provider}_ratings.json'), 'w') as file:
+        json.dump(ratings, file, indent=2)
+    run.report("compare", "done", provider)
+    return {"comparison": comparison, "ratings": ratings}
 
-# 1-2-1 comparing of RFP_summary and RFQ_summary
-finalAnalysis = []
-for RFQ_providerSummary in [provider1_Summary,provider2_Summary,provider3_Summary]:
-    result = summaryComparison(RFQ_providerSummary, RFQ_customerSummary)
-    finalAnalysis.append(result)
-    
-write_to_file(f'./markdown/{fileId}/finalAnalysis.md', finalAnalysis)
-print("final analysis ", finalAnalysis)
+# Providers by combined score, highest first; the sort is stable, so equal scores keep the submission order
+def rankByScore(providers, scores):
+    return sorted(providers, key=lambda provider: -scores[provider])
 
-best_rfqResponse_prompt = f"""
-        You have the following comparison results for each provider's response to the RFQ: {finalAnalysis}.
+# Combined scores and ranking are computed here from the ratings of every comparison, so any
+# number of providers is ranked the same way; only the optional narrative asks the model
+def rankProviders(run, providers, *comparisons):
+    run.report("rank", "started")
+    finalAnalysis = {provider: result["comparison"] for provider, result in zip(providers, comparisons)}
+    write_to_file(run.outputPath('finalAnalysis.md'), [f"## {provider}\n\n{comparison}" for provider, comparison in finalAnalysis.items()])
+    ratings = {provider: result["ratings"] for provider, result in zip(providers, comparisons)}
+    scores = {provider: combined_score(ratings[provider]) for provider in providers}
+    ranking = rankByScore(providers, scores)
+    print("--debug combined scores",scores)
+    finalResponse = scoreReport(ratings, scores, ranking)
+    write_to_file(run.outputPath('finalResponse.md'), [finalResponse])
+    if RANK_NARRATIVE:
+        digest = narrativeDigest(ratings, scores, ranking)
+        finalResponse += "\n\n## Recommendation\n"
+        finalResponse += rankingNarrative(digest, run=run, output=("rank", None, run.outputPath('finalResponse.md'), finalResponse))
+    run.report("rank", "done")
+    return finalResponse
 
-        Your task is to provide a detailed, side-by-side tabular comparison of the providers’ responses to the RFQ across the following key aspects. 
-        Two tables should be generated: one for the **comments** and another for the **ratings**. The providers' combined score for each key aspect should be 
-        calculated based on the ratings, and providers should be ranked accordingly.
+# Key aspects every provider is rated on, with what the rating looks at
+KEY_ASPECTS = {
+    "Overall Quote clarity and completeness": "the proposed approach meets the scope and is presented in a clear and organized manner",
+    "Overall Solution approach correctness and alignment": "correctness of the solution or technical approach and its alignment with the scope of work",
+    "Relevant experience": "documented staff expertise and experience delivering similar scope with other customers",
+    "Previous work": "examples of work, methodology, client testimonials and references relevant to the customer's industry and project",
+    "Migration Plan": "report/data sources consolidation, migration report validation, best practices and lessons learned",
+    "Users and Security Controls Migration": "migration of users, roles and security controls",
+    "QA Plan": "success criteria and validation methodology",
+    "Training and Knowledge Transfer": "training, documentation and knowledge transfer to the customer's team",
+    "Services and Deliverables": "alignment of the services and deliverables with the RFQ, gaps and additional offerings",
+    "Fee Structure": "proposed cost, transparency of the fee structure, payment terms and milestones against the budget",
+    "Capabilities": "expertise, technical proficiency, qualifications and certifications for this project",
+    "Client Testimonials and Case Studies": "relevance of testimonials and case studies to the project goals",
+    "Evaluation Criteria Alignment": "alignment with the evaluation criteria set out in the RFQ",
+    "Innovation and Value Additions": "innovations, features or value-added services beyond the core requirements",
+    "Risk Management": "identified risks and mitigation strategies",
+    "Support and Maintenance": "post-project support, customer service, SLAs and maintenance",
+    "Timeline and Delivery Schedule": "realism of the timeline and alignment with the customer's deadlines",
+    "Compliance and Certifications": "required certifications and regulatory compliance",
+}
+RATING_SCALE = {
+    1: "Did not meet expectations.",
+    2: "Approach Provided.",
+    3: "Measurable Approach.",
+    4: "Measurable with Mitigation provided for success.",
+    5: "Met all expectations with investment into the customer's success, and a mitigation with key success outcome outlined.",
+}
+RATING_ATTEMPTS = 2  # requests per provider before invalid ratings fail the run
+RANK_NARRATIVE = os.getenv("RANK_NARRATIVE", "1") == "1"  # short written recommendation under the computed ranking
+NARRATIVE_PROVIDERS = 3  # top-ranked providers detailed in the narrative's prompt
+NARRATIVE_ITEMS = 3  # strengths, weaknesses, best and worst aspects per detailed provider
+NARRATIVE_ITEM_CHARS = 200  # characters kept of each strength, weakness or comment
 
-        Please ensure that you do a very detailed study of the responses and provide a very detailed comments for each of the evaluation criteria for 
-        all providers and call out what is good or outstanding in the response for this evaluation criteria and what is missing or lacking in the response 
-        against each of the evaluation criteria for all providers. 
-        Always look out for details and come up with comprehensive and detailed comments that can enable the
-        team to take a decision to finalize the provider. 
-        Call out the strength and weakness of all providers accross each of the evaluation criteria.
+def aspectKey(aspect):
+    return re.sub(r"[^a-z0-9]+", "_", aspect.lower()).strip("_")
 
-            1.  Overall Quote clarity and completeness: proposed approach must meet the scope and be presented in a clear and organized manner
-            2. 	Overall Solution approach correctness and alignment with the scope of work: Highlight the key aspect that stands out in the solution approach or technical solution proposed by each provider
-            3. 	Services and Deliverables: Compare whether each provider's response aligns with the requested services and deliverables outlined in the RFQ. Identify gaps or misalignments, and highlight any additional offerings that provide added value beyond the project scope.
-            4.	Relevant experience: Supplier must provide descriptions and documentation of staff expertise and experience and relevant experience delivering similar scope with other customers
-            5.	Previous work: Suppliers will be evaluated on examples of their work, methodology, as well as client testimonials and references. Review the relevance of client testimonials and case studies to the customer’s industry and project context.Evaluate how these references support the vendor's ability to meet project goals. And provider relevant justifications and call outs
+# Structured output format of the ratings: a score and a comment per key aspect, plus strengths,
+# weaknesses and the RFQ asks the response misses
+def ratingsFormat():
+    rating = {"type": "object", "properties": {"comment": {"type": "string"}, "score": {"type": "integer", "enum": list(RATING_SCALE)}},
+              "required": ["comment", "score"], "additionalProperties": False}
+    texts = {"type": "array", "items": {"type": "string"}}
+    keys = [aspectKey(aspect) for aspect in KEY_ASPECTS]
+    schema = {
+        "type": "object",
+        "properties": {
+            "ratings": {"type": "object", "properties": {key: rating for key in keys}, "required": keys, "additionalProperties": False},
+            "strengths": texts, "weaknesses": texts, "missing": texts,
+        },
+        "required": ["ratings", "strengths", "weaknesses", "missing"],
+        "additionalProperties": False,
+    }
+    return {"type": "json_schema", "json_schema": {"name": "provider_ratings", "strict": True, "schema": schema}}
 
-            6.	Value: Suppliers will be evaluated on the proposed cost, transparency of fee structure, performance incentive, based on the work to be performed in accordance with the scope of services requested.Analyze the proposed fee structures, focusing on transparency, alignment with customer expectations, and reasonableness.Evaluate whether payment terms and milestones are clearly defined and aligned with the customer’s budget. Clealry call out the outstanding aspects of the response and the aspects that are lacking or missing on this topic in the response
+RATINGS_FORMAT = ratingsFormat()
 
-            7. Capabilities:Assess each provider's expertise, experience, and technical proficiency based on the response, Compare qualifications, certifications, and experience with similar projects to identify the vendor best positioned for success.Provide a detailed comment on what stands out and what is missing or needs improvement
-            8.	Response completeness and alignement with the ask/scope
-                Provide a detailed assessment of the responses across the aspects listed below
-                        
-                    - Migration Plan
-                    - Report/Data Sources Consolidation
-                    - Migration Report Validation
-                    - Best practices and lessons learned
-                    - Users and Security Controls Migration
-                    - Power BI Architecture Design
-                    - Performance Evaluation and proposed Optimization
-                    - Non-Functional Requirements (NFRs) and Performance assessments/optimizations criteria
-                    - QA Plan
-                    - Success criteria and Validation methodology
-                    - Training and Knowledge Transfer
-
-            And clearly summarize and call out or highlight the good approaches followed by each of the supplier/provider across all the above aspects in their response and what are the shortcomings in their approach to address the above points
-
-            9.	Innovation and Value Additions: Assess any unique innovations, features, or value-added services proposed by each vendor.
-            10.	Risk Management: Compare how vendors have addressed potential risks and provided mitigation strategies.
-            11.	Support and Maintenance: Evaluate post-project support plans, including customer service, training, and maintenance.
-            12.	Timeline and Delivery Schedule: Assess the realism of proposed timelines and alignment with customer exp
-                
-            13. Pros and Cons:
-                - Detail the strengths and weaknesses of each provider’s response based on the evaluation criteria.
-
-            14. Alignment with the RFQ asks:
-                - Identify any critical aspects from the RFQ that are missing or inadequately addressed in each provider's response.Provide clear justification of what is aligned and what is missing in the responses
-
-            15. Ranking:
-                - Rank the providers from best to worst based on the combined score and evaluation criteria.
-                - Justify the rankings with clear reasoning based on strengths, weaknesses, and alignment with customer needs.
-            
-            16. Migration Plan
-                - Report/Data Sources Consolidation
-                - Migration Report Validation
-                - Best practices and lessons learned
-                
-            17. Users and Security Controls Migration
-            
-            18. QA Plan
-                - Success criteria and Validation methodology
-            
-            19. Training and Knowledge Transfer
-
-            ### Table 1: Comments on Key Aspects
-            For each key aspect, provide a detailed comment for each provider describing their strengths, weaknesses, and performance.
-
-            | Key Aspect                          | Provider1                  | Provider2                  |    Provider3               |
-            |-------------------------------------|----------------------------|----------------------------|----------------------------|
-            | Overall Quote clarity and completeness           |                            |                            |                            |
-            | Overall Solution approach correctness and alignment           |                            |                            |                            |
-            | Relevant experience           |                            |                            |                            |
-            | Previous work           |                            |                            |                            |
-            | Migration Plan                      |                            |                            |                            |
-            | Users and Security Controls Migration|                            |                            |                            |
-            | QA Plan                             |                            |                            |                            |
-            | Training and Knowledge Transfer     |                            |                            |                            |
-            | Services and Deliverables           |                            |                            |                            |
-            | Fee Structure                       |                            |                            |                            |
-            | Capabilities                        |                            |                            |                            |
-            | Client Testimonials and Case Studies|                            |                            |                            |
-            | Evaluation Criteria Alignment       |                            |                            |                            |
-            | Innovation and Value Additions      |                            |                            |                            |
-            | Risk Management                     |                            |                            |                            |
-            | Support and Maintenance             |                            |                            |                            |
-            | Timeline and Delivery Schedule      |                            |                            |                            |
-            | Compliance and Certifications        |                            |                            |                            |
-            | Pros and Cons                       |                            |                            |                            |
-            | Missing Key Aspects                 |                            |                            |                            |
-            
-            Also add other evaluation criteria from the customer evaluation criterias
-            
-            ### Table 2: Ratings on Key Aspects
-            For each key aspect, rate the providers on a scale of 1 to 5 based on the following criteria:
-                1 - Did not meet expectations.
-                2 - Approach Provided.
-                3 - Measurable Approach.
-                4 - Measurable with Mitigation provided for success.
-                5 - Met all expectations with investment into Veolia's success, and a mitigation with key success outcome outlined.
-            
-            After assigning ratings to each key aspect, calculate the **combined score** for each provider by summing their ratings across all aspects. 
-            Rank the providers based on their combined score and explain the reasoning behind the ranking.
-
-            | Key Aspect                          | Provider1 (Score)         | Provider2 (Score)         | Provider3 (Score)         |
-            |-------------------------------------|---------------------------|---------------------------|---------------------------|
-            | Overall Quote clarity and completeness           |                            |                            |                            |
-            | Overall Solution approach correctness and alignment           |                            |                            |                            |
-            | Relevant experience           |                            |                            |                            |
-            | Previous work           |                            |                            |                            |
-            | Migration Plan                      |                            |                            |                            |
-            | Users and Security Controls Migration|                            |                            |                            |
-            | QA Plan                             |                            |                            |                            |
-            | Training and Knowledge Transfer     |                            |                            |                            |
-            | Services and Deliverables           |                           |                           |                           |
-            | Fee Structure                       |                           |                           |                           |
-            | Capabilities                        |                           |                           |                           |
-            | Client Testimonials and Case Studies|                           |                           |                           |
-            | Evaluation Criteria Alignment       |                           |                           |                           |
-            | Innovation and Value Additions      |                           |                           |                           |
-            | Risk Management                     |                           |                           |                           |
-            | Support and Maintenance             |                           |                           |                           |
-            | Timeline and Delivery Schedule      |                           |                           |                           |
-            | Compliance and Certifications        |                           |                           |                           |
-            | Pros and Cons                       |                           |                           |                           |
-            | Missing Key Aspects                 |                           |                           |                           |
-            | **Combined Score**                  |                           |                           |                           |
-            
-            
-            Also add other evaluation criteria from the customer evaluation criterias for scoring.
-            
-    ### Ranking:
-    After calculating the combined score, rank the providers from best to worst. Justify the ranking by analyzing their strengths, weaknesses, 
-    and overall alignment with the customer's needs.
-    
-    The tables should be detailed but easy to understand. Conclude by explaining the final ranking and why the top-ranked provider
-    is the best based on the evaluation.
-"""
+# Validates a ratings answer against RATINGS_FORMAT; returns {"ratings": {aspect: {"score", "comment"}},
+# "strengths", "weaknesses", "missing"} with the aspects by name, or raises ValueError
+def parseRatings(content):
+    try:
+        data = json.loads(content)
+    except ValueError as e:
+        raise ValueError(f"Ratings are not JSON: {e}")
+    if not isinstance(data, dict) or not isinstance(data.get("ratings"), dict):
+        raise ValueError("Ratings object missing")
+    ratings = {}
+    for aspect in KEY_ASPECTS:
+        entry = data["ratings"].get(aspectKey(aspect))
+        if not isinstance(entry, dict) or type(entry.get("score")) is not int or entry["score"] not in RATING_SCALE \
+                or not isinstance(entry.get("comment"), str):
+            raise ValueError(f"Invalid rating for {aspect}: {entry!r}")
+        ratings[aspect] = {"score": entry["score"], "comment": entry["comment"].strip()}
+    parsed = {"ratings": ratings}
+    for field in ("strengths", "weaknesses", "missing"):
+        values = data.get(field)
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            raise ValueError(f"Invalid {field}: {values!r}")
+        parsed[field] = [value.strip() for value in values]
+    return parsed
+
+# Ratings of one provider from its 1-2-1 comparison; providers are rated concurrently by their
+# comparison tasks, the scores are added up locally by rankProviders
+def rateProvider(comparison, run=None, target=None):
+    aspects = "\n".join(f"            - {aspect}: {description}" for aspect, description in KEY_ASPECTS.items())
+    scale = "\n".join(f"            {score} - {meaning}" for score, meaning in RATING_SCALE.items())
+    instructions = f"""
+        You are rating a provider's response to an RFQ (Request for Quotation) or RFP, based on its detailed comparison with the customer's RFQ in <comparison>.
+
+        Rate the response on each of the following key aspects:
+{aspects}
+
+        Use this scale:
+{scale}
+
+        For every aspect write a detailed comment calling out what is good or outstanding in the response and what is missing or lacking, and give the score.
+        If the comparison does not cover an aspect, score it 1 and say so in the comment.
+        Also list the main strengths and weaknesses of the response, and the critical aspects of the RFQ it misses or addresses inadequately.
+    """
+    messages = [{"role": "system", "content": instructions}, {"role": "user", "content": f"<comparison>\n{comparison}\n</comparison>"}]
+    for attempt in range(1, RATING_ATTEMPTS + 1):
+        try:
+            return parseRatings(chatCompletion(messages, temperature=0, run=run, stage="rate", target=target,
+                                               response_format=RATINGS_FORMAT, validate=parseRatings))
+        except ValueError as e:
+            if attempt == RATING_ATTEMPTS:
+                raise
+            print("--debug invalid ratings, requesting them again",target,e)
+
+def markdownTable(columns, rows):
+    lines = ["| " + " | ".join(columns) + " |", "|" + "|".join("---" for _ in columns) + "|"]
+    lines += ["| " + " | ".join(" ".join(str(cell).split()).replace("|", "\\|") for cell in row) + " |" for row in rows]
+    return "\n".join(lines)
+
+# Comments and ratings tables, combined scores and ranking, computed from the providers' ratings
+def scoreReport(ratings, scores, ranking):
+    providers = list(ratings)
+    comments = [[aspect] + [ratings[provider]["ratings"][aspect]["comment"] for provider in providers] for aspect in KEY_ASPECTS]
+    comments.append(["Pros and Cons"] + [f"Pros: {'; '.join(ratings[provider]['strengths']) or 'none'}. "
+                                         f"Cons: {'; '.join(ratings[provider]['weaknesses']) or 'none'}." for provider in providers])
+    comments.append(["Missing Key Aspects"] + ["; ".join(ratings[provider]["missing"]) or "None" for provider in providers])
+    scoreRows = [[aspect] + [ratings[provider]["ratings"][aspect]["score"] for provider in providers] for aspect in KEY_ASPECTS]
+    scoreRows.append(["**Combined Score**"] + [f"**{scores[provider]}**" for provider in providers])
+    maximum = max(RATING_SCALE) * len(KEY_ASPECTS)
+    return "\n".join([
+        "## Comments on Key Aspects",
+        markdownTable(["Key Aspect"] + providers, comments),
+        "",
+        "## Ratings on Key Aspects",
+        "Scale: " + " ".join(f"{score} - {meaning}" for score, meaning in RATING_SCALE.items()),
+        "",
+        markdownTable(["Key Aspect"] + [f"{provider} (Score)" for provider in providers], scoreRows),
+        "",
+        "## Ranking",
+        *[f"{position}. {provider}: {scores[provider]} of {maximum}" for position, provider in enumerate(ranking, start=1)],
+    ])
+
+def clip(text, limit=NARRATIVE_ITEM_CHARS):
+    return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + "..."
+
+# What the narrative is written from: the ranking with every combined score, and for the top
+# NARRATIVE_PROVIDERS only their best and worst rated aspects, strengths and weaknesses, each
+# clipped, so the prompt stays the same size however many providers responded
+def narrativeDigest(ratings, scores, ranking):
+    maximum = max(RATING_SCALE) * len(KEY_ASPECTS)
+    lines = ["Ranking by combined score:"]
+    lines += [f"{position}. {provider}: {scores[provider]} of {maximum}" for position, provider in enumerate(ranking, start=1)]
+    for provider in ranking[:NARRATIVE_PROVIDERS]:
+        # stable sorts: equal scores keep the order of KEY_ASPECTS
+        aspects = list(ratings[provider]["ratings"].items())
+        best = sorted(aspects, key=lambda item: -item[1]["score"])[:NARRATIVE_ITEMS]
+        worst = sorted(aspects, key=lambda item: item[1]["score"])[:NARRATIVE_ITEMS]
+        lines += ["", f"## {provider}",
+                  *[f"- Best rated: {aspect} ({rating['score']}): {clip(rating['comment'])}" for aspect, rating in best],
+                  *[f"- Worst rated: {aspect} ({rating['score']}): {clip(rating['comment'])}" for aspect, rating in worst],
+                  *[f"- Strength: {clip(value)}" for value in ratings[provider]["strengths"][:NARRATIVE_ITEMS]],
+                  *[f"- Weakness: {clip(value)}" for value in ratings[provider]["weaknesses"][:NARRATIVE_ITEMS]]]
+    return "\n".join(lines)
+
+# Short written recommendation on top of the computed ranking; it does not change the scores
+def rankingNarrative(digest, run=None, output=None):
+    instructions = """
+        You are given the evaluation of the providers' responses to an RFQ (Request for Quotation) or RFP in <evaluation>:
+        the ranking and combined scores computed from ratings from 1 to 5 per key aspect and, for the top-ranked providers,
+        their best and worst rated aspects with the rating comments and their main strengths and weaknesses.
+
+        Write a short recommendation of at most 250 words: justify the ranking with the decisive strengths and weaknesses of the providers
+        and explain why the top-ranked provider is the best choice. Do not list the scores aspect by aspect and do not change the scores or the ranking.
+    """
+    messages = [{"role": "system", "content": instructions}, {"role": "user", "content": f"<evaluation>\n{digest}\n</evaluation>"}]
+    return chatCompletion(messages, temperature=0.3, run=run, output=output, stage="rank")
+
+# Files and tasks every provider leaves in the output folder
+PROVIDER_OUTPUTS = ("_summary.md", "_comparison.md", "_ratings.json")
+PROVIDER_TASKS = ("_summary", "_comparison")
+
+# Removes the outputs, stages.json entries and passage index of the providers of earlier runs
+# whose folder is gone from the workspace, so the folder and the results store match this run
+def pruneProviders(run, providers):
+    stale = {name[:-len(suffix)] for name in run.stageManifest for suffix in PROVIDER_TASKS if name.endswith(suffix)}
+    stale |= {name[:-len(suffix)] for name in os.listdir(run.outputDir) for suffix in PROVIDER_OUTPUTS if name.endswith(suffix)}
+    stale -= set(providers)
+    for provider in sorted(stale):
+        print("--debug provider removed from the workspace",provider)
+        for suffix in PROVIDER_OUTPUTS:
+            path = run.outputPath(f"{provider}{suffix}")
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(os.path.join(RETRIEVAL_INDEX_DIR, run.fileId, provider), ignore_errors=True)
+    if stale:
+        run.forgetTasks([f"{provider}{suffix}" for provider in stale for suffix in PROVIDER_TASKS])
+
+def run_analysis(fileId, mode=SUMMARY_MODE, refresh=False, onEvent=None, stream=False, batch=False, compare_mode=COMPARE_MODE,
+                 models=None):
+    """Runs the full RFQ evaluation for the workspace ./docs/{fileId} in-process.
+
+    Writes the markdown outputs to ./markdown/{fileId}/ and returns the customer
+    summary, the provider summaries, the 1-2-1 comparisons, the ratings behind the
+    scores and the final response.
+    `onEvent` receives a progress event dict at the start and end of every stage.
+    With `stream`, summaries, comparisons and the recommendation are written to
+    their markdown files token by token (a retrieval comparison section by section,
+    then its conclusion) and the time to first token of every stage is recorded.
+    Wall time per stage, tokens, estimated cost, cache hits and retries of every
+    completion are written to ./markdown/{fileId}/metrics.json and returned in `metrics`.
+    With `batch`, the independent requests of each stage (chunk summaries, merges,
+    comparisons, ratings) go through the Batch API at half the price and the
+    pipeline resumes when each batch completes; this is meant for offline re-scoring.
+    Each comparison is rated per key aspect as schema-validated JSON; the combined
+    scores, ranking and tables are computed locally, with a short written
+    recommendation from the model unless RANK_NARRATIVE=0.
+    With `compare_mode` "retrieval", the documents are also indexed into passages
+    (persisted under RETRIEVAL_INDEX_DIR) and each comparison criterion is assessed
+    from the top passages of both sides; "summary" compares the two summaries.
+    Every task result is recorded in ./markdown/{fileId}/stages.json with a fingerprint
+    of its inputs; a rerun reuses the tasks whose inputs did not change (unless
+    `refresh`), e.g. a revised proposal only recomputes that provider's summary,
+    its comparison and the ranking. Reused tasks are listed in `reused_stages`.
+    `models` overrides STAGE_MODELS for this run, e.g. {"summarize": "gpt-4o-mini"};
+    stages other than summarize, compare and rank raise ValueError. The routing
+    used is returned in `models`.
+    The finished run is indexed with the providers' combined scores in the
+    results store (RESULTS_DB), where the app lists past evaluations.
+    """
+    run = AnalysisRun(fileId, mode=mode, refresh=refresh, onEvent=onEvent, stream=stream, batch=batch, compareMode=compare_mode,
+                      models=models)
+    #dir for markdown files
+    os.makedirs(run.outputDir, exist_ok=True)
+    customerPaths, providerPaths = loadWorkspace(run)
+    run.loadStageManifest()
+    fingerprints = taskFingerprints(run, customerPaths, providerPaths)
+
+    def task(name, outputName, stages, target, fn):
+        return partial(memoizedTask, run, name, fingerprints[name], outputName, stages, target, fn)
+
+    # Customer and provider summaries run concurrently, each 1-2-1 comparison starts as soon as
+    # its provider summary and the customer summary are ready, the ranking waits for all of them
+    pipelineTasks = {"customer": (task("customer", 'RFQ_customerSummary.md', ("chunk", "summarize"), "customer",
+                                       partial(summarizeCustomer, run, customerPaths)), [])}
+    for provider, paths in providerPaths.items():
+        pipelineTasks[f"{provider}_summary"] = (task(f"{provider}_summary", f'{provider}_summary.md', ("chunk", "summarize"), provider,
+                                                     partial(summarizeProvider, run, provider, paths)), [])
+        pipelineTasks[f"{provider}_comparison"] = (task(f"{provider}_comparison", f'{provider}_comparison.md', ("compare",), provider,
+                                                        partial(compareProvider, run, provider)),
+                                                   [f"{provider}_summary", "customer"])
+    pipelineTasks["final"] = (task("final", 'finalResponse.md', ("rank",), None, partial(rankProviders, run, list(providerPaths))),
+                              [f"{provider}_comparison" for provider in providerPaths])
+
+    # in batch mode every provider waits on the same batches instead of a free stage slot
+    results = runTaskGraph(pipelineTasks, max_workers=len(pipelineTasks) if batch else PIPELINE_MAX_WORKERS)
+
+    pruneProviders(run, providerPaths)
+    # finalResponse
+    finalResponse = results["final"]
 
-# Call the OpenAI API for the completion
-final_recommendation = openai_client.chat.completions.create(
-    model="gpt-4o",
-    messages=[{"role": "user", "content": best_rfqResponse_prompt}],
-    temperature=0.3,
-    stream=False,
-)
+    if finalResponse and len(finalResponse) > 0:
+        write_to_file(run.outputPath('finalResponse.md'), [finalResponse])
 
-# finalResponse
-finalResponse = final_recommendation.choices[0].message.content
+    print("Final Analysis:", finalResponse)
+    print("--debug llm cache", llm_cache.stats())
+    print("--debug llm client", llm.stats())
+    if batch:
+        print("--debug llm batches", llm_batch.stats())
+    print("--debug document cache", doc_cache.stats())
+    metrics = run.metrics.report()
+    with open(run.outputPath('metrics.json'), 'w') as file:
+        json.dump({**metrics, "parsing": run.parseReport, "time_to_first_token": run.timeToFirstToken,
+                   "reused_stages": run.reusedStages, "models": run.models}, file, indent=2)
+    registry.observe_run(metrics)
+    try:
+        resultsStore().record_run(fileId, run.outputDir, {provider: results[f"{provider}_comparison"]["ratings"] for provider in providerPaths},
+                                 metrics, run.models)
+    except sqlite3.Error as e:
+        print("--debug results store not updated",e)
+    print("--debug run metrics", metrics["totals"])
+    return {
+        "fileId": fileId,
+        "customer_summary": results["customer"],
+        "provider_summaries": {provider: results[f"{provider}_summary"] for provider in providerPaths},
+        "comparisons": {provider: results[f"{provider}_comparison"]["comparison"] for provider in providerPaths},
+        "ratings": {provider: results[f"{provider}_comparison"]["ratings"] for provider in providerPaths},
+        "final_response": finalResponse,
+        "time_to_first_token": run.timeToFirstToken,
+        "parsing": run.parseReport,
+        "reused_stages": run.reusedStages,
+        "models": run.models,
+        "metrics": metrics,
+    }
 
-if finalResponse and len(finalResponse) > 0:
-    write_to_file(f'./markdown/{fileId}/finalResponse.md', [finalResponse])
 
-print("Final Analysis:", finalResponse)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Example script")
+    parser.add_argument('--filename', type=str, help='Your file name')
+    parser.add_argument('--mode', type=str, choices=["mapreduce", "refine"], default=SUMMARY_MODE,
+                        help='mapreduce: summarize chunks concurrently and merge in a tree, refine: update one summary chunk by chunk')
+    parser.add_argument('--refresh', action='store_true', default=os.getenv("LLM_CACHE_BYPASS", "") == "1",
+                        help='Ignore cached completions and parsed documents and compute fresh ones (results are still written to the caches)')
+    parser.add_argument('--stream', action='store_true', help='Write outputs token by token as they are generated')
+    parser.add_argument('--batch', action='store_true', help='Send the requests of each stage through the Batch API (slower, half the price)')
+    parser.add_argument('--compare-mode', type=str, choices=["retrieval", "summary"], default=COMPARE_MODE,
+                        help='retrieval: assess each criterion on the indexed passages of both sides, summary: compare the summaries in one call')
+    parser.add_argument('--summary-model', type=str, default=STAGE_MODELS["summarize"], help='Model of the chunk summaries and merges')
+    parser.add_argument('--compare-model', type=str, default=STAGE_MODELS["compare"], help='Model of the comparisons and ratings')
+    parser.add_argument('--rank-model', type=str, default=STAGE_MODELS["rank"], help='Model of the written recommendation')
+    args = parser.parse_args()
+    run_analysis(args.filename, mode=args.mode, refresh=args.refresh, stream=args.stream, batch=args.batch, compare_mode=args.compare_mode,
+                 models={"summarize": args.summary_model, "compare": args.compare_model, "rank": args.rank_model})
 
 
 
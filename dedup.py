@@ -0,0 +1,103 @@
+import os
+import re
+import hashlib
+from array import array
+from collections import OrderedDict
+
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.8))  # estimated Jaccard similarity above which a paragraph is dropped; 0 disables
+DEDUP_MIN_TOKENS = int(os.getenv("DEDUP_MIN_TOKENS", 40))  # shorter paragraphs (headings, captions, table rows) are always kept
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", 10000))  # most recent kept paragraphs compared against, bounds the filter's memory
+DEDUP_SHINGLE_WORDS = 5
+DEDUP_BINS = 64  # signature length, a power of two
+DEDUP_BANDS = 16  # LSH bands of DEDUP_BINS // DEDUP_BANDS rows each
+
+WORD = re.compile(r"\w+")
+EMPTY = (1 << 64) - 1  # signature value of a bin no shingle fell into
+
+
+def shingles(words, size=DEDUP_SHINGLE_WORDS):
+    if len(words) <= size:
+        return {tuple(words)}
+    return set(zip(*(words[i:] for i in range(size))))
+
+
+# One-permutation MinHash: every shingle hash lands in one of DEDUP_BINS bins by its low bits
+# and each bin keeps the smallest of the remaining bits, one pass over the shingles instead of
+# one per permutation. hash() is salted per process, which is fine as signatures are never stored
+def signature(words):
+    values = [EMPTY] * DEDUP_BINS
+    shift = DEDUP_BINS.bit_length() - 1
+    for shingle in shingles(words):
+        h = hash(shingle) & EMPTY
+        slot, value = h & (DEDUP_BINS - 1), h >> shift
+        if value < values[slot]:
+            values[slot] = value
+    return array("Q", values)
+
+
+# Estimated Jaccard similarity of the shingle sets behind two signatures: the share of equal
+# bins among the bins that are not empty in both
+def similarity(first, second):
+    equal = filled = 0
+    for a, b in zip(first, second):
+        if a != EMPTY or b != EMPTY:
+            filled += 1
+            equal += a == b
+    return equal / filled if filled else 1.0
+
+
+class NearDuplicateFilter:
+    """Recognises paragraphs that repeat, nearly verbatim, one seen earlier in the same stream.
+
+    A paragraph whose normalised text was kept before is dropped outright, matched
+    on a 128-bit digest. Otherwise its word shingles are reduced to a MinHash
+    signature; locality sensitive hashing over bands of the signature finds the
+    earlier paragraphs that may match, and a candidate counts when the similarity
+    estimated from the two signatures reaches `threshold`. Only the digests and
+    signatures of the last `window` kept paragraphs are held, so memory stays
+    bounded however long the stream is; repeats further apart are kept.
+    """
+
+    def __init__(self, threshold=DEDUP_THRESHOLD, min_tokens=DEDUP_MIN_TOKENS, window=DEDUP_WINDOW):
+        self.threshold = threshold
+        self.min_tokens = min_tokens
+        self.window = window
+        self.rows = DEDUP_BINS // DEDUP_BANDS
+        self.kept = OrderedDict()  # paragraph number -> (digest, signature), oldest first
+        self.exact = {}  # digest -> paragraph number
+        self.buckets = {}  # band key -> paragraph number of the latest paragraph in that bucket
+        self.count = 0
+
+    # True when `text` duplicates an earlier paragraph; otherwise it is remembered
+    def is_duplicate(self, text, tokens):
+        if not self.threshold or tokens < self.min_tokens:
+            return False
+        words = WORD.findall(text.lower())
+        digest = hashlib.blake2b(" ".join(words).encode("utf-8"), digest_size=16).digest()
+        if digest in self.exact:
+            return True
+        values = signature(words)
+        keys = self.band_keys(values)
+        for number in {self.buckets[key] for key in keys if key in self.buckets}:
+            if similarity(values, self.kept[number][1]) >= self.threshold:
+                return True
+        self.remember(digest, values, keys)
+        return False
+
+    def band_keys(self, values):
+        return [hash((band, tuple(values[band * self.rows:(band + 1) * self.rows]))) for band in range(DEDUP_BANDS)]
+
+    def remember(self, digest, values, keys):
+        number = self.count
+        self.count += 1
+        self.kept[number] = (digest, values)
+        self.exact[digest] = number
+        for key in keys:
+            self.buckets[key] = number
+        while len(self.kept) > self.window:
+            old, (old_digest, old_values) = self.kept.popitem(last=False)
+            del self.exact[old_digest]
+            for key in self.band_keys(old_values):
+                # a later paragraph may have taken over the bucket
+                if self.buckets.get(key) == old:
+                    del self.buckets[key]
@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import Future
+
+BATCH_COLLECT_SECONDS = float(os.getenv("BATCH_COLLECT_SECONDS", 5))  # quiet time before the collected requests are submitted
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", 30))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 50000))  # Batch API limit per input file
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_TERMINAL = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchRequestFailed(Exception):
+    """A request came back from the batch with an error or not at all."""
+
+
+class BatchCollector:
+    """Turns blocking chat completions from many pipeline threads into Batch API jobs.
+
+    `complete` queues the request body and waits. Once no new request has arrived
+    for `collect_seconds` (every independent request of the current stage is then
+    queued, as its threads are all waiting) the queue is written to a JSONL file,
+    uploaded and submitted as one batch, polled every `poll_seconds`, and each
+    waiting thread is resumed with its response body. Later stages queue the next
+    batch the same way.
+    """
+
+    def __init__(self, openai_client, collect_seconds=BATCH_COLLECT_SECONDS, poll_seconds=BATCH_POLL_SECONDS,
+                 max_requests=BATCH_MAX_REQUESTS):
+        self.openai = openai_client
+        self.collect_seconds = collect_seconds
+        self.poll_seconds = poll_seconds
+        self.max_requests = max_requests
+        self.pending = []
+        self.lastQueued = 0.0
+        self.batches = []
+        self._changed = threading.Condition()
+        self._flusher = None
+
+    def complete(self, body):
+        future = Future()
+        with self._changed:
+            self.pending.append((f"request-{uuid.uuid4().hex}", body, future))
+            self.lastQueued = time.monotonic()
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                self._flusher.start()
+            self._changed.notify_all()
+        return future.result()
+
+    def _flush_loop(self):
+        while True:
+            with self._changed:
+                if not self.pending:
+                    self._flusher = None
+                    return
+                quiet = time.monotonic() - self.lastQueued
+                if quiet < self.collect_seconds and len(self.pending) < self.max_requests:
+                    self._changed.wait(self.collect_seconds - quiet)
+                    continue
+                requests, self.pending = self.pending[:self.max_requests], self.pending[self.max_requests:]
+            threading.Thread(target=self._run_batch, args=(requests,), daemon=True).start()
+
+    def _run_batch(self, requests):
+        futures = {customId: future for customId, _, future in requests}
+        try:
+            results = self.submit_and_wait(requests)
+        except Exception as e:
+            for future in futures.values():
+                future.set_exception(BatchRequestFailed(f"Batch failed: {e}"))
+            return
+        for customId, future in futures.items():
+            if customId in results:
+                future.set_result(results[customId])
+            else:
+                future.set_exception(BatchRequestFailed(f"No result for {customId}"))
+
+    def submit_and_wait(self, requests):
+        lines = [json.dumps({"custom_id": customId, "method": "POST", "url": "/v1/chat/completions", "body": body})
+                 for customId, body, _ in requests]
+        inputFile = self.openai.files.create(file=("requests.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+        batch = self.openai.batches.create(input_file_id=inputFile.id, endpoint="/v1/chat/completions",
+                                           completion_window=BATCH_COMPLETION_WINDOW)
+        started = time.perf_counter()
+        print("--debug batch submitted", batch.id, len(requests), "requests")
+        while batch.status not in BATCH_TERMINAL:
+            time.sleep(self.poll_seconds)
+            batch = self.openai.batches.retrieve(batch.id)
+        seconds = time.perf_counter() - started
+        print("--debug batch", batch.id, batch.status, f"after {seconds:.1f}s", batch.request_counts)
+        with self._changed:
+            self.batches.append({"id": batch.id, "status": batch.status, "requests": len(requests), "seconds": round(seconds, 3)})
+
+        # an expired batch still returns the requests it finished
+        results = {}
+        for fileId in (batch.output_file_id, batch.error_file_id):
+            if not fileId:
+                continue
+            for line in self.openai.files.content(fileId).text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                if response.get("status_code") == 200 and not entry.get("error"):
+                    results[entry["custom_id"]] = response["body"]
+        return results
+
+    def stats(self):
+        with self._changed:
+            return {"batches": list(self.batches), "pending": len(self.pending)}
@@ -0,0 +1,250 @@
+import os
+import re
+import time
+import random
+import threading
+from openai import RateLimitError, APIConnectionError, InternalServerError
+from chunking import count_tokens
+
+LLM_RPM = int(os.getenv("LLM_RPM", 0))  # requests per minute, 0: learn the limit from the response headers
+LLM_TPM = int(os.getenv("LLM_TPM", 0))  # tokens per minute, 0: learn the limit from the response headers
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 6))  # retries of a request after a 5xx or connection error
+LLM_MAX_RATE_LIMIT_RETRIES = int(os.getenv("LLM_MAX_RATE_LIMIT_RETRIES", 20))  # retries after a 429, which only asks to wait
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", 1.0))  # seconds, doubled on every retry
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", 60.0))
+LLM_COMPLETION_TOKENS_ESTIMATE = int(os.getenv("LLM_COMPLETION_TOKENS_ESTIMATE", 1000))  # reserved per request until usage is known
+
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+DURATION_PART = re.compile(r"([\d.]+)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+# "1s", "6m0s", "20ms" as sent in x-ratelimit-reset-* headers
+def parse_duration(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        parts = DURATION_PART.findall(value)
+        return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts) if parts else None
+
+
+def header_int(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Per-minute budget refilled continuously; `acquire` blocks until it fits.
+
+    Without a configured limit the bucket is unlimited until `sync` learns the
+    limit and the remaining budget from the API's rate-limit headers.
+    """
+
+    def __init__(self, per_minute=0):
+        self.configured = per_minute or None
+        self.capacity = self.configured
+        self.level = float(self.capacity or 0)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def acquire(self, amount):
+        while True:
+            with self._lock:
+                self._refill()
+                if not self.capacity:
+                    return
+                amount = min(amount, self.capacity)
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                wait = (amount - self.level) * 60 / self.capacity
+            time.sleep(min(wait, 1.0))
+
+    # Gives back (positive) or charges (negative) the difference once the real usage is known
+    def adjust(self, amount):
+        with self._lock:
+            self._refill()
+            if self.capacity:
+                self.level = min(self.capacity, self.level + amount)
+
+    def sync(self, limit, remaining):
+        with self._lock:
+            self._refill()
+            if limit and not self.configured:
+                if not self.capacity:
+                    self.level = float(limit)
+                self.capacity = limit
+            if remaining is not None and self.capacity:
+                self.level = min(self.level, remaining)
+
+
+class AdaptiveConcurrency:
+    """Gate on in-flight requests whose limit follows the API's feedback.
+
+    Additive increase while the rate-limit headers show headroom and halving on every
+    429; while a budget is nearly used up the limit holds and the token buckets pace
+    the requests.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.inFlight = 0
+        self._changed = threading.Condition()
+
+    def acquire(self):
+        with self._changed:
+            while self.inFlight >= max(self.minimum, int(self.limit)):
+                self._changed.wait()
+            self.inFlight += 1
+
+    def release(self):
+        with self._changed:
+            self.inFlight -= 1
+            self._changed.notify_all()
+
+    def on_headroom(self, fraction):
+        with self._changed:
+            if fraction > 0.25:
+                self.limit = min(self.maximum, self.limit + 1 / max(self.limit, 1))
+            self._changed.notify_all()
+
+    def on_rate_limited(self):
+        with self._changed:
+            self.limit = max(self.minimum, self.limit / 2)
+            print("--debug rate limited, concurrency down to", int(self.limit))
+
+
+class Completion:
+    """One chat completion under the client's limits, used as a context manager.
+
+    Entering waits for a concurrency slot and the request/token budgets, then sends
+    the request, retrying 429, 5xx and connection errors with jittered exponential
+    backoff (or the server's retry-after). The slot is held until exit, so streamed
+    responses are read under it; set `usage` before exit to settle the token budget.
+    """
+
+    def __init__(self, client, kwargs):
+        self.client = client
+        self.kwargs = kwargs
+        self.estimate = client.estimate_tokens(kwargs.get("messages", []))
+        self.response = None
+        self.usage = None
+        self.retries = 0
+        self.rateLimitRetries = 0
+        self.waitSeconds = 0.0
+        self.sentAt = None
+
+    def __enter__(self):
+        client = self.client
+        while True:
+            start = time.perf_counter()
+            client.concurrency.acquire()
+            client.requests.acquire(1)
+            client.tokens.acquire(self.estimate)
+            self.waitSeconds += time.perf_counter() - start
+            self.sentAt = time.perf_counter()
+            try:
+                raw = client.openai.chat.completions.with_raw_response.create(**self.kwargs)
+            except RETRYABLE_ERRORS as e:
+                client.concurrency.release()
+                rateLimited = isinstance(e, RateLimitError)
+                if rateLimited and self.rateLimitRetries >= client.max_rate_limit_retries:
+                    raise
+                if not rateLimited and self.retries - self.rateLimitRetries >= client.max_retries:
+                    raise
+                self.retries += 1
+                self.rateLimitRetries += 1 if rateLimited else 0
+                delay = client.backoff(self.retries, e)
+                print("--debug retrying completion",self.retries,type(e).__name__,f"in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            except Exception:
+                client.concurrency.release()
+                raise
+            # __exit__ only runs once __enter__ returned, so the slot is given back here if reading the response fails
+            try:
+                client.observe_headers(raw.headers)
+                self.response = raw.parse()
+            except BaseException:
+                client.concurrency.release()
+                raise
+            return self
+
+    def __exit__(self, *exc):
+        self.client.concurrency.release()
+        if self.usage:
+            self.client.tokens.adjust(self.estimate - self.usage["prompt_tokens"] - self.usage["completion_tokens"])
+        return False
+
+
+class RateLimitedClient:
+    """Shared layer over an OpenAI client for every pipeline thread.
+
+    Requests/min and tokens/min token buckets (configured or learned from the
+    x-ratelimit-* headers), adaptive concurrency and retries with backoff.
+    """
+
+    def __init__(self, openai_client, max_concurrency, requests_per_minute=LLM_RPM, tokens_per_minute=LLM_TPM,
+                 max_retries=LLM_MAX_RETRIES, max_rate_limit_retries=LLM_MAX_RATE_LIMIT_RETRIES, model="gpt-4o"):
+        self.openai = openai_client
+        self.model = model
+        self.max_retries = max_retries
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.rateLimited = 0
+        self._lock = threading.Lock()
+
+    def completion(self, **kwargs):
+        return Completion(self, kwargs)
+
+    def estimate_tokens(self, messages):
+        prompt = "\n".join(str(message.get("content") or "") for message in messages)
+        return count_tokens(prompt, self.model) + LLM_COMPLETION_TOKENS_ESTIMATE
+
+    def backoff(self, attempt, error):
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        retryAfter = header_int(headers, "retry-after-ms")
+        retryAfter = retryAfter / 1000 if retryAfter is not None else parse_duration(headers.get("retry-after"))
+        if isinstance(error, RateLimitError):
+            with self._lock:
+                self.rateLimited += 1
+            self.concurrency.on_rate_limited()
+            self.requests.sync(header_int(headers, "x-ratelimit-limit-requests"), header_int(headers, "x-ratelimit-remaining-requests"))
+            self.tokens.sync(header_int(headers, "x-ratelimit-limit-tokens"), header_int(headers, "x-ratelimit-remaining-tokens"))
+        # full jitter, but never earlier than the server asked for
+        delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** (attempt - 1)))
+        return max(delay, retryAfter or 0)
+
+    def observe_headers(self, headers):
+        fractions = []
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = header_int(headers, f"x-ratelimit-limit-{kind}")
+            remaining = header_int(headers, f"x-ratelimit-remaining-{kind}")
+            bucket.sync(limit, remaining)
+            if limit and remaining is not None:
+                fractions.append(remaining / limit)
+        if fractions:
+            self.concurrency.on_headroom(min(fractions))
+
+    def stats(self):
+        return {
+            "concurrency_limit": int(self.concurrency.limit),
+            "in_flight": self.concurrency.inFlight,
+            "rate_limited": self.rateLimited,
+            "requests_per_minute": self.requests.capacity,
+            "tokens_per_minute": self.tokens.capacity,
+        }
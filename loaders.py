@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from langchain_core.documents import Document
+from langchain_community.document_loaders import UnstructuredFileLoader
+from cache import DiskCache, hash_key
+
+# Bump when the parsing path changes so previously cached text is not reused
+PARSER_VERSION = 2
+DOC_CACHE_DIR = os.getenv("DOC_CACHE_DIR", "./cache/docs")
+DOC_CACHE_MAX_MB = int(os.getenv("DOC_CACHE_MAX_MB", 2048))
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", os.cpu_count() or 1))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", 10))  # larger PDFs are split into page ranges
+MIN_PAGE_TEXT_CHARS = int(os.getenv("MIN_PAGE_TEXT_CHARS", 20))  # pages with less extractable text are OCRed
+
+
+class ParsedDocumentCache(DiskCache):
+    """Extracted text and metadata keyed by the SHA-256 of the uploaded bytes.
+
+    Entries are zlib-compressed JSON; the parse time of the original run is stored
+    with them so hits can report how much parsing they saved.
+    """
+
+    def __init__(self, directory=DOC_CACHE_DIR, max_mb=DOC_CACHE_MAX_MB):
+        super().__init__(directory, max_mb * 1024 * 1024, name="docs")
+        self.parse_seconds = 0.0
+        self.parse_seconds_saved = 0.0
+        self._timing_lock = threading.Lock()
+
+    def load_documents(self, path, file_hash):
+        data = self.get(hash_key("parsed", PARSER_VERSION, file_hash))
+        if data is None:
+            return None
+        entry = json.loads(zlib.decompress(data))
+        with self._timing_lock:
+            self.parse_seconds_saved += entry["parse_seconds"]
+        # the same bytes may have been uploaded under another workspace or name
+        return [Document(page_content=doc["text"], metadata={**doc["metadata"], "source": path}) for doc in entry["docs"]]
+
+    def store_documents(self, file_hash, docs, parse_seconds):
+        with self._timing_lock:
+            self.parse_seconds += parse_seconds
+        entry = {
+            "parse_seconds": parse_seconds,
+            "docs": [{"text": doc.page_content, "metadata": doc.metadata} for doc in docs],
+        }
+        payload = json.dumps(entry, ensure_ascii=False, default=str).encode("utf-8")
+        self.set(hash_key("parsed", PARSER_VERSION, file_hash), zlib.compress(payload, 6))
+
+    def stats(self):
+        stats = super().stats()
+        stats["parse_seconds"] = round(self.parse_seconds, 2)
+        stats["parse_seconds_saved"] = round(self.parse_seconds_saved, 2)
+        return stats
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def list_files(directory):
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        paths.extend(os.path.join(root, file) for file in sorted(files) if not file.startswith("."))
+    return paths
+
+
+def parse_file(path):
+    return UnstructuredFileLoader(path).load()
+
+
+def pdf_page_ranges(path, pages_per_task=PDF_PAGES_PER_TASK):
+    if not path.lower().endswith(".pdf"):
+        return [None]
+    from pypdf import PdfReader
+    try:
+        page_count = len(PdfReader(path).pages)
+    except Exception as e:
+        print("--debug could not count pages, parsing whole file", path, e)
+        return [None]
+    if page_count <= pages_per_task:
+        return [None]
+    return [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+
+
+def read_txt(path):
+    with open(path, "r", encoding="utf-8", errors="replace") as file:
+        return file.read()
+
+
+# Paragraphs and tables in document order, so a table stays next to the text that refers to it
+def read_docx(path):
+    from docx import Document as DocxDocument
+    from docx.oxml.ns import qn
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+    document = DocxDocument(path)
+    blocks = []
+    for element in document.element.body.iterchildren():
+        if element.tag == qn("w:p"):
+            paragraph = Paragraph(element, document)
+            if paragraph.text.strip():
+                blocks.append(paragraph.text)
+        elif element.tag == qn("w:tbl"):
+            for row in Table(element, document).rows:
+                cells = [cell.text.strip() for cell in row.cells if cell.text.strip()]
+                if cells:
+                    blocks.append(" | ".join(cells))
+    return "\n\n".join(blocks)
+
+
+def read_xlsx(path):
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    sheets = []
+    for sheet in workbook.worksheets:
+        rows = []
+        for row in sheet.iter_rows(values_only=True):
+            cells = [str(value) for value in row if value is not None and str(value).strip()]
+            if cells:
+                rows.append("\t".join(cells))
+        if rows:
+            sheets.append(f"{sheet.title}\n" + "\n".join(rows))
+    workbook.close()
+    return "\n\n".join(sheets)
+
+
+# Partitions pages [start, end) of a PDF through a temporary PDF holding only those pages
+def parse_pdf_pages(reader, pages, **unstructured_kwargs):
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for page in reader.pages[pages[0]:pages[1]]:
+        writer.add_page(page)
+    with tempfile.TemporaryDirectory() as directory:
+        part_path = os.path.join(directory, f"pages_{pages[0]}_{pages[1]}.pdf")
+        with open(part_path, "wb") as file:
+            writer.write(file)
+        return UnstructuredFileLoader(part_path, **unstructured_kwargs).load()
+
+
+def ocr_pdf_page(reader, number):
+    docs = parse_pdf_pages(reader, (number, number + 1), strategy="ocr_only")
+    return "\n\n".join(doc.page_content for doc in docs).strip()
+
+
+# Uses the PDF text layer page by page and only OCRs pages without extractable text
+def read_pdf(path, pages=None):
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    start, end = pages or (0, len(reader.pages))
+    texts, ocr_pages = [], 0
+    for number in range(start, end):
+        text = (reader.pages[number].extract_text() or "").strip()
+        if len(text) < MIN_PAGE_TEXT_CHARS:
+            text = ocr_pdf_page(reader, number)
+            ocr_pages += 1
+        if text:
+            texts.append(text)
+    return "\n\n".join(texts), end - start, ocr_pages
+
+
+FAST_READERS = {".txt": read_txt, ".docx": read_docx, ".xlsx": read_xlsx}
+
+
+# Runs in the parse pool: extracts a whole file, or pages [start, end) of a PDF.
+# .txt/.docx/.xlsx and PDF text layers skip the unstructured partitioning stack,
+# which stays as the fallback for other types and for files the fast path can't read
+def parse_task(path, pages=None):
+    start = time.perf_counter()
+    extension = os.path.splitext(path)[1].lower()
+    result = {"pages": 0, "ocr_pages": 0}
+    try:
+        if extension in FAST_READERS:
+            result.update(texts=[(FAST_READERS[extension](path), {})], method=extension[1:])
+        elif extension == ".pdf":
+            text, page_count, ocr_pages = read_pdf(path, pages)
+            result.update(texts=[(text, {})], method="pdf", pages=page_count, ocr_pages=ocr_pages)
+    except Exception as e:
+        print("--debug fast path failed, falling back to unstructured", path, e)
+        result = {"pages": 0, "ocr_pages": 0}
+    if "texts" not in result:
+        if pages is None:
+            docs = parse_file(path)
+        else:
+            from pypdf import PdfReader
+            docs = parse_pdf_pages(PdfReader(path), pages)
+        result.update(texts=[(doc.page_content, doc.metadata) for doc in docs], method="unstructured")
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+_parse_pools = {}
+_parse_pools_lock = threading.Lock()
+
+
+# Pools are kept for the life of the process so warm workers reuse their parse processes
+def get_parse_pool(workers):
+    with _parse_pools_lock:
+        if workers not in _parse_pools:
+            _parse_pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _parse_pools[workers]
+
+
+# Starts the parse tasks of one file; the pool runs them while earlier files are consumed
+def submit_parse_tasks(tasks, workers):
+    if workers <= 1:
+        return None
+    pool = get_parse_pool(workers)
+    return [pool.submit(parse_task, path, pages) for path, pages in tasks]
+
+
+def collect_parsed_file(path, tasks, futures):
+    results = [future.result() for future in futures] if futures is not None else \
+        [parse_task(task_path, pages) for task_path, pages in tasks]
+    entry = {"texts": [], "methods": [], "seconds": 0.0, "pages": 0, "ocr_pages": 0}
+    for result in results:
+        entry["texts"].extend(result["texts"])
+        entry["methods"].append(result["method"])
+        for field in ("seconds", "pages", "ocr_pages"):
+            entry[field] += result[field]
+    if tasks[0][1] is not None:
+        # page ranges of one PDF are joined back like a single-mode partition
+        docs = [Document(page_content="\n\n".join(text for text, _ in entry["texts"]), metadata={"source": path})]
+    else:
+        docs = [Document(page_content=text, metadata={**metadata, "source": path}) for text, metadata in entry["texts"]]
+    return docs, entry
+
+
+def iter_documents(paths, doc_cache=None, refresh=False, workers=PARSE_WORKERS, parse_report=None, lookahead=None):
+    """Yields the documents of `paths` file by file, in order.
+
+    Files already seen are served from the parsed-document cache; the others, and
+    the page ranges of large PDFs, are partitioned on a process pool at most
+    `lookahead` files ahead of the consumer, so memory stays bounded by a few files
+    however large the submission is. `source` is always the uploaded path. When
+    `parse_report` is a list, one entry per file is appended with the parsing path
+    taken (cache, txt, docx, xlsx, pdf-text, pdf-mixed, pdf-ocr, unstructured) and
+    the time it took.
+    """
+    lookahead = lookahead or max(2, workers * 2)
+    pending = deque()
+
+    def start(path):
+        file_hash = file_sha256(path)
+        docs = None if doc_cache is None or refresh else doc_cache.load_documents(path, file_hash)
+        if docs is not None:
+            return path, file_hash, docs, None, None
+        tasks = [(path, pages) for pages in pdf_page_ranges(path)]
+        return path, file_hash, None, tasks, submit_parse_tasks(tasks, workers)
+
+    def finish(path, file_hash, docs, tasks, futures):
+        if docs is not None:
+            item = {"source": path, "method": "cache", "seconds": 0.0, "pages": 0, "ocr_pages": 0}
+        else:
+            docs, entry = collect_parsed_file(path, tasks, futures)
+            if doc_cache is not None:
+                doc_cache.store_documents(file_hash, docs, entry["seconds"])
+            item = {"source": path, "method": parse_method(entry), "seconds": round(entry["seconds"], 3),
+                    "pages": entry["pages"], "ocr_pages": entry["ocr_pages"]}
+        print("--debug parsed", item["source"], item["method"], f"{item['seconds']}s")
+        if parse_report is not None:
+            parse_report.append(item)
+        return docs
+
+    for path in paths:
+        pending.append(start(path))
+        if len(pending) >= lookahead:
+            yield from finish(*pending.popleft())
+    while pending:
+        yield from finish(*pending.popleft())
+
+
+# Same output as DirectoryLoader(directory).load(), see iter_documents
+def load_documents(directory, doc_cache=None, refresh=False, workers=PARSE_WORKERS, parse_report=None):
+    return list(iter_documents(list_files(directory), doc_cache, refresh, workers, parse_report))
+
+
+# pdf-text: text layer only, pdf-ocr: every page OCRed, pdf-mixed: OCR on some pages
+def parse_method(entry):
+    methods = set(entry["methods"])
+    if methods == {"pdf"}:
+        if entry["ocr_pages"] == 0:
+            return "pdf-text"
+        return "pdf-ocr" if entry["ocr_pages"] == entry["pages"] else "pdf-mixed"
+    return "+".join(sorted(methods))
@@ -0,0 +1,231 @@
+import os
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# USD per million (prompt, cached prompt, completion) tokens
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+}
+BATCH_PRICE_FACTOR = 0.5  # Batch API completions are billed at half price
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))  # 0: no Prometheus endpoint
+
+
+# cached_tokens is the part of prompt_tokens served from the API's prompt cache
+def llm_cost(model, prompt_tokens, completion_tokens, batch=False, cached_tokens=0):
+    prompt_price, cached_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0, 0.0))
+    cost = ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price
+            + completion_tokens * completion_price) / 1_000_000
+    return cost * BATCH_PRICE_FACTOR if batch else cost
+
+
+# Share of the prompt tokens served from the API's prompt cache
+def cached_token_ratio(cached_tokens, prompt_tokens):
+    return round(cached_tokens / prompt_tokens, 4) if prompt_tokens else 0.0
+
+
+class TimedIterator:
+    """Wraps an iterator and adds up the time spent producing its items."""
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.seconds = 0.0
+        self.items = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            item = next(self.iterator)
+        finally:
+            self.seconds += time.perf_counter() - start
+        self.items += 1
+        return item
+
+
+class RunMetrics:
+    """Wall time, token usage, cost, cache hits and retries of one analysis.
+
+    `record_stage` is called for timed spans (a stage of one target, the loader or
+    the splitter), `record_llm` once per completion, whether it was answered by the
+    cache or the API. `report` aggregates both per stage and keeps every call.
+    """
+
+    def __init__(self, fileId):
+        self.fileId = fileId
+        self.startedAt = time.time()
+        self.spans = []
+        self.calls = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record_stage(self, stage, target, seconds, **detail):
+        with self._lock:
+            self.spans.append({"stage": stage, "target": target, "seconds": round(seconds, 3), **detail})
+
+    def record_llm(self, stage, target, model, seconds, prompt_tokens=0, completion_tokens=0, cached=False, retries=0, batch=False,
+                   cached_tokens=0):
+        cost = llm_cost(model, prompt_tokens, completion_tokens, batch, cached_tokens)
+        with self._lock:
+            self.calls.append({
+                "stage": stage, "target": target, "model": model, "seconds": round(seconds, 3),
+                "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cached_tokens": cached_tokens,
+                "cached": cached, "retries": retries, "batch": batch,
+                # a cache hit costs nothing; its original cost is what the cache saved
+                "cost_usd": 0.0 if cached else cost,
+                "saved_usd": cost if cached else 0.0,
+            })
+
+    def report(self):
+        with self._lock:
+            spans, calls = list(self.spans), list(self.calls)
+        stages = {}
+
+        def stageEntry(stage):
+            return stages.setdefault(stage, {
+                "count": 0, "seconds": 0.0, "max_seconds": 0.0, "llm_calls": 0, "cache_hits": 0, "retries": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "cost_usd": 0.0, "saved_usd": 0.0,
+            })
+
+        for span in spans:
+            entry = stageEntry(span["stage"])
+            entry["count"] += 1
+            entry["seconds"] += span["seconds"]
+            entry["max_seconds"] = max(entry["max_seconds"], span["seconds"])
+        for call in calls:
+            entry = stageEntry(call["stage"])
+            entry["llm_calls"] += 1
+            if call["cached"]:
+                entry["cache_hits"] += 1
+                entry["saved_usd"] += call["saved_usd"]
+                continue
+            for field in ("retries", "prompt_tokens", "completion_tokens", "cached_tokens", "cost_usd"):
+                entry[field] += call.get(field, 0)
+        for entry in stages.values():
+            entry["cached_token_ratio"] = cached_token_ratio(entry["cached_tokens"], entry["prompt_tokens"])
+            for field in ("seconds", "max_seconds"):
+                entry[field] = round(entry[field], 3)
+            for field in ("cost_usd", "saved_usd"):
+                entry[field] = round(entry[field], 6)
+
+        billed = [call for call in calls if not call["cached"]]
+        promptTokens = sum(call["prompt_tokens"] for call in billed)
+        cachedTokens = sum(call.get("cached_tokens", 0) for call in billed)
+        return {
+            "fileId": self.fileId,
+            "started_at": self.startedAt,
+            "wall_seconds": round(time.perf_counter() - self._start, 3),
+            "totals": {
+                "llm_calls": len(calls),
+                "cache_hits": len(calls) - len(billed),
+                "retries": sum(call["retries"] for call in calls),
+                "prompt_tokens": promptTokens,
+                "completion_tokens": sum(call["completion_tokens"] for call in billed),
+                "cached_tokens": cachedTokens,
+                "cached_token_ratio": cached_token_ratio(cachedTokens, promptTokens),
+                "cost_usd": round(sum(call["cost_usd"] for call in calls), 6),
+                "saved_usd": round(sum(call["saved_usd"] for call in calls), 6),
+                # tokens of near-duplicate paragraphs the splitter kept out of the prompts
+                "dedup_tokens_saved": sum(span.get("dedup_tokens_saved", 0) for span in spans),
+            },
+            "stages": stages,
+            "spans": spans,
+            "calls": calls,
+        }
+
+
+class MetricsRegistry:
+    """Process-wide counters over finished runs, rendered in the Prometheus text format."""
+
+    COUNTERS = {
+        "docreader_runs_total": "Analyses finished",
+        "docreader_run_seconds_total": "Wall time of finished analyses",
+        "docreader_stage_seconds_total": "Time spent per stage",
+        "docreader_stage_spans_total": "Timed spans per stage",
+        "docreader_llm_calls_total": "Completions requested, including cache hits",
+        "docreader_llm_cache_hits_total": "Completions answered by the cache",
+        "docreader_llm_retries_total": "Retried completion requests",
+        "docreader_llm_prompt_tokens_total": "Prompt tokens billed",
+        "docreader_llm_completion_tokens_total": "Completion tokens billed",
+        "docreader_llm_cached_tokens_total": "Prompt tokens served from the API's prompt cache",
+        "docreader_llm_cost_usd_total": "Estimated cost of billed completions in USD",
+        "docreader_dedup_tokens_saved_total": "Tokens of near-duplicate paragraphs dropped before summarization",
+    }
+
+    def __init__(self):
+        self.values = {name: {} for name in self.COUNTERS}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def observe_run(self, report):
+        self.inc("docreader_runs_total")
+        self.inc("docreader_run_seconds_total", report["wall_seconds"])
+        for span in report["spans"]:
+            self.inc("docreader_stage_seconds_total", span["seconds"], stage=span["stage"])
+            self.inc("docreader_stage_spans_total", stage=span["stage"])
+            if span.get("dedup_tokens_saved"):
+                self.inc("docreader_dedup_tokens_saved_total", span["dedup_tokens_saved"])
+        for call in report["calls"]:
+            labels = {"stage": call["stage"], "model": call["model"]}
+            self.inc("docreader_llm_calls_total", **labels)
+            if call["cached"]:
+                self.inc("docreader_llm_cache_hits_total", **labels)
+                continue
+            self.inc("docreader_llm_retries_total", call["retries"], **labels)
+            self.inc("docreader_llm_prompt_tokens_total", call["prompt_tokens"], **labels)
+            self.inc("docreader_llm_completion_tokens_total", call["completion_tokens"], **labels)
+            self.inc("docreader_llm_cached_tokens_total", call.get("cached_tokens", 0), **labels)
+            self.inc("docreader_llm_cost_usd_total", call["cost_usd"], **labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, help in self.COUNTERS.items():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(self.values[name].items()):
+                    labels = ",".join(f'{label}="{labelValue}"' for label, labelValue in key)
+                    lines.append(f"{name}{{{labels}}} {value:g}" if labels else f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+_metrics_server = None
+
+
+# Serves registry.render() on http://<host>:<port>/metrics from a daemon thread, once per process
+def serve_metrics(port=METRICS_PORT, host="0.0.0.0"):
+    global _metrics_server
+    if _metrics_server is not None or not port:
+        return _metrics_server
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            data = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    _metrics_server = ThreadingHTTPServer((host, port), Handler)
+    _metrics_server.daemon_threads = True
+    threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    print("--debug metrics served on port", port)
+    return _metrics_server
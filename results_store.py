@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import glob
+import sqlite3
+import argparse
+from contextlib import closing
+
+RESULTS_DB = os.getenv("RESULTS_DB", "./markdown/results.sqlite3")  # index of finished analyses
+RESULTS_PAGE_SIZE = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    output_dir TEXT NOT NULL,
+    providers INTEGER NOT NULL,
+    top_provider TEXT,
+    top_score INTEGER,
+    wall_seconds REAL,
+    llm_calls INTEGER,
+    cost_usd REAL,
+    models TEXT,
+    UNIQUE (file_id, started_at)
+);
+CREATE INDEX IF NOT EXISTS runs_finished_at ON runs (finished_at DESC);
+CREATE INDEX IF NOT EXISTS runs_file_id ON runs (file_id, finished_at DESC);
+CREATE INDEX IF NOT EXISTS runs_top_score ON runs (top_score DESC);
+CREATE TABLE IF NOT EXISTS provider_scores (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    provider TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (run_id, provider)
+);
+CREATE INDEX IF NOT EXISTS provider_scores_provider ON provider_scores (provider, score DESC);
+"""
+
+
+# Combined score of one provider: the sum of its ratings on the key aspects
+def combined_score(ratings):
+    return sum(rating["score"] for rating in ratings["ratings"].values())
+
+
+class ResultsStore:
+    """SQLite index of finished analyses by workspace, provider, time and score.
+
+    Only the metadata of a run and the combined score and position of every
+    provider are stored; the outputs stay in the run's markdown folder. The
+    database is opened per call in WAL mode, so the worker processes can record
+    runs while the app lists them.
+    """
+
+    def __init__(self, path=RESULTS_DB):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with closing(self.connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA foreign_keys=ON")
+        return db
+
+    # Indexes one run; `ratings` is {provider: ratings} in submission order. A run recorded
+    # again (same workspace and start time) replaces its earlier entry
+    def record_run(self, file_id, output_dir, ratings, metrics, models=None):
+        scores = {provider: combined_score(ratings[provider]) for provider in ratings}
+        # stable sort: equal scores keep the submission order, as in the ranking
+        ranking = sorted(scores, key=lambda provider: -scores[provider])
+        totals = metrics.get("totals", {})
+        with closing(self.connect()) as db, db:
+            db.execute("DELETE FROM runs WHERE file_id = ? AND started_at = ?", (file_id, metrics["started_at"]))
+            cursor = db.execute(
+                "INSERT INTO runs (file_id, started_at, finished_at, output_dir, providers, top_provider, top_score,"
+                " wall_seconds, llm_calls, cost_usd, models) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (file_id, metrics["started_at"], metrics["started_at"] + metrics.get("wall_seconds", 0), output_dir,
+                 len(scores), ranking[0] if ranking else None, scores[ranking[0]] if ranking else None,
+                 metrics.get("wall_seconds"), totals.get("llm_calls"), totals.get("cost_usd"),
+                 json.dumps(models) if models else None))
+            db.executemany("INSERT INTO provider_scores (run_id, provider, score, position) VALUES (?, ?, ?, ?)",
+                           [(cursor.lastrowid, provider, scores[provider], position)
+                            for position, provider in enumerate(ranking, start=1)])
+            return cursor.lastrowid
+
+    def list_runs(self, search=None, order="recent", limit=RESULTS_PAGE_SIZE, offset=0):
+        """Newest (or with `order` "score", best scoring) runs first, one page at a time.
+
+        `search` matches the start of the workspace id or a provider name. Each run
+        comes with its providers as [(provider, score, position)] in ranking order.
+        """
+        where, params = "", []
+        if search:
+            where = ("WHERE file_id LIKE ? ESCAPE '\\' OR EXISTS (SELECT 1 FROM provider_scores"
+                     " WHERE run_id = runs.id AND provider LIKE ? ESCAPE '\\')")
+            pattern = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params += [f"{pattern}%", f"%{pattern}%"]
+        order_by = "top_score DESC, finished_at DESC" if order == "score" else "finished_at DESC"
+        with closing(self.connect()) as db:
+            runs = [dict(row) for row in db.execute(f"SELECT * FROM runs {where} ORDER BY {order_by} LIMIT ? OFFSET ?",
+                                                    params + [limit, offset])]
+            if runs:
+                placeholders = ",".join("?" * len(runs))
+                by_run = {run["id"]: run for run in runs}
+                for run in runs:
+                    run["scores"] = []
+                for row in db.execute(f"SELECT run_id, provider, score, position FROM provider_scores"
+                                      f" WHERE run_id IN ({placeholders}) ORDER BY position", list(by_run)):
+                    by_run[row["run_id"]]["scores"].append((row["provider"], row["score"], row["position"]))
+        return runs
+
+    def get_run(self, run_id):
+        with closing(self.connect()) as db:
+            row = db.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+            if row is None:
+                return None
+            run = dict(row)
+            run["scores"] = [(row["provider"], row["score"], row["position"]) for row in db.execute(
+                "SELECT provider, score, position FROM provider_scores WHERE run_id = ? ORDER BY position", (run_id,))]
+        return run
+
+    # Indexes the runs under `markdown_dir` that finished before the store existed, from their
+    # metrics.json and the <provider>_ratings.json of the providers in stages.json; runs already
+    # indexed are skipped
+    def reindex(self, markdown_dir="./markdown"):
+        with closing(self.connect()) as db:
+            known = {(row["file_id"], row["started_at"]) for row in db.execute("SELECT file_id, started_at FROM runs")}
+        added = 0
+        for metrics_path in sorted(glob.glob(os.path.join(markdown_dir, "*", "metrics.json"))):
+            output_dir = os.path.dirname(metrics_path)
+            try:
+                with open(metrics_path) as file:
+                    metrics = json.load(file)
+                # ratings left behind by providers removed since are not part of the run
+                tasks = None
+                if os.path.exists(os.path.join(output_dir, "stages.json")):
+                    with open(os.path.join(output_dir, "stages.json")) as file:
+                        tasks = json.load(file)
+                ratings = {}
+                for ratings_path in sorted(glob.glob(os.path.join(output_dir, "*_ratings.json"))):
+                    provider = os.path.basename(ratings_path)[:-len("_ratings.json")]
+                    if tasks is not None and f"{provider}_comparison" not in tasks:
+                        continue
+                    with open(ratings_path) as file:
+                        ratings[provider] = json.load(file)
+            except (OSError, ValueError) as e:
+                print("--debug results store skipping",output_dir,e)
+                continue
+            file_id = metrics.get("fileId") or os.path.basename(output_dir)
+            if "started_at" not in metrics or (file_id, metrics["started_at"]) in known:
+                continue
+            self.record_run(file_id, output_dir, ratings, metrics, metrics.get("models"))
+            added += 1
+        return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index and list finished analyses")
+    parser.add_argument('--reindex', action='store_true', help='Index the runs under ./markdown/ that are not in the store yet')
+    parser.add_argument('--search', type=str, help='Start of a workspace id or part of a provider name')
+    parser.add_argument('--order', type=str, choices=["recent", "score"], default="recent")
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    store = ResultsStore()
+    if args.reindex:
+        print(f"--results indexed {store.reindex()} runs", file=sys.stderr)
+    for run in store.list_runs(args.search, args.order, args.limit):
+        ranking = ", ".join(f"{provider} {score}" for provider, score, _ in run["scores"])
+        print(f"{run['id']:>6}  {run['file_id']}  {run['output_dir']}  {ranking}")
@@ -0,0 +1,143 @@
+import os
+import re
+import sqlite3
+from contextlib import closing
+from chunking import split_paragraphs
+
+INDEX_VERSION = 2
+RETRIEVAL_INDEX_DIR = os.getenv("RETRIEVAL_INDEX_DIR", "./cache/index")
+RETRIEVAL_PASSAGE_CHARS = int(os.getenv("RETRIEVAL_PASSAGE_CHARS", 1500))  # about 350 tokens per passage
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 4))  # passages per side and criterion
+RETRIEVAL_COMMIT_PASSAGES = 500  # passages per transaction while indexing
+
+TERM = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a an and are as at be been but by can could do does for from had has have if in into is it its may more must
+no not of on or our shall should such than that the their them then there these they this those to under up
+upon was we were what when where which while who will with within would you your all any each other also
+""".split())
+
+
+def terms(text):
+    return [term for term in TERM.findall(text.lower()) if len(term) > 1 and term not in STOPWORDS]
+
+
+# Packs whole paragraphs into passages of at most max_chars, slicing paragraphs that are longer
+def pack_passages(text, max_chars=RETRIEVAL_PASSAGE_CHARS):
+    current, size = [], 0
+    for paragraph in split_paragraphs(text):
+        for start in range(0, len(paragraph), max_chars):
+            piece = paragraph[start:start + max_chars]
+            if current and size + len(piece) + 2 > max_chars:
+                yield "\n\n".join(current)
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece) + 2
+    if current:
+        yield "\n\n".join(current)
+
+
+class PassageIndex:
+    """BM25 index over the passages of one target's documents (the customer RFQ or one provider).
+
+    Passages go into an SQLite FTS5 table in `index.sqlite3` as they are indexed,
+    in transactions of RETRIEVAL_COMMIT_PASSAGES, so the postings live on disk and
+    memory stays bounded whatever the size of the documents. Only the stopword
+    filtered terms are indexed; the fingerprint of the files they came from is
+    stored alongside, so the next run over unchanged files opens the index
+    instead of rebuilding it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.count = 0
+        self._db = None
+
+    @property
+    def indexPath(self):
+        return os.path.join(self.directory, "index.sqlite3")
+
+    @property
+    def buildPath(self):
+        return f"{self.indexPath}.{os.getpid()}.tmp"
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def load(cls, directory, fingerprint):
+        index = cls(directory)
+        if not os.path.exists(index.indexPath):
+            return None
+        try:
+            with closing(index.connect()) as db:
+                meta = dict(db.execute("SELECT key, value FROM meta"))
+                if meta.get("version") != str(INDEX_VERSION) or meta.get("fingerprint") != fingerprint:
+                    return None
+                index.count = db.execute("SELECT count(*) FROM passages").fetchone()[0]
+        except sqlite3.Error:
+            return None
+        return index
+
+    def connect(self, path=None):
+        return sqlite3.connect(path or self.indexPath, timeout=30)
+
+    # Indexes the documents as they pass through and saves the index once they are exhausted
+    def indexing(self, docs, fingerprint):
+        for doc in docs:
+            source = os.path.basename(doc.metadata.get('source', ''))
+            for passage in pack_passages(doc.page_content):
+                self.add(passage, source)
+            yield doc
+        self.save(fingerprint)
+
+    # Opens a fresh build database next to the index, swapped in by save()
+    def _builder(self):
+        if self._db is None:
+            os.makedirs(self.directory, exist_ok=True)
+            if os.path.exists(self.buildPath):
+                os.remove(self.buildPath)
+            self._db = self.connect(self.buildPath)
+            self._db.executescript("""
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE VIRTUAL TABLE passages USING fts5(terms, source UNINDEXED, text UNINDEXED);
+            """)
+        return self._db
+
+    def add(self, text, source):
+        db = self._builder()
+        db.execute("INSERT INTO passages (rowid, terms, source, text) VALUES (?, ?, ?, ?)",
+                   (self.count, " ".join(terms(text)), source, text))
+        self.count += 1
+        if self.count % RETRIEVAL_COMMIT_PASSAGES == 0:
+            db.commit()
+
+    def save(self, fingerprint):
+        db = self._builder()
+        db.executemany("INSERT INTO meta (key, value) VALUES (?, ?)",
+                       [("version", str(INDEX_VERSION)), ("fingerprint", fingerprint)])
+        db.commit()
+        db.execute("INSERT INTO passages (passages) VALUES ('optimize')")
+        db.commit()
+        db.close()
+        self._db = None
+        os.replace(self.buildPath, self.indexPath)
+
+    def passage(self, number):
+        with closing(self.connect()) as db:
+            source, text = db.execute("SELECT source, text FROM passages WHERE rowid = ?", (number,)).fetchone()
+        return {"source": source, "text": text}
+
+    def search(self, query, k=RETRIEVAL_TOP_K):
+        """Top `k` passages for `query` by BM25, as dicts with id, source, text and score."""
+        queryTerms = sorted(set(terms(query)))
+        if not self.count or not queryTerms:
+            return []
+        # terms are plain [a-z0-9]+, quoting keeps them from reading as FTS5 operators
+        match = " OR ".join(f'"{term}"' for term in queryTerms)
+        # a connection per search, as the criteria are searched from several threads
+        with closing(self.connect()) as db:
+            rows = db.execute("SELECT rowid, source, text, bm25(passages) AS rank FROM passages"
+                              " WHERE passages MATCH ? ORDER BY rank LIMIT ?", (f"terms : ({match})", k)).fetchall()
+        # FTS5 ranks better matches lower
+        return [{"id": number, "score": round(-rank, 3), "source": source, "text": text} for number, source, text, rank in rows]
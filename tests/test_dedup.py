@@ -0,0 +1,67 @@
+import random
+
+from dedup import NearDuplicateFilter
+
+VOCABULARY = [f"word{i}" for i in range(2000)]
+
+
+def paragraph(seed, words=120):
+    rng = random.Random(seed)
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def edited(text, changes, seed=0):
+    rng = random.Random(seed)
+    words = text.split()
+    for _ in range(changes):
+        words[rng.randrange(len(words))] = rng.choice(VOCABULARY)
+    return " ".join(words)
+
+
+def test_exact_repeat_is_dropped():
+    dedup = NearDuplicateFilter(threshold=0.8, min_tokens=10)
+    text = paragraph(1)
+    assert not dedup.is_duplicate(text, 150)
+    # case and punctuation do not matter
+    assert dedup.is_duplicate(text.upper().replace(" ", ", "), 150)
+
+
+def test_near_repeat_is_dropped():
+    dedup = NearDuplicateFilter(threshold=0.8, min_tokens=10)
+    text = paragraph(2)
+    assert not dedup.is_duplicate(text, 150)
+    assert dedup.is_duplicate(edited(text, 1), 150)
+
+
+def test_distinct_paragraphs_are_kept():
+    dedup = NearDuplicateFilter(threshold=0.8, min_tokens=10)
+    assert not any(dedup.is_duplicate(paragraph(seed), 150) for seed in range(500))
+
+
+def test_heavily_edited_paragraph_is_kept():
+    dedup = NearDuplicateFilter(threshold=0.8, min_tokens=10)
+    text = paragraph(3)
+    assert not dedup.is_duplicate(text, 150)
+    # a word in every ten changed leaves about 60% of the 5-word shingles in common
+    assert not dedup.is_duplicate(edited(text, 12, seed=3), 150)
+
+
+def test_short_paragraphs_and_disabled_filter_keep_everything():
+    text = paragraph(4)
+    short = NearDuplicateFilter(threshold=0.8, min_tokens=200)
+    assert not short.is_duplicate(text, 150) and not short.is_duplicate(text, 150)
+    disabled = NearDuplicateFilter(threshold=0, min_tokens=10)
+    assert not disabled.is_duplicate(text, 150) and not disabled.is_duplicate(text, 150)
+
+
+def test_window_bounds_the_state():
+    dedup = NearDuplicateFilter(threshold=0.8, min_tokens=10, window=10)
+    first = paragraph(5)
+    dedup.is_duplicate(first, 150)
+    for seed in range(100, 120):
+        dedup.is_duplicate(paragraph(seed), 150)
+    assert len(dedup.kept) == len(dedup.exact) == 10
+    assert len(dedup.buckets) <= 10 * 16
+    # the first paragraph fell out of the window
+    assert not dedup.is_duplicate(first, 150)
+    assert dedup.is_duplicate(paragraph(119), 150)
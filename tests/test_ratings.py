@@ -0,0 +1,87 @@
+import os
+import json
+
+import pytest
+
+os.environ.setdefault("OPENAI_KEY", "test")
+
+import comparison
+from results_store import combined_score
+
+
+def answer(score=3, **fields):
+    data = {
+        "ratings": {comparison.aspectKey(aspect): {"score": score, "comment": f" {aspect} is covered "} for aspect in comparison.KEY_ASPECTS},
+        "strengths": [" clear plan "],
+        "weaknesses": ["no references"],
+        "missing": [],
+    }
+    data.update(fields)
+    return data
+
+
+def with_rating(entry):
+    data = answer()
+    data["ratings"][comparison.aspectKey("QA Plan")] = entry
+    return json.dumps(data)
+
+
+def test_valid_ratings_are_parsed():
+    parsed = comparison.parseRatings(json.dumps(answer(score=4)))
+    assert list(parsed["ratings"]) == list(comparison.KEY_ASPECTS)
+    assert parsed["ratings"]["QA Plan"] == {"score": 4, "comment": "QA Plan is covered"}
+    assert parsed["strengths"] == ["clear plan"]
+    assert parsed["weaknesses"] == ["no references"]
+    assert parsed["missing"] == []
+
+
+@pytest.mark.parametrize("content", ["", "not json", "[]", json.dumps({"ratings": []})])
+def test_unusable_answer_is_rejected(content):
+    with pytest.raises(ValueError):
+        comparison.parseRatings(content)
+
+
+def test_missing_aspect_is_rejected():
+    data = answer()
+    del data["ratings"][comparison.aspectKey("Fee Structure")]
+    with pytest.raises(ValueError, match="Fee Structure"):
+        comparison.parseRatings(json.dumps(data))
+
+
+@pytest.mark.parametrize("entry", [
+    {"score": 0, "comment": "below the scale"},
+    {"score": 6, "comment": "above the scale"},
+    {"score": 3.0, "comment": "not an int"},
+    {"score": "3", "comment": "a string"},
+    {"score": True, "comment": "a bool"},
+    {"score": 3},
+    {"score": 3, "comment": None},
+    "3",
+])
+def test_invalid_rating_is_rejected(entry):
+    with pytest.raises(ValueError, match="QA Plan"):
+        comparison.parseRatings(with_rating(entry))
+
+
+@pytest.mark.parametrize("field, values", [
+    ("strengths", "clear plan"),
+    ("weaknesses", ["no references", 3]),
+    ("missing", None),
+])
+def test_invalid_lists_are_rejected(field, values):
+    with pytest.raises(ValueError, match=field):
+        comparison.parseRatings(json.dumps(answer(**{field: values})))
+
+
+def test_combined_score_adds_up_the_aspects():
+    parsed = comparison.parseRatings(json.dumps(answer(score=2)))
+    assert combined_score(parsed) == 2 * len(comparison.KEY_ASPECTS)
+    parsed["ratings"]["QA Plan"]["score"] = 5
+    assert combined_score(parsed) == 2 * len(comparison.KEY_ASPECTS) + 3
+
+
+def test_ranking_is_by_score_and_ties_keep_the_submission_order():
+    scores = {"delta": 50, "alpha": 61, "charlie": 50, "bravo": 61, "echo": 18}
+    assert comparison.rankByScore(list(scores), scores) == ["alpha", "bravo", "delta", "charlie", "echo"]
+    providers = ["charlie", "delta", "echo", "bravo", "alpha"]
+    assert comparison.rankByScore(providers, scores) == ["bravo", "alpha", "charlie", "delta", "echo"]
@@ -0,0 +1,92 @@
+import os
+import shutil
+import hashlib
+import tempfile
+
+UPLOAD_BLOB_DIR = os.getenv("UPLOAD_BLOB_DIR", "./cache/uploads")  # content-addressed store shared by all workspaces
+UPLOAD_BLOCK_BYTES = 1024 * 1024
+
+
+def blob_path(file_hash, blob_dir=UPLOAD_BLOB_DIR):
+    return os.path.join(blob_dir, file_hash[:2], file_hash)
+
+
+# Streams an upload into the blob store in blocks while hashing it; identical content is stored once
+def store_blob(upload, blob_dir=UPLOAD_BLOB_DIR):
+    os.makedirs(blob_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    upload.seek(0)
+    with tempfile.NamedTemporaryFile(dir=blob_dir, prefix=".upload-", delete=False) as tmp:
+        for block in iter(lambda: upload.read(UPLOAD_BLOCK_BYTES), b""):
+            digest.update(block)
+            tmp.write(block)
+    file_hash = digest.hexdigest()
+    path = blob_path(file_hash, blob_dir)
+    if os.path.exists(path):
+        os.remove(tmp.name)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp.name, path)
+    return file_hash
+
+
+# Places the blob at `dest` as a hard link (a copy where links are not possible)
+def link_blob(path, dest):
+    if os.path.exists(dest) and os.path.samefile(path, dest):
+        return False
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_dest = f"{dest}.{os.getpid()}.tmp"
+    try:
+        os.link(path, tmp_dest)
+    except OSError:
+        shutil.copyfile(path, tmp_dest)
+    os.replace(tmp_dest, dest)
+    return True
+
+
+class UploadPersister:
+    """Writes a session's uploads into its workspace once.
+
+    `persist` takes {relative path in the workspace: uploaded file}. Uploads already
+    written for that path in this session (same upload id, name and size) are
+    skipped without reading them; new ones are streamed into the blob store, where
+    identical content is kept once, and hard-linked into the workspace. Files of the
+    workspace that are no longer uploaded are removed, so a replaced upload does not
+    linger next to its successor.
+    """
+
+    def __init__(self, workspace, blob_dir=UPLOAD_BLOB_DIR):
+        self.workspace = workspace
+        self.blob_dir = blob_dir
+        self.persisted = {}  # relative path -> (upload key, sha256)
+
+    @staticmethod
+    def upload_key(upload):
+        return (getattr(upload, "file_id", None), upload.name, upload.size)
+
+    def persist(self, uploads):
+        written = []
+        for relpath, upload in uploads.items():
+            dest = os.path.join(self.workspace, relpath)
+            key = self.upload_key(upload)
+            known = self.persisted.get(relpath)
+            if known and known[0] == key and os.path.exists(dest):
+                continue
+            file_hash = store_blob(upload, self.blob_dir)
+            link_blob(blob_path(file_hash, self.blob_dir), dest)
+            self.persisted[relpath] = (key, file_hash)
+            written.append(relpath)
+        self.remove_stale(set(uploads))
+        return written
+
+    def remove_stale(self, current):
+        for relpath in [relpath for relpath in self.persisted if relpath not in current]:
+            del self.persisted[relpath]
+        for root, dirs, files in os.walk(self.workspace, topdown=False):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.relpath(path, self.workspace) not in current:
+                    os.remove(path)
+            # an emptied provider folder would still count as a provider
+            if root != self.workspace and not os.listdir(root):
+                os.rmdir(root)
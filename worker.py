@@ -0,0 +1,154 @@
+import os
+import time
+import uuid
+import atexit
+import threading
+import traceback
+import multiprocessing
+from metrics import registry, serve_metrics
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))  # warm pipeline processes
+JOB_EVENT_HISTORY = 200  # progress events kept per job
+
+
+# Runs in each worker process: pays for the heavy imports (langchain, unstructured,
+# tesseract OCR, OpenAI client, tokenizer) once, then serves jobs until stopped
+def serve(requests, events):
+    start = time.perf_counter()
+    import comparison
+    from chunking import get_encoding
+    get_encoding(comparison.LLM_MODEL)
+    events.put({"type": "ready", "pid": os.getpid(), "import_seconds": time.perf_counter() - start})
+
+    while True:
+        job = requests.get()
+        if job is None:
+            break
+        jobId, kind, fileId, options, submittedAt = job
+        events.put({"type": "started", "jobId": jobId, "pid": os.getpid(), "startup_seconds": time.time() - submittedAt})
+        try:
+            if kind == "ping":
+                result = None
+            else:
+                onEvent = lambda event: events.put({"type": "progress", "jobId": jobId, **event})
+                result = comparison.run_analysis(fileId, onEvent=onEvent, **options)
+            events.put({"type": "done", "jobId": jobId, "result": result})
+        except Exception:
+            events.put({"type": "error", "jobId": jobId, "error": traceback.format_exc()})
+
+
+class JobQueue:
+    """Local job queue served by a pool of warm pipeline processes.
+
+    `submit` returns a job id immediately; `status` returns the job's state
+    (queued, running, done, error), the current stage and progress, so callers
+    can poll without blocking on the analysis. A job is tied to the worker
+    process that started it, and `check_workers` fails the job and replaces the
+    worker when that process dies mid-job.
+    """
+
+    def __init__(self, workers=JOB_WORKERS):
+        self.context = multiprocessing.get_context("spawn")
+        self.requests = self.context.Queue()
+        self.events = self.context.Queue()
+        self.processes = [self._spawn() for _ in range(workers)]
+        self.jobs = {}
+        self.import_seconds = []
+        # reentrant, as wait() checks the workers while holding it
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        threading.Thread(target=self._collect, daemon=True).start()
+        atexit.register(self.stop)
+        # runs happen in the workers, their metrics are added up here where the endpoint is served
+        serve_metrics()
+
+    def _spawn(self):
+        process = self.context.Process(target=serve, args=(self.requests, self.events))
+        process.start()
+        return process
+
+    def submit(self, fileId, kind="analysis", **options):
+        jobId = uuid.uuid4().hex
+        with self._lock:
+            self.jobs[jobId] = {
+                "jobId": jobId, "fileId": fileId, "status": "queued", "stage": None, "target": None,
+                "progress": 0.0, "events": [], "result": None, "error": None,
+                "submitted_at": time.time(), "started_at": None, "finished_at": None, "startup_seconds": None, "pid": None,
+            }
+        self.requests.put((jobId, kind, fileId, options, time.time()))
+        print("--debug job submitted", jobId, fileId)
+        return jobId
+
+    def status(self, jobId):
+        with self._lock:
+            job = dict(self.jobs[jobId])
+            job["events"] = list(job["events"])
+            return job
+
+    def wait(self, jobId, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._changed:
+            while self.jobs[jobId]["status"] not in ("done", "error"):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"Job {jobId} still {self.jobs[jobId]['status']}")
+                self._changed.wait(remaining if remaining is not None else 1)
+                self.check_workers()
+            job = self.jobs[jobId]
+        if job["status"] == "error":
+            raise RuntimeError(f"Analysis {job['fileId']} failed in the worker:\n{job['error']}")
+        return job["result"]
+
+    # Fails the running jobs of worker processes that died (killed for memory, crashed in a
+    # parser) and starts a replacement for each such worker; raises when no worker is alive.
+    # Workers that die without a job, e.g. on a broken import, are not restarted
+    def check_workers(self):
+        with self._changed:
+            for slot, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                lost = [job for job in self.jobs.values() if job["status"] == "running" and job["pid"] == process.pid]
+                if not lost:
+                    continue
+                for job in lost:
+                    job.update(status="error", finished_at=time.time(),
+                               error=f"Worker process {process.pid} exited with code {process.exitcode} while running the job")
+                self.processes[slot] = self._spawn()
+                print("--debug worker", process.pid, "exited mid-job, replaced by", self.processes[slot].pid)
+                self._changed.notify_all()
+            if not any(process.is_alive() for process in self.processes):
+                raise RuntimeError("All pipeline workers have exited")
+
+    def _collect(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            with self._changed:
+                if event["type"] == "ready":
+                    self.import_seconds.append(event["import_seconds"])
+                    print("--debug worker", event["pid"], "ready, imports took", round(event["import_seconds"], 2), "s")
+                    continue
+                job = self.jobs.get(event["jobId"])
+                if job is None:
+                    continue
+                if event["type"] == "started":
+                    job.update(status="running", pid=event["pid"], started_at=time.time(), startup_seconds=event["startup_seconds"])
+                elif event["type"] == "progress":
+                    job.update(stage=event["stage"], target=event["target"], progress=event["progress"])
+                    job["events"] = (job["events"] + [event])[-JOB_EVENT_HISTORY:]
+                elif event["type"] == "done":
+                    job.update(status="done", progress=1.0, result=event["result"], finished_at=time.time())
+                    if event["result"] and "metrics" in event["result"]:
+                        registry.observe_run(event["result"]["metrics"])
+                elif event["type"] == "error":
+                    job.update(status="error", error=event["error"], finished_at=time.time())
+                self._changed.notify_all()
+
+    def stop(self):
+        for process in self.processes:
+            if process.is_alive():
+                self.requests.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+        self.events.put(None)